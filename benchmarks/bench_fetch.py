@@ -0,0 +1,53 @@
+"""
+Compare fetching a 40-tile mosaic with a fresh connection per tile (what the old grequests
+path did) against the pooled keep-alive `TileFetcher`.
+
+    python -m benchmarks.bench_fetch [--tiles 40] [--rounds 5] [--connect-delay 0.05]
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from stitch.fetch import TileFetcher, run_sync
+from benchmarks.tileserver import serve
+
+
+def _per_tile_connections(urls):
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        return list(pool.map(requests.get, urls))
+
+
+def _pooled(fetcher, urls):
+    return run_sync(fetcher.get_all(urls))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tiles', type=int, default=40)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--connect-delay', type=float, default=0.05)
+    args = parser.parse_args()
+
+    with serve(latency=args.latency, connect_delay=args.connect_delay) as (server, base):
+        urls = ['{}/tile/{}.png'.format(base, i) for i in range(args.tiles)]
+        fetcher = TileFetcher(per_host=10)
+
+        for name, run in (('per-tile connections', _per_tile_connections),
+                          ('pooled keep-alive', lambda u: _pooled(fetcher, u))):
+            server.stats['connections'] = 0
+            timings = []
+            for _ in range(args.rounds):
+                start = time.perf_counter()
+                run(urls)
+                timings.append(time.perf_counter() - start)
+            print('{:<22} best {:.3f}s  mean {:.3f}s  connections {}'.format(
+                name, min(timings), sum(timings) / len(timings), server.stats['connections']))
+
+        fetcher.close()
+
+
+if __name__ == '__main__':
+    main()
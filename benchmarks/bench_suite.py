@@ -0,0 +1,193 @@
+"""
+Benchmark suite: end-to-end renders against a local stand-in for rammb-slider and himawari8-dl,
+plus the image operations every render goes through. Each benchmark reports its best and mean
+time, its throughput and the peak memory of a single run (Python/NumPy allocations traced by
+tracemalloc, and the growth of the process's resident set while it ran).
+
+    python -m benchmarks.bench_suite [--rounds 5] [--latency 0.02] [--jitter 0.01]
+                                     [--error-rate 0.0] [--goes-seconds-variation 3]
+                                     [--only himawari] [--json results.json]
+"""
+import argparse
+import ctypes
+import gc
+import json
+import os
+import threading
+import time
+import tracemalloc
+import warnings
+from datetime import datetime
+
+from PIL import Image, ImageFilter
+
+from stitch import core, nict_himawari, rammb_slider
+from stitch.core import TileArray, composite_into, overlay
+from stitch.fetch import TileFetcher, set_default_fetcher
+from stitch.postprocess import CIRAPostProcessor
+from benchmarks.tileserver import stand_in
+
+_timestamp = datetime(2017, 8, 6, 0, 0)
+
+
+def _cold(render):
+    # every round starts without any of the in-process caches warm
+    def run():
+        rammb_slider.clear_overlay_cache()
+        nict_himawari.clear_coastline_cache()
+        rammb_slider.set_scan_seconds_index(None)
+        return render()
+    return run
+
+
+def _end_to_end_benchmarks():
+    # (name, run, units of work per run, unit)
+    yield ('himawari 4x3 + map + lat', _cold(lambda: rammb_slider.himawari(
+        _timestamp, 3, 13, range(0, 4), range(0, 3), latlon=True)), 36, 'tiles')
+    yield ('goes16 4x3 + map', _cold(lambda: rammb_slider.goes16(
+        _timestamp, 3, 14, range(0, 4), range(0, 3))), 24, 'tiles')
+    yield ('himawari cropped 5x4', _cold(lambda: rammb_slider.himawari(
+        _timestamp, 3, 13, range(0, 5), range(0, 4), crop=(0, 0, 0.5, 0.6))), 18, 'tiles')
+    yield ('vis 4x4 + coastline', _cold(lambda: nict_himawari.vis(
+        _timestamp, 3, range(0, 4), range(0, 4))), 32, 'tiles')
+
+
+def _image_benchmarks():
+    tiles = {(x, y): Image.new('RGB', (550, 550), (10 * x, 10 * y, 100)) for x in range(5) for y in range(4)}
+    rgba_tiles = {pos: tile.convert('RGBA') for pos, tile in tiles.items()}
+    base = Image.new('RGB', (2750, 2200), (10, 80, 160))
+    layer = Image.new('RGBA', base.size, (255, 255, 0, 0))
+    layer.paste((255, 255, 0, 200), (0, 1000, 2750, 1010))
+    megapixels = base.width * base.height / 1e6
+
+    yield ('TileArray.merge RGB 5x4', lambda: TileArray.fromtiles(tiles).merge(), 20, 'tiles')
+    yield ('TileArray.merge RGBA 5x4', lambda: TileArray.fromtiles(rgba_tiles, 'RGBA').merge(), 20, 'tiles')
+    yield ('overlay x2', lambda: overlay(overlay(base, layer), layer), megapixels, 'MP')
+    yield ('composite_into x2', lambda: composite_into(base.copy(), layer, layer), megapixels, 'MP')
+
+    def postprocess(*ops, **kwargs):
+        def run():
+            img = CIRAPostProcessor(base, 'band_14', _timestamp, **kwargs)
+            for op in ops:
+                op(img)
+            return img.result()
+        return run
+
+    yield ('crop_relative', postprocess(lambda im: im.crop_relative(0, 0, 0.8, 0.87)), megapixels, 'MP')
+    yield ('minimize', postprocess(lambda im: im.minimize(1000, 1000)), megapixels, 'MP')
+    yield ('scale 0.5', postprocess(lambda im: im.scale(0.5)), megapixels, 'MP')
+    yield ('timestamp_label', postprocess(lambda im: im.timestamp_label()), megapixels, 'MP')
+    yield ('apply_filter SHARPEN', postprocess(lambda im: im.apply_filter(ImageFilter.SHARPEN)), megapixels, 'MP')
+    yield ('logo', postprocess(lambda im: im.logo()), megapixels, 'MP')
+    yield ('colorbar', postprocess(lambda im: im.colorbar()), megapixels, 'MP')
+
+    chain = (lambda im: im.apply_filter(ImageFilter.SHARPEN), lambda im: im.crop_relative(0, 0, 0.5, 0.5),
+             lambda im: im.timestamp_label(), lambda im: im.logo(), lambda im: im.colorbar())
+    yield ('5-op chain eager', postprocess(*chain), megapixels, 'MP')
+    yield ('5-op chain lazy', postprocess(*chain, lazy=True), megapixels, 'MP')
+
+
+def _rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _release_freed_memory():
+    # hand memory freed by earlier runs back to the OS, so it isn't silently reused by this one
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def _peak_memory(run):
+    # peak traced allocations, and peak resident set growth sampled while `run` executes
+    gc.collect()
+    _release_freed_memory()
+    start_rss = _rss()
+    peak_rss = [start_rss]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.002):
+            peak_rss[0] = max(peak_rss[0], _rss())
+
+    sampler = threading.Thread(target=sample, daemon=True) if start_rss is not None else None
+    tracemalloc.start()
+    if sampler is not None:
+        sampler.start()
+    try:
+        run()
+    finally:
+        done.set()
+        if sampler is not None:
+            sampler.join()
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    rss_growth = None if start_rss is None else max(0, max(peak_rss[0], _rss()) - start_rss)
+    return traced_peak, rss_growth
+
+
+def _measure(name, run, units, unit, rounds):
+    run()  # warm up imports, fonts, assets and connections
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    traced_peak, rss_growth = _peak_memory(run)
+    best = min(timings)
+    return {'name': name, 'best': best, 'mean': sum(timings) / len(timings),
+            'throughput': units / best, 'unit': unit, 'peak_traced': traced_peak, 'peak_rss_growth': rss_growth}
+
+
+def _report(result):
+    rss = '-' if result['peak_rss_growth'] is None else '{:.1f}'.format(result['peak_rss_growth'] / 2 ** 20)
+    print('{:<28} best {:7.3f}s  mean {:7.3f}s  {:9.1f} {}/s  peak traced {:7.1f} MiB  peak rss +{} MiB'.format(
+        result['name'], result['best'], result['mean'], result['throughput'], result['unit'],
+        result['peak_traced'] / 2 ** 20, rss))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--goes-seconds-variation', type=int, default=3)
+    parser.add_argument('--only', help='run only benchmarks whose name contains this')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    with stand_in(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                  goes_seconds_variation=args.goes_seconds_variation) as (server, _):
+        fetcher = TileFetcher()
+        set_default_fetcher(fetcher)
+        core.set_tile_cache(None)
+        try:
+            with warnings.catch_warnings():
+                # failed tiles are expected when running with an error rate
+                warnings.simplefilter('ignore')
+                for benchmarks in (_end_to_end_benchmarks(), _image_benchmarks()):
+                    for name, run, units, unit in benchmarks:
+                        if args.only and args.only not in name:
+                            continue
+                        results.append(_measure(name, run, units, unit, args.rounds))
+                        _report(results[-1])
+        finally:
+            set_default_fetcher(None)
+            fetcher.close()
+        print('stand-in server: {} connections, {} requests'.format(server.stats['connections'],
+                                                                    server.stats['requests']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
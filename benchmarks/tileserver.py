@@ -0,0 +1,185 @@
+"""
+Local stand-ins for the upstream tile servers, used by the benchmarks.
+
+`serve` answers every GET with the same PNG tile. `connect_delay` is paid once per new
+connection to stand in for TCP/TLS setup to a remote host, and `latency` is paid once per
+request.
+
+`stand_in` serves synthetic tiles at the URL layouts of rammb-slider and himawari8-dl, and
+points `stitch.rammb_slider` and `stitch.nict_himawari` at itself while it is open.
+"""
+import io
+import random
+import re
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+from stitch import nict_himawari, rammb_slider
+
+
+def _png_tile(size=(550, 550), color=(40, 40, 40)):
+    buf = io.BytesIO()
+    Image.new('RGB', size, color).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super(TileHandler, self).setup()
+        with self.server.lock:
+            self.server.stats['connections'] += 1
+        if self.server.connect_delay:
+            time.sleep(self.server.connect_delay)
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        body = self.server.tile
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def serve(latency=0.0, connect_delay=0.0, handler=TileHandler, **attrs):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.latency = latency
+    server.connect_delay = connect_delay
+    server.tile = _png_tile()
+    server.stats = {'connections': 0, 'requests': 0}
+    for name, value in attrs.items():
+        setattr(server, name, value)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+_rammb_tile_size = 678
+_nict_tile_size = 550
+
+# (tile kind, pattern) for every URL layout the stitch modules request
+_routes = (
+    ('rammb', re.compile(r'^/data/imagery/\d{8}/(?P<sat>[\w-]+?)---(?P<sector>\w+)/\w+/'
+                         r'(?P<scan>\d{12})(?P<seconds>\d{2})/\d{2}/(?P<y>\d{3})_(?P<x>\d{3})\.png$')),
+    ('rammb-overlay', re.compile(r'^/data/(?:map|lat)/[\w-]+/\w+/white/\d{14}/\d{2}/'
+                                 r'(?P<y>\d{3})_(?P<x>\d{3})\.png$')),
+    ('nict', re.compile(r'^/himawari8/img/\w+/\w+/550/\d{4}/\d{2}/\d{2}/\d{6}_(?P<x>\d+)_(?P<y>\d+)\.png$')),
+    ('nict-overlay', re.compile(r'^/himawari8/img/\w+/\w+/550/coastline/ffff00_(?P<x>\d+)_(?P<y>\d+)\.png$')),
+)
+
+
+def _synthetic_tiles():
+    # a few encoded variants per kind, so tiles differ without encoding one per request
+    tiles = {}
+    for variant in range(4):
+        shade = 40 + 50 * variant
+        tiles['rammb', variant] = _png_tile((_rammb_tile_size,) * 2, (shade, shade, shade))
+        tiles['nict', variant] = _png_tile((_nict_tile_size,) * 2, (shade, shade // 2, shade))
+        for kind, size in (('rammb-overlay', _rammb_tile_size), ('nict-overlay', _nict_tile_size)):
+            im = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+            im.paste((255, 255, 0, 255), (0, variant * size // 4, size, variant * size // 4 + 2))
+            buf = io.BytesIO()
+            im.save(buf, 'PNG')
+            tiles[kind, variant] = buf.getvalue()
+    return tiles
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super(StandInHandler, self).setup()
+        with self.server.lock:
+            self.server.stats['connections'] += 1
+        if self.server.connect_delay:
+            time.sleep(self.server.connect_delay)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def _respond(self, send_body):
+        server = self.server
+        with server.lock:
+            server.stats['requests'] += 1
+            failed = server.error_rate and server.random.random() < server.error_rate
+            delay = server.latency + server.jitter * server.random.random()
+        if delay:
+            time.sleep(delay)
+
+        status, body = (503, b'') if failed else self._tile()
+        with server.lock:
+            server.stats[status] = server.stats.get(status, 0) + 1
+        self.send_response(status)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def _tile(self):
+        for kind, pattern in _routes:
+            match = pattern.match(self.path)
+            if match is None:
+                continue
+            groups = match.groupdict()
+            if groups.get('sat') == 'goes-16' and int(groups['seconds']) != self.server.goes_seconds(
+                    groups['sector'], groups['scan']):
+                return 404, b''
+            return 200, self.server.tiles[kind, (int(groups['x']) + int(groups['y'])) % 4]
+        return 404, b''
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def stand_in(latency=0.0, jitter=0.0, error_rate=0.0, goes_seconds=38, goes_seconds_variation=0,
+             connect_delay=0.0, seed=0):
+    """
+    Serve synthetic RAMMB and NICT tiles with `latency` plus up to `jitter` seconds of delay per
+    request, failing a random `error_rate` fraction of requests with a 503. GOES-16 scans are
+    only found at `goes_seconds` past the minute, shifted per scan by up to
+    +/-`goes_seconds_variation` seconds, as on the real server.
+    """
+    def scan_seconds(sector, scan):
+        if not goes_seconds_variation:
+            return goes_seconds
+        spread = 2 * goes_seconds_variation + 1
+        return goes_seconds - goes_seconds_variation + zlib.crc32((sector + scan).encode()) % spread
+
+    parent_url, base_url = rammb_slider.PARENT_URL, nict_himawari.BASE_URL
+    with serve(latency=latency, connect_delay=connect_delay, handler=StandInHandler, jitter=jitter,
+               error_rate=error_rate, goes_seconds=scan_seconds, random=random.Random(seed),
+               tiles=_synthetic_tiles()) as (server, base):
+        rammb_slider.PARENT_URL = base + '/data'
+        nict_himawari.BASE_URL = base + '/himawari8'
+        try:
+            yield server, base
+        finally:
+            rammb_slider.PARENT_URL, nict_himawari.BASE_URL = parent_url, base_url
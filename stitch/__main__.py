@@ -0,0 +1,34 @@
+import argparse
+import sys
+
+from .batch import load_jobs, render_jobs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m stitch',
+                                     description='Render a batch of satellite images listed in a JSON job file.')
+    parser.add_argument('jobfile', help='path to the JSON job file')
+    parser.add_argument('--cache', help='tile cache directory shared by all renders (overrides the job file)')
+    parser.add_argument('--workers', type=int, help='number of render processes (overrides the job file)')
+    parser.add_argument('--budget', type=int, help='most upstream requests to make (overrides the job file)')
+    args = parser.parse_args(argv)
+
+    spec = load_jobs(args.jobfile)
+    results = render_jobs(spec['jobs'],
+                          cachedir=args.cache or spec.get('cache'),
+                          workers=args.workers or spec.get('workers'),
+                          budget=args.budget if args.budget is not None else spec.get('budget'))
+
+    failed = 0
+    for output, error in results:
+        if error is None:
+            print('rendered {}'.format(output))
+        else:
+            failed += 1
+            print('failed {}: {}'.format(output, error), file=sys.stderr)
+    print('{} of {} jobs rendered'.format(len(results) - failed, len(results)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
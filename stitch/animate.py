@@ -0,0 +1,208 @@
+import io
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from PIL import Image
+
+
+def save_animation(frames, path, duration=500, loop=0, fmt=None):
+    """
+    Write `frames` (PostProcessors or PIL images) to an animated GIF or APNG at `path`, one
+    frame at a time as the iterable produces them, so that only the frame being encoded is held
+    in memory. `duration` is the display time of each frame in milliseconds and `loop` the
+    number of times to play the animation (0 loops forever). The format is taken from the
+    file extension unless `fmt` ('gif' or 'apng') is given. Returns the number of frames written.
+    """
+    if fmt is None:
+        ext = os.path.splitext(path)[1].lower()
+        fmt = 'gif' if ext == '.gif' else 'apng' if ext in ('.png', '.apng') else None
+    if fmt == 'gif':
+        writer_cls = GifWriter
+    elif fmt == 'apng':
+        writer_cls = ApngWriter
+    else:
+        raise ValueError("Cannot determine animation format for: {}".format(path))
+
+    with open(path, 'wb') as fp:
+        writer = writer_cls(fp, duration=duration, loop=loop)
+        for frame in frames:
+            writer.append(_frame_image(frame))
+        writer.close()
+    return writer.frame_count
+
+
+def _frame_image(frame):
+    return frame if isinstance(frame, Image.Image) else frame.result()
+
+
+class GifWriter(object):
+    def __init__(self, fp, duration=500, loop=0):
+        self._fp = fp
+        self._duration = duration
+        self._loop = loop
+        self._size = None
+        self.frame_count = 0
+
+    def append(self, im):
+        if self._size is None:
+            self._size = im.size
+            self._write_header()
+        elif im.size != self._size:
+            raise ValueError("All frames of an animation must be the same size")
+
+        encoded = io.BytesIO()
+        im.convert('RGB').convert('P', palette=Image.ADAPTIVE).save(encoded, 'GIF')
+        color_table, descriptor, image_data = _split_gif(encoded.getvalue())
+
+        # graphic control extension: frame duration in hundredths of a second
+        self._fp.write(b'!\xf9\x04\x04' + struct.pack('<H', int(round(self._duration / 10))) + b'\x00\x00')
+        if color_table:
+            # move the frame's global palette into a local one
+            size_bits = (len(color_table) // 3).bit_length() - 2
+            descriptor = descriptor[:9] + bytes([0x80 | (descriptor[9] & 0x40) | size_bits])
+        self._fp.write(descriptor + color_table + image_data)
+        self.frame_count += 1
+
+    def close(self):
+        if self._size is not None:
+            self._fp.write(b';')
+
+    def _write_header(self):
+        width, height = self._size
+        self._fp.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0, 0, 0))
+        self._fp.write(b'!\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', self._loop) + b'\x00')
+
+
+def _split_gif(data):
+    # returns (global color table, image descriptor, LZW image data) of a single-frame GIF
+    packed = data[10]
+    pos = 13
+    color_table = b''
+    if packed & 0x80:
+        table_len = 3 * 2 ** ((packed & 0x07) + 1)
+        color_table = data[pos:pos + table_len]
+        pos += table_len
+
+    while data[pos:pos + 1] == b'!':
+        pos += 2
+        pos = _skip_sub_blocks(data, pos)
+
+    if data[pos:pos + 1] != b',':
+        raise ValueError("Unexpected GIF block")
+    descriptor = data[pos:pos + 10]
+    pos += 10
+    if descriptor[9] & 0x80:
+        # frame already carries a local color table
+        table_len = 3 * 2 ** ((descriptor[9] & 0x07) + 1)
+        color_table = data[pos:pos + table_len]
+        pos += table_len
+        descriptor = descriptor[:9] + bytes([descriptor[9] & 0x7f])
+    start = pos
+    pos = _skip_sub_blocks(data, pos + 1)
+    return color_table, descriptor, data[start:pos]
+
+
+def _skip_sub_blocks(data, pos):
+    while data[pos] != 0:
+        pos += data[pos] + 1
+    return pos + 1
+
+
+class ApngWriter(object):
+    _signature = b'\x89PNG\r\n\x1a\n'
+
+    def __init__(self, fp, duration=500, loop=0):
+        self._fp = fp
+        self._duration = duration
+        self._loop = loop
+        self._size = None
+        self._mode = None
+        self._actl_offset = None
+        self._sequence = 0
+        self.frame_count = 0
+
+    def append(self, im):
+        if self._size is None:
+            self._size = im.size
+            self._mode = 'RGBA' if 'A' in im.getbands() else 'RGB'
+        elif im.size != self._size:
+            raise ValueError("All frames of an animation must be the same size")
+
+        encoded = io.BytesIO()
+        im.convert(self._mode).save(encoded, 'PNG')
+        chunks = list(_png_chunks(encoded.getvalue()))
+        if self.frame_count == 0:
+            self._fp.write(self._signature)
+            self._write_chunk(b'IHDR', next(data for ctype, data in chunks if ctype == b'IHDR'))
+            self._actl_offset = self._fp.tell()
+            self._write_chunk(b'acTL', struct.pack('>II', 0, self._loop))
+
+        width, height = self._size
+        self._write_chunk(b'fcTL', struct.pack('>IIIIIHHBB', self._next_sequence(), width, height, 0, 0,
+                                               int(self._duration), 1000, 0, 0))
+        for ctype, data in chunks:
+            if ctype != b'IDAT':
+                continue
+            if self.frame_count == 0:
+                self._write_chunk(b'IDAT', data)
+            else:
+                self._write_chunk(b'fdAT', struct.pack('>I', self._next_sequence()) + data)
+        self.frame_count += 1
+
+    def close(self):
+        if self._size is None:
+            return
+        self._write_chunk(b'IEND', b'')
+        # the frame count is only known now that the stream has ended
+        end = self._fp.tell()
+        self._fp.seek(self._actl_offset)
+        self._write_chunk(b'acTL', struct.pack('>II', self.frame_count, self._loop))
+        self._fp.seek(end)
+
+    def _next_sequence(self):
+        sequence = self._sequence
+        self._sequence += 1
+        return sequence
+
+    def _write_chunk(self, ctype, data):
+        self._fp.write(struct.pack('>I', len(data)) + ctype + data +
+                       struct.pack('>I', zlib.crc32(ctype + data) & 0xffffffff))
+
+
+def _png_chunks(data):
+    pos = 8
+    while pos < len(data):
+        length, = struct.unpack('>I', data[pos:pos + 4])
+        yield data[pos + 4:pos + 8], data[pos + 8:pos + 8 + length]
+        pos += length + 12
+
+
+def frame_times(start, end, step):
+    """
+    Timestamps from `start` to `end` inclusive, `step` (a timedelta) apart.
+    """
+    if step <= timedelta(0):
+        raise ValueError("`step` must be a positive timedelta")
+    timestamp = start
+    while timestamp <= end:
+        yield timestamp
+        timestamp += step
+
+
+def render_frames(render, timestamps, concurrency=3):
+    """
+    Call `render(timestamp)` for each timestamp, keeping up to `concurrency` renders in flight
+    at once, and yield the results in timestamp order.
+    """
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='stitch-frame') as pool:
+        pending = deque()
+        for timestamp in timestamps:
+            pending.append(pool.submit(render, timestamp))
+            if len(pending) >= concurrency:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
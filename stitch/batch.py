@@ -0,0 +1,181 @@
+import json
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from PIL import ImageFilter
+
+from . import nict_himawari, rammb_slider
+from .cache import AvailabilityIndex, TileCache
+from .core import prefetch, get_tile_cache, set_tile_cache, get_availability_index, set_availability_index, \
+    StitchException
+from .fetch import TileFetcher, default_fetcher, set_default_fetcher
+
+# postprocessing steps a job may list, and the PostProcessor method each one calls
+_steps = ('crop', 'crop_relative', 'minimize', 'scale', 'timestamp_label', 'apply_filter', 'logo', 'colorbar')
+
+
+def load_jobs(path):
+    """
+    Read a job file: a JSON object with a list of `jobs` and, optionally, the `cache` directory
+    shared by all renders, the number of `workers` and the upstream request `budget`.
+
+    Each job names its `source` (`rammb_slider` or `nict_himawari`), the `sat` and `sector` for
+    RAMMB imagery, the `product`, the `timestamp` (as YYYY-mm-ddTHH:MM), the `zoom`, the tile
+    `rangex` and `rangey` as [start, stop) pairs, and optionally `crop`, `boundaries`, `latlon`,
+    `window`, a list of `postprocess` steps -- a PostProcessor method name, or a list of the name
+    and its arguments -- and the `output` path to save the image to.
+    """
+    with open(path) as f:
+        spec = json.load(f)
+    if 'jobs' not in spec:
+        raise ValueError("Job file must list `jobs`")
+    return spec
+
+
+def render_jobs(jobs, cachedir=None, workers=None, budget=None):
+    """
+    Render every job across a pool of `workers` processes, returning a list of (output, error)
+    pairs in job order, where `error` is None for jobs that rendered.
+
+    Before any render starts, the tiles of all jobs are downloaded once into the tile cache at
+    `cachedir` (a temporary directory if not given), so tiles shared by several jobs -- overlays
+    of the same region, or the same imagery cropped differently -- are only requested once.
+    No more than `budget` requests are made upstream over the whole run. Tiles found missing or
+    blank are recorded in an availability index next to the cache, and not requested again.
+    """
+    if cachedir is None:
+        with tempfile.TemporaryDirectory() as tmpd:
+            return render_jobs(jobs, tmpd, workers, budget)
+
+    # workers are spawned rather than forked, as the fetch and decode pools run threads
+    context = multiprocessing.get_context('spawn')
+    remaining = context.Value('l', -1 if budget is None else budget)
+    seconds_index = os.path.join(cachedir, 'scan_seconds.json')
+
+    previous = get_tile_cache(), default_fetcher(), rammb_slider._scan_seconds, get_availability_index()
+    _init_worker(cachedir, remaining, seconds_index)
+    try:
+        layers = []
+        for job in jobs:
+            try:
+                layers.extend(_job_layers(job).values())
+            except Exception:
+                # reported when the job itself is rendered
+                pass
+        try:
+            prefetch(layers)
+        except BudgetExhausted:
+            # the jobs render from what was fetched, and report the tiles that could not be
+            pass
+    finally:
+        default_fetcher().close()
+        set_tile_cache(previous[0])
+        set_default_fetcher(previous[1])
+        rammb_slider._scan_seconds = previous[2]
+        set_availability_index(previous[3])
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(cachedir, remaining, seconds_index)) as pool:
+        return list(pool.map(_render_job, jobs))
+
+
+def _init_worker(cachedir, remaining, seconds_index):
+    # nothing is evicted, so no prefetched tile is gone before the job reading it renders
+    set_tile_cache(TileCache(cachedir, max_bytes=None, ttl=None))
+    set_default_fetcher(_BudgetedFetcher(remaining))
+    rammb_slider.set_scan_seconds_index(seconds_index)
+    set_availability_index(AvailabilityIndex(os.path.join(cachedir, 'availability.json')))
+
+
+class BudgetExhausted(StitchException):
+    pass
+
+
+class _BudgetedFetcher(TileFetcher):
+    # draws every upstream request from a budget shared by all processes of a batch run; once it
+    # is spent, requests fail straight away instead of being scheduled, retried or counted as
+    # congestion
+    def __init__(self, remaining, **kwargs):
+        super(_BudgetedFetcher, self).__init__(**kwargs)
+        self._remaining = remaining
+
+    async def _request(self, method, url, headers):
+        with self._remaining.get_lock():
+            if self._remaining.value == 0:
+                raise BudgetExhausted("Upstream request budget exhausted")
+            if self._remaining.value > 0:
+                self._remaining.value -= 1
+        return await super(_BudgetedFetcher, self)._request(method, url, headers)
+
+
+def _render_job(job):
+    output = job.get('output')
+    try:
+        if output is None:
+            raise ValueError("Job has no `output` path")
+        steps = [_parse_step(step) for step in job.get('postprocess', ())]
+        img = _render(job)
+        img.lazy = True
+        for name, args, kwargs in steps:
+            getattr(img, name)(*args, **kwargs)
+        outdir = os.path.dirname(output)
+        if outdir:
+            os.makedirs(outdir, exist_ok=True)
+        img.save(output)
+        return output, None
+    except Exception as e:
+        return output, '{}: {}'.format(type(e).__name__, e)
+
+
+def _job_args(job):
+    timestamp = datetime.strptime(job['timestamp'], '%Y-%m-%dT%H:%M')
+    rangex, rangey = range(*job['rangex']), range(*job['rangey'])
+    crop = tuple(job['crop']) if job.get('crop') else None
+    return timestamp, job['zoom'], job['product'], rangex, rangey, crop
+
+
+def _job_layers(job):
+    timestamp, zoom, product, rangex, rangey, crop = _job_args(job)
+    source = job.get('source')
+    if source == 'rammb_slider':
+        return rammb_slider.tile_layers(job.get('sat', 'himawari'), timestamp, zoom, product, rangex, rangey,
+                                        job.get('sector', 'full_disk'), job.get('boundaries', True),
+                                        job.get('latlon', False), crop)
+    elif source == 'nict_himawari':
+        return nict_himawari.tile_layers(timestamp, zoom, product, rangex, rangey,
+                                         job.get('boundaries', True), crop)
+    raise ValueError("Unknown source: {}".format(source))
+
+
+def _render(job):
+    timestamp, zoom, product, rangex, rangey, crop = _job_args(job)
+    source = job.get('source')
+    if source == 'rammb_slider':
+        sat = job.get('sat', 'himawari')
+        if sat not in ('himawari', 'goes-16'):
+            raise ValueError("Unknown sat: {}".format(sat))
+        render = rammb_slider.himawari if sat == 'himawari' else rammb_slider.goes16
+        return render(timestamp, zoom, product, rangex, rangey, sector=job.get('sector', 'full_disk'),
+                      boundaries=job.get('boundaries', True), latlon=job.get('latlon', False), crop=crop,
+                      window=job.get('window'))
+    elif source == 'nict_himawari':
+        render = nict_himawari.vis if product.lower() == 'vis' else nict_himawari.ir
+        return render(timestamp, zoom, rangex, rangey, boundaries=job.get('boundaries', True), crop=crop,
+                      window=job.get('window'))
+    raise ValueError("Unknown source: {}".format(source))
+
+
+def _parse_step(step):
+    if isinstance(step, str):
+        name, args = step, []
+    else:
+        name, args = step[0], list(step[1:])
+    if name not in _steps:
+        raise ValueError("Unknown postprocess step: {}".format(name))
+    if name == 'apply_filter':
+        args = [getattr(ImageFilter, args[0])]
+    kwargs = args.pop() if args and isinstance(args[-1], dict) else {}
+    return name, args, kwargs
@@ -0,0 +1,108 @@
+import io
+import mmap
+import os
+import tempfile
+import threading
+
+
+class TileBuffer(object):
+    """
+    Holds tile payloads keyed by tile position: in memory until they add up to `max_bytes`, and
+    past that appended to an anonymous scratch file (in `dir`, or the default temp directory)
+    that is read back through a memory map.
+
+    `open(key)` returns a read-only file object over the payload itself -- the response bytes,
+    or a slice of the mapped scratch file -- so tiles are decoded without first copying each
+    payload into a separate buffer.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, dir=None):
+        self.max_bytes = max_bytes
+        self.dir = dir
+        self.memory_bytes = 0
+        self.spilled_bytes = 0
+        self._memory = {}
+        self._spilled = {}
+        self._scratch = None
+        self._map = None
+        self._lock = threading.Lock()
+
+    def add(self, key, content):
+        with self._lock:
+            if self.memory_bytes + len(content) <= self.max_bytes:
+                self._memory[key] = content
+                self.memory_bytes += len(content)
+                return
+            if self._scratch is None:
+                self._scratch = tempfile.TemporaryFile(dir=self.dir)
+            offset = self._scratch.seek(0, os.SEEK_END)
+            self._scratch.write(content)
+            self._spilled[key] = (offset, len(content))
+            self.spilled_bytes += len(content)
+            # mapped again on the next read, to cover the new payload
+            self._map = None
+
+    def keys(self):
+        with self._lock:
+            return list(self._memory.keys()) + list(self._spilled.keys())
+
+    def __len__(self):
+        return len(self._memory) + len(self._spilled)
+
+    def __contains__(self, key):
+        return key in self._memory or key in self._spilled
+
+    def view(self, key):
+        with self._lock:
+            if key in self._memory:
+                return memoryview(self._memory[key])
+            offset, length = self._spilled[key]
+            if self._map is None:
+                self._scratch.flush()
+                self._map = mmap.mmap(self._scratch.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(self._map)[offset:offset + length]
+
+    def open(self, key):
+        return _ViewReader(self.view(key))
+
+    def close(self):
+        # views already handed out keep their mapping alive until they are released
+        with self._lock:
+            self._memory.clear()
+            self._spilled.clear()
+            self._map = None
+            if self._scratch is not None:
+                self._scratch.close()
+                self._scratch = None
+
+
+class _ViewReader(io.RawIOBase):
+    def __init__(self, view):
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self._view) - self._pos))
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = len(self._view) + offset
+        else:
+            raise ValueError("Invalid whence: {}".format(whence))
+        return self._pos
+
+    def tell(self):
+        return self._pos
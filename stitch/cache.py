@@ -0,0 +1,321 @@
+import base64
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class TileCache(object):
+    """
+    On-disk tile cache keyed by URL, content-addressed, with LRU eviction past `max_bytes`.
+    Tiles stored with `static=True` never expire; others expire after `ttl` seconds.
+    """
+
+    _index_filename = 'index.sqlite'
+
+    def __init__(self, cachedir, max_bytes=512 * 1024 * 1024, ttl=24 * 3600):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._conn = None
+        self._pid = None
+        os.makedirs(os.path.join(cachedir, 'blobs'), exist_ok=True)
+
+    def get(self, url):
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute('SELECT digest, stored, static FROM tiles WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                return None
+            digest, stored, static = row
+            if not static and self._expired(stored):
+                self._delete_urls(conn, [url])
+                return None
+            try:
+                with open(self._blob_path(digest), 'rb') as f:
+                    content = f.read()
+            except (IOError, OSError):
+                self._delete_urls(conn, [url])
+                return None
+            with conn:
+                conn.execute('UPDATE tiles SET accessed = ? WHERE url = ?', (time.time(), url))
+            return content
+
+    def put(self, url, content, static=False):
+        digest = hashlib.sha1(content).hexdigest()
+        blob = self._blob_path(digest)
+        with self._lock:
+            if not os.path.exists(blob):
+                tmp = '{}.{}.tmp'.format(blob, os.getpid())
+                with open(tmp, 'wb') as f:
+                    f.write(content)
+                os.replace(tmp, blob)
+            now = time.time()
+            conn = self._connection()
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO tiles (url, digest, size, stored, accessed, static) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', (url, digest, len(content), now, now, int(static)))
+            self._evict(conn)
+
+    def __contains__(self, url):
+        return self.get(url) is not None
+
+    @property
+    def size(self):
+        with self._lock:
+            return self._stored_bytes(self._connection())
+
+    def clear(self):
+        with self._lock:
+            conn = self._connection()
+            urls = [row[0] for row in conn.execute('SELECT url FROM tiles')]
+            self._delete_urls(conn, urls)
+
+    def _expired(self, stored):
+        return self.ttl is not None and time.time() - stored > self.ttl
+
+    def _blob_path(self, digest):
+        return os.path.join(self.cachedir, 'blobs', digest)
+
+    def _connection(self):
+        # sqlite connections must not be shared across a fork
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(os.path.join(self.cachedir, self._index_filename),
+                                   timeout=30, check_same_thread=False)
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS tiles (url TEXT PRIMARY KEY, digest TEXT, '
+                             'size INTEGER, stored REAL, accessed REAL, static INTEGER)')
+                conn.execute('CREATE INDEX IF NOT EXISTS tiles_digest ON tiles (digest)')
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def _stored_bytes(self, conn):
+        row = conn.execute('SELECT SUM(size) FROM (SELECT MAX(size) AS size FROM tiles GROUP BY digest)').fetchone()
+        return row[0] or 0
+
+    def _evict(self, conn):
+        if self.max_bytes is None:
+            return
+        total = self._stored_bytes(conn)
+        if total <= self.max_bytes:
+            return
+        # a payload is only freed once every URL pointing at it is gone, so evict whole payloads
+        evicted = []
+        for digest, size in conn.execute('SELECT digest, MAX(size) FROM tiles GROUP BY digest '
+                                         'ORDER BY MAX(accessed) ASC').fetchall():
+            if total <= self.max_bytes:
+                break
+            evicted.extend(row[0] for row in conn.execute('SELECT url FROM tiles WHERE digest = ?', (digest,)))
+            total -= size
+        self._delete_urls(conn, evicted)
+
+    def _delete_urls(self, conn, urls):
+        if not urls:
+            return
+        with conn:
+            digests = set()
+            for url in urls:
+                row = conn.execute('SELECT digest FROM tiles WHERE url = ?', (url,)).fetchone()
+                if row is not None:
+                    digests.add(row[0])
+                conn.execute('DELETE FROM tiles WHERE url = ?', (url,))
+        for digest in digests:
+            still_used = conn.execute('SELECT 1 FROM tiles WHERE digest = ? LIMIT 1', (digest,)).fetchone()
+            if still_used is None:
+                try:
+                    os.remove(self._blob_path(digest))
+                except OSError:
+                    pass
+
+
+class AvailabilityIndex(object):
+    """
+    Tiles known to be missing (by URL) or blank (by grid position), persisted to `path` on `flush()`.
+    """
+
+    def __init__(self, path=None, ttl=3600, confirmations=2, blank_ttl=24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self.confirmations = confirmations
+        self.blank_ttl = blank_ttl
+        self._missing = {}
+        self._grids = {}
+        self._payloads = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self._missing = saved['missing']
+            self._grids = saved['grids']
+            self._payloads = {digest: base64.b64decode(payload) for digest, payload in saved['payloads'].items()}
+
+    def missing(self, url):
+        with self._lock:
+            return self._missing.get(url, 0) > time.time()
+
+    def blank(self, grid, x, y):
+        # the payload to synthesize the tile from, if it is known to be blank
+        entry = self._entry(grid, x, y)
+        if not self._confirmed(entry):
+            return None
+        return self._payloads.get(entry['digest'])
+
+    def needs_check(self, grid, x, y):
+        entry = self._entry(grid, x, y)
+        return entry is None or 'present' not in entry and not self._confirmed(entry)
+
+    def record_missing(self, url):
+        with self._lock:
+            self._missing[url] = time.time() + self.ttl
+            self._dirty = True
+
+    def record_content(self, grid, x, y, content, blank):
+        if not blank:
+            self._update(grid, x, y, {'present': True})
+            return
+        digest = hashlib.sha1(content).hexdigest()
+        with self._lock:
+            self._payloads.setdefault(digest, content)
+        entry = self._entry(grid, x, y) or {}
+        live = entry.get('digest') == digest and entry.get('expires', 0) > time.time()
+        self._update(grid, x, y, {'blank': entry.get('blank', 0) + 1 if live else 1, 'digest': digest,
+                                  'expires': time.time() + self.blank_ttl})
+
+    def flush(self):
+        # writes the index out if it changed; called once per render rather than per tile
+        with self._lock:
+            if self.path is None or not self._dirty:
+                return
+            update_json(self.path, self._merged)
+            self._dirty = False
+
+    def clear(self):
+        with self._lock:
+            self._missing.clear()
+            self._grids.clear()
+            self._payloads.clear()
+            if self.path is not None:
+                update_json(self.path, lambda saved: self._serialized())
+
+    def _confirmed(self, entry):
+        return (entry is not None and entry.get('blank', 0) >= self.confirmations and
+                entry.get('expires', 0) > time.time())
+
+    def _entry(self, grid, x, y):
+        with self._lock:
+            return self._grids.get(self._grid_key(grid), {}).get(self._tile_key(x, y))
+
+    def _update(self, grid, x, y, entry):
+        with self._lock:
+            self._grids.setdefault(self._grid_key(grid), {})[self._tile_key(x, y)] = entry
+            self._dirty = True
+
+    def _grid_key(self, grid):
+        return '/'.join(str(part) for part in grid)
+
+    def _tile_key(self, x, y):
+        return '{}_{}'.format(x, y)
+
+    def _merged(self, saved):
+        # entries other processes sharing the file saved meanwhile are kept; ours are newer
+        if saved is not None:
+            for url, expires in saved['missing'].items():
+                self._missing[url] = max(expires, self._missing.get(url, 0))
+            for key, tiles in saved['grids'].items():
+                self._grids[key] = dict(tiles, **self._grids.get(key, {}))
+            for digest, payload in saved['payloads'].items():
+                self._payloads.setdefault(digest, base64.b64decode(payload))
+        return self._serialized()
+
+    def _serialized(self):
+        now = time.time()
+        self._missing = {url: expires for url, expires in self._missing.items() if expires > now}
+        digests = {entry['digest'] for tiles in self._grids.values() for entry in tiles.values() if 'digest' in entry}
+        self._payloads = {digest: payload for digest, payload in self._payloads.items() if digest in digests}
+        return {'missing': self._missing, 'grids': self._grids,
+                'payloads': {digest: base64.b64encode(payload).decode('ascii')
+                             for digest, payload in self._payloads.items()}}
+
+
+def update_json(path, merge):
+    """
+    Rewrite the JSON file at `path`, which other processes may share, with `merge(saved)` -- where
+    `saved` is its current contents, or None -- under an exclusive lock where fcntl is available.
+    """
+    with open(path + '.lock', 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        saved = None
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(merge(saved), f)
+        os.replace(tmp, path)
+
+
+class MemoryCache(object):
+    """
+    In-process LRU cache bounded by the total size of its values. The caller supplies each
+    value's size when storing it; values larger than `max_bytes` are not stored at all.
+    Meant for static layers, which can be reused by every render over the same region.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, nbytes = self._entries.pop(key)
+            except KeyError:
+                return None
+            self._entries[key] = value, nbytes
+            return value
+
+    def put(self, key, value, nbytes):
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = value, nbytes
+            self._size += nbytes
+            while self._size > self.max_bytes:
+                _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                self._size -= evicted_nbytes
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return self._size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+def image_nbytes(im):
+    return im.width * im.height * len(im.getbands())
@@ -0,0 +1,122 @@
+import asyncio
+import bisect
+import threading
+import time
+from datetime import datetime, timedelta
+
+from .core import StitchException
+from .fetch import run_sync
+
+
+class ScanCatalogue(object):
+    """
+    The known scan times of one imagery stream, found by probing a slot every `step`.
+    """
+
+    def __init__(self, probe, step, offset=timedelta(0), ttl=60, settle=timedelta(hours=1), batch=4,
+                 name='scan'):
+        self.probe = probe
+        self.step = step
+        self.offset = offset
+        self.ttl = ttl
+        self.settle = settle
+        self.batch = batch
+        self.name = name
+        self._times = []
+        self._probed = {}
+        self._lock = threading.Lock()
+
+    def nearest(self, timestamp, within=timedelta(hours=1)):
+        return run_sync(self.nearest_async(timestamp, within))
+
+    async def nearest_async(self, timestamp, within=timedelta(hours=1)):
+        """
+        The known scan closest to `timestamp` and no more than `within` away from it, or None.
+        """
+        slots = sorted(self._slots(timestamp - within, timestamp + within),
+                       key=lambda slot: (abs(slot - timestamp), slot))
+        while True:
+            best = self._closest(timestamp, within)
+            # a slot as close as the best scan found so far may still hold a closer one
+            unprobed = [slot for slot in slots if not self._probed_recently(slot) and
+                        (best is None or abs(slot - timestamp) <= abs(best - timestamp))]
+            if not unprobed:
+                return best
+            await self._probe_all(unprobed[:self.batch])
+
+    def snap(self, timestamp, within):
+        """
+        The known scan closest to `timestamp`, raising a StitchException if none is within `within` of it.
+        """
+        scan = self.nearest(timestamp, within)
+        if scan is None:
+            raise StitchException("No {} within {} of {}".format(self.name, within, timestamp))
+        return scan
+
+    def latest(self, within=timedelta(hours=2), now=None):
+        return run_sync(self.latest_async(within, now))
+
+    async def latest_async(self, within=timedelta(hours=2), now=None):
+        """
+        The most recent scan no older than `within`, or None.
+        """
+        now = datetime.utcnow() if now is None else now
+        slots = sorted(self._slots(now - within, now), reverse=True)
+        while True:
+            with self._lock:
+                i = bisect.bisect_right(self._times, now)
+                best = self._times[i - 1] if i and self._times[i - 1] >= now - within else None
+            unprobed = [slot for slot in slots if not self._probed_recently(slot) and
+                        (best is None or slot > best)]
+            if not unprobed:
+                return best
+            await self._probe_all(unprobed[:self.batch])
+
+    def range(self, start, end):
+        return run_sync(self.range_async(start, end))
+
+    async def range_async(self, start, end):
+        """
+        Every scan from `start` to `end`, inclusive, in time order.
+        """
+        slots = [slot for slot in self._slots(start - self.step, end) if not self._probed_recently(slot)]
+        for i in range(0, len(slots), self.batch):
+            await self._probe_all(slots[i:i + self.batch])
+        with self._lock:
+            return self._times[bisect.bisect_left(self._times, start):bisect.bisect_right(self._times, end)]
+
+    def clear(self):
+        with self._lock:
+            self._times = []
+            self._probed.clear()
+
+    def _closest(self, timestamp, within):
+        with self._lock:
+            i = bisect.bisect_left(self._times, timestamp)
+            candidates = [t for t in self._times[max(0, i - 1):i + 1] if abs(t - timestamp) <= within]
+        return min(candidates, key=lambda t: (abs(t - timestamp), t)) if candidates else None
+
+    def _slots(self, start, end):
+        # every nominal slot from `start` to `end`, anchored at midnight of `start`'s day
+        anchor = start.replace(hour=0, minute=0, second=0, microsecond=0) + self.offset
+        slot = anchor + self.step * max(0, -(-(start - anchor) // self.step))
+        slots = []
+        while slot <= end:
+            slots.append(slot)
+            slot += self.step
+        return slots
+
+    def _probed_recently(self, slot):
+        with self._lock:
+            entry = self._probed.get(slot)
+        return entry is not None and (entry[1] is None or entry[1] > time.time())
+
+    async def _probe_all(self, slots):
+        found = await asyncio.gather(*(self.probe(slot) for slot in slots))
+        now = time.time()
+        with self._lock:
+            for slot, scan in zip(slots, found):
+                settled = scan is not None or datetime.utcnow() - slot > self.settle
+                self._probed[slot] = (scan, None if settled else now + self.ttl)
+                if scan is not None and scan not in self._times:
+                    bisect.insort(self._times, scan)
@@ -1,71 +1,501 @@
 from __future__ import division
 
+import asyncio
+import functools
 import io
+import math
 import os
 import random
-import shutil
 import string
-import tempfile
+import threading
+import time
 import warnings
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
-import grequests
+import numpy as np
 from PIL import Image
 
+from . import trace
+from .buffer import TileBuffer
+from .fetch import default_fetcher, run_sync, RetryPolicy
 
-def stitch(pos_urls, mode, tempfiles=False):
+
+_tile_cache = None
+
+
+def set_tile_cache(cache):
+    """
+    Install a process-wide tile cache used by `load_tiles`, `save_tiles` and `stitch`. The cache
+    is any object with `get(url)` returning the payload bytes (or None on a miss) and
+    `put(url, content, static=False)`, e.g. `stitch.cache.TileCache`. Pass None to disable caching.
+    """
+    global _tile_cache
+    _tile_cache = cache
+
+
+def get_tile_cache():
+    return _tile_cache
+
+
+# payload bytes a buffered stitch holds in memory before spilling the rest to a scratch file
+_buffer_max_bytes = 64 * 1024 * 1024
+
+
+def set_tile_buffer_budget(max_bytes):
+    """
+    Set how many bytes of tile payloads `stitch(tempfiles=True)` and `load_tiles` keep in memory;
+    payloads past the budget are spilled to a memory-mapped scratch file (0 spills every tile).
+    """
+    global _buffer_max_bytes
+    _buffer_max_bytes = max_bytes
+
+
+_availability = None
+
+
+def set_availability_index(index):
+    """
+    Install a process-wide `stitch.cache.AvailabilityIndex` consulted for the tiles of layers
+    that name their tile grid (see `Layer`); None disables it.
+    """
+    global _availability
+    _availability = index
+
+
+def get_availability_index():
+    return _availability
+
+
+_retry_policy = RetryPolicy()
+
+
+def set_retry_policy(policy):
+    """
+    Set the `stitch.fetch.RetryPolicy` for tile requests; None disables retries altogether.
+    """
+    global _retry_policy
+    _retry_policy = policy
+
+
+def _new_render_state():
+    return _retry_policy.new_render() if _retry_policy is not None else None
+
+
+def stitch(pos_urls, mode, tempfiles=False, static=False, window=None, rate=None):
+    if window is None:
+        _check_tile_count(pos_urls)
+
+    with trace.span('stitch', tiles=len(pos_urls), mode=mode):
+        if tempfiles:
+            return run_sync(_stitch_buffered(pos_urls, mode, static, window, rate))
+        else:
+            return run_sync(_stitch_streaming(pos_urls, mode, static, window, rate))
+
+
+async def stitch_async(pos_urls, mode, tempfiles=False, static=False, window=None, rate=None):
+    if window is None:
+        _check_tile_count(pos_urls)
+
+    with trace.span('stitch', tiles=len(pos_urls), mode=mode):
+        if tempfiles:
+            return await _stitch_buffered(pos_urls, mode, static, window, rate)
+        else:
+            return await _stitch_streaming(pos_urls, mode, static, window, rate)
+
+
+# `grid` keys the layer's tiles in the availability index; with `learn_blanks`, blank tiles it
+# fetches are taken to be blank in every layer of the grid (not so for e.g. visible imagery,
+# which is black on the night side)
+Layer = namedtuple('Layer', ['pos_urls', 'mode', 'static', 'grid', 'learn_blanks'])
+Layer.__new__.__defaults__ = (False, None, False)
+
+# most tile requests in flight at once across all layers of a render
+_request_budget = 40
+
+
+def stitch_layers(layers, window=None, rate=None):
+    return run_sync(stitch_layers_async(layers, window=window, rate=rate))
+
+
+async def stitch_layers_async(layers, window=None, rate=None):
+    """
+    Stitch several layers of the same render (e.g. imagery plus its map and lat/lon overlays)
+    in a single fetch phase. `layers` maps a name to a `Layer`; every layer's tile requests are
+    submitted at once, sharing one budget of in-flight requests, and the stitched images are
+    returned under the same names.
+    """
+    if window is None:
+        for layer in layers.values():
+            _check_tile_count(layer.pos_urls)
+
+    budget = asyncio.Semaphore(_request_budget)
+    render_state = _new_render_state()
+    names = list(layers.keys())
+    with trace.span('stitch_layers', layers=names,
+                    tiles=sum(len(layer.pos_urls) for layer in layers.values())) as stage:
+        try:
+            imgs = await asyncio.gather(*(_stitch_streaming(layers[name].pos_urls, layers[name].mode,
+                                                            layers[name].static, window, rate,
+                                                            budget=budget, render_state=render_state,
+                                                            grid=layers[name].grid,
+                                                            learn_blanks=layers[name].learn_blanks)
+                                          for name in names))
+        finally:
+            await _flush_availability()
+        if render_state is not None:
+            stage.set(retries=render_state.retries, hedges=render_state.hedges)
+    return dict(zip(names, imgs))
+
+
+async def _flush_availability():
+    if _availability is not None:
+        await asyncio.get_running_loop().run_in_executor(None, _availability.flush)
+
+
+def prefetch(layers, window=None):
+    return run_sync(prefetch_async(layers, window=window))
+
+
+async def prefetch_async(layers, window=None):
+    """
+    Download the tiles of every `Layer` in `layers` into the tile cache without stitching them.
+    Each URL is requested once however many layers list it, with at most `window` requests (by
+    default, as many as a render) in flight at a time. Returns the number of tiles fetched or
+    already cached.
+    """
+    if _tile_cache is None:
+        raise StitchException("Prefetching tiles requires a tile cache, see `set_tile_cache`")
+
+    # every url is fetched once, for the first layer it appears in
+    seen = set()
+    unique = []
+    for layer in layers:
+        pos_urls = {pos: url for pos, url in layer.pos_urls.items() if url not in seen}
+        seen.update(pos_urls.values())
+        if pos_urls:
+            unique.append(layer._replace(pos_urls=pos_urls))
+
+    budget = asyncio.Semaphore(window or _request_budget)
+    render_state = _new_render_state()
+
+    async def fetch_layer(layer):
+        tiles = _load_tile_inner(layer.pos_urls, _discard, static=layer.static, budget=budget,
+                                 render_state=render_state, grid=layer.grid, learn_blanks=layer.learn_blanks)
+        return len([tile async for tile in tiles])
+
+    try:
+        return sum(await asyncio.gather(*(fetch_layer(layer) for layer in unique)))
+    finally:
+        await _flush_availability()
+
+
+def _discard(content, x, y):
+    return None
+
+
+def _check_tile_count(pos_urls):
     # don't overwhelm the server with requests
     if len(pos_urls) > 40:
         raise StitchException("At this time, cannot stitch more than 40 tiles together. "
                               "Please reduce the number of tiles in your request. The easiest "
                               "way to achieve this for a given satellite area is by reducing "
-                              "your zoom level.")
+                              "your zoom level, or pass `window=` to fetch the tiles in "
+                              "bounded batches.")
+
+
+async def _stitch_streaming(pos_urls, mode, static, window=None, rate=None, budget=None,
+                            render_state=None, grid=None, learn_blanks=False):
+    # Tiles are decoded as soon as their response arrives and pasted straight into the canvas.
+    # With a `window`, at most that many tiles are fetched at a time (and at most `rate` tiles
+    # per second), so only the canvas and a single batch of tiles are ever held in memory.
+    if render_state is None:
+        render_state = _new_render_state()
+    if not pos_urls:
+        raise StitchException("Empty tiles")
+
+    minx = min(pos[0] for pos in pos_urls.keys())
+    miny = min(pos[1] for pos in pos_urls.keys())
+    cols = max(pos[0] for pos in pos_urls.keys()) - minx + 1
+    rows = max(pos[1] for pos in pos_urls.keys()) - miny + 1
+
+    # allocated from the first tile's size, then each tile is written into it as it decodes
+    tiles = None
+    async for x, y, tile in _windowed(pos_urls, _open_tile, window, rate, static=static, budget=budget,
+                                      render_state=render_state, grid=grid, learn_blanks=learn_blanks):
+        if tiles is None:
+            tiles = TileArray(rows, cols, tile.width, tile.height, _buffer_mode(mode))
+        tiles[y - miny, x - minx] = tile
+
+    if tiles is None:
+        raise StitchException("Empty tiles")
+    img = tiles.trimmed().merge(mode)
+    # missing edge tiles are trimmed off; where the image sits in the grid, for `TileCrop.box`
+    img.info['tiles'] = tiles.extent()
+    return img
+
+
+async def _windowed(pos_urls, process_response, window=None, rate=None, **kwargs):
+    # `_load_tile_inner` over batches of at most `window` tiles, fetching at most `rate` tiles per second
+    if window is None:
+        window = max(1, len(pos_urls))
+    elif window < 1:
+        raise ValueError("`window` must be a positive number of tiles")
+
+    items = list(pos_urls.items())
+    for start in range(0, len(items), window):
+        batch = dict(items[start:start + window])
+        started = time.monotonic()
+        async for tile in _load_tile_inner(batch, process_response, **kwargs):
+            yield tile
+        if rate and start + window < len(items):
+            await asyncio.sleep(max(0.0, len(batch) / rate - (time.monotonic() - started)))
+
+
+async def _stitch_rows(pos_urls, mode, static=False):
+    # Yields each row of the grid, top to bottom, as a one-row TileArray -- None for a row
+    # without any tile -- fetching the next row while the caller works on the current one.
+    minx = min(pos[0] for pos in pos_urls.keys())
+    cols = max(pos[0] for pos in pos_urls.keys()) - minx + 1
+    ys = range(min(pos[1] for pos in pos_urls.keys()), max(pos[1] for pos in pos_urls.keys()) + 1)
+    render_state = _new_render_state()
+
+    async def fetch_row(y):
+        row_urls = {pos: url for pos, url in pos_urls.items() if pos[1] == y}
+        _check_tile_count(row_urls)
+        row = None
+        async for x, _, tile in _load_tile_inner(row_urls, _open_tile, static=static,
+                                                 render_state=render_state):
+            if row is None:
+                row = TileArray(1, cols, tile.width, tile.height, _buffer_mode(mode))
+            row[0, x - minx] = tile
+        return row
+
+    upcoming = asyncio.ensure_future(fetch_row(ys[0]))
+    try:
+        for i in range(len(ys)):
+            row = await upcoming
+            if i + 1 < len(ys):
+                upcoming = asyncio.ensure_future(fetch_row(ys[i + 1]))
+            yield row
+    finally:
+        upcoming.cancel()
+
+
+async def _stitch_buffered(pos_urls, mode, static, window=None, rate=None):
+    # All payloads are received before any tile is decoded. They stay in memory up to the
+    # buffer budget and spill to a mapped scratch file past it, and are decoded straight from there.
+    buffer = TileBuffer(_buffer_max_bytes)
+    try:
+        async for _ in _windowed(pos_urls, _buffering(buffer), window, rate, static=static):
+            pass
+        trace.event('buffer', memory_bytes=buffer.memory_bytes, spilled_bytes=buffer.spilled_bytes)
+        if not len(buffer):
+            raise StitchException("Empty tiles")
+        return _merge_tiles({pos: buffer.open(pos) for pos in buffer.keys()}, mode)
+    finally:
+        buffer.close()
+
+
+def _buffering(buffer):
+    def add(content, x, y):
+        buffer.add((x, y), content)
+    return add
 
-    if tempfiles:
-        with tempfile.TemporaryDirectory() as tmpd:
-            tilelocs = save_tiles(pos_urls, tmpd)
-            tileimgs = {(x, y): Image.open(tileloc) for ((x, y), tileloc) in tilelocs.items()}
-            return TileArray.fromtiles(tileimgs).merge(mode)
-    else:
-        tilebufs = load_tiles(pos_urls)
-        tileimgs = {(x, y): Image.open(buf) for ((x, y), buf) in tilebufs.items()}
-        return TileArray.fromtiles(tileimgs).merge(mode)
 
+def _open_tile(content, x, y):
+    tile = Image.open(io.BytesIO(content))
+    tile.load()
+    return tile
 
-def load_tiles(pos_url_map):
-    return _load_tile_inner(pos_url_map,
-                            lambda resp, x, y: io.BytesIO(resp.content))
 
+def _merge_tiles(tilesrcs, mode):
+    tileimgs = {(x, y): Image.open(src) for ((x, y), src) in tilesrcs.items()}
+    return TileArray.fromtiles(tileimgs, _buffer_mode(mode)).merge(mode)
 
-def save_tiles(pos_url_map, savedir):
 
-    def savetodisk(resp, x, y):
+def _buffer_mode(mode):
+    return mode if mode in _buffer_modes else 'RGBA'
+
+
+def load_tiles(pos_url_map, static=False):
+    return run_sync(load_tiles_async(pos_url_map, static=static))
+
+
+async def load_tiles_async(pos_url_map, static=False):
+    # the returned file objects read straight from the buffer, in memory or spilled to disk
+    buffer = TileBuffer(_buffer_max_bytes)
+    try:
+        async for _ in _load_tile_inner(pos_url_map, _buffering(buffer), static=static):
+            pass
+        return {pos: buffer.open(pos) for pos in buffer.keys()}
+    finally:
+        buffer.close()
+
+
+def save_tiles(pos_url_map, savedir, static=False):
+    return run_sync(save_tiles_async(pos_url_map, savedir, static=static))
+
+
+async def save_tiles_async(pos_url_map, savedir, static=False):
+
+    def savetodisk(content, x, y):
         filename = '{x}_{y}_{etc}.png'.format(x=x, y=y, etc=_randomstr(10))
         savedtile_loc = os.sep.join([savedir, filename])
         with open(savedtile_loc, 'wb') as f:
-            resp.raw.decode_content = True
-            shutil.copyfileobj(resp.raw, f)
+            f.write(content)
         return savedtile_loc
 
-    return _load_tile_inner(pos_url_map, savetodisk)
-
-
-def _load_tile_inner(pos_url_map, process_response):
-    pos_lookup = {v: k for k, v in pos_url_map.items()}
-    reqs = (grequests.get(url) for url in pos_lookup.keys())
-    resps = grequests.map(reqs, stream=True, size=10)
-    tiles = dict()
-    for resp in resps:
-        if resp is None:
-            warnings.warn('Got a NULL response for a tile, this image might not stitch correctly')
-        else:
-            x, y = pos_lookup[resp.url]
-            if resp.status_code == 200:
-                tiles[x, y] = process_response(resp, x, y)
+    return {(x, y): loc async for x, y, loc in _load_tile_inner(pos_url_map, savetodisk, static=static)}
+
+
+_decode_pool = None
+_decode_pool_lock = threading.Lock()
+_cache_pool = None
+
+
+def _decoder():
+    # PIL releases the GIL while decoding, so tiles decode in parallel with each other and
+    # with the network I/O still in flight
+    global _decode_pool
+    with _decode_pool_lock:
+        if _decode_pool is None:
+            _decode_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 4,
+                                              thread_name_prefix='stitch-decode')
+        return _decode_pool
+
+
+def _cache_io():
+    # the tile cache reads and writes files and sqlite, which must not block the event loop
+    global _cache_pool
+    with _decode_pool_lock:
+        if _cache_pool is None:
+            _cache_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='stitch-cache')
+        return _cache_pool
+
+
+async def _load_tile_inner(pos_url_map, process_response, static=False, budget=None, render_state=None,
+                           validators=None, grid=None, learn_blanks=False):
+    # Yields (x, y, processed tile) in completion order; `process_response` runs on the
+    # decode pool as soon as each tile's payload is available. With `validators`, a dict of
+    # url -> (ETag, Last-Modified), tiles fetched before are requested conditionally and the
+    # validators of every tile fetched are recorded; a tile that has not changed since yields
+    # (x, y, None) without being processed. With `grid`, tiles the availability index knows to
+    # be missing are skipped and tiles it knows to be blank are synthesized without a request;
+    # the index is only written out by `_flush_availability`, once per render.
+    cache = _tile_cache
+    index = _availability if grid is not None else None
+    fetcher = default_fetcher()
+    retry = _retry_policy
+    if retry is not None and render_state is None:
+        render_state = retry.new_render()
+    loop = asyncio.get_running_loop()
+
+    async def fetch_one(pos, url):
+        x, y = pos
+        tracing = trace.enabled()
+        started = time.perf_counter() if tracing else None
+        if index is not None:
+            if index.missing(url):
+                if tracing:
+                    trace.event('tile', url=url, x=x, y=y, cached=False, bytes=0, status=404, latency=None,
+                                known=True)
+                return None
+            content = index.blank(grid, x, y)
+            if content is not None:
+                return await process(url, x, y, content, True, started)
+
+        conditional = validators is not None and url in validators
+        content = None
+        if cache is not None and not conditional:
+            content = await loop.run_in_executor(_cache_io(), cache.get, url)
+        cached = content is not None
+        if content is None:
+            headers = _conditional_headers(*validators[url]) if conditional else None
+            if budget is None:
+                resp = await fetcher.fetch(url, headers=headers, retry=retry, state=render_state)
             else:
+                async with budget:
+                    resp = await fetcher.fetch(url, headers=headers, retry=retry, state=render_state)
+            if conditional and resp is not None and resp.status_code == 304:
+                if tracing:
+                    trace.event('tile', url=url, x=x, y=y, cached=False, bytes=0, status=304,
+                                latency=time.perf_counter() - started)
+                return x, y, None
+            if index is not None and resp is not None and resp.status_code in (404, 410):
+                index.record_missing(url)
+            if resp is None or resp.status_code != 200:
+                if tracing:
+                    trace.event('tile', url=url, x=x, y=y, cached=False, bytes=0,
+                                status=None if resp is None else resp.status_code,
+                                latency=time.perf_counter() - started)
+            if resp is None:
+                warnings.warn('Got a NULL response for a tile, this image might not stitch correctly')
+                return None
+            if resp.status_code != 200:
                 warnings.warn('Got status code: {} instead of 200 while attempting to fetch tile at '
                               'position: ({},{}), this image might not '
                               'stitch correctly'.format(resp.status_code, x, y))
-    return tiles
+                return None
+            content = resp.content
+            if cache is not None:
+                await loop.run_in_executor(_cache_io(), functools.partial(cache.put, url, content, static=static))
+            if validators is not None:
+                validator = resp.headers.get('ETag'), resp.headers.get('Last-Modified')
+                if any(validator):
+                    validators[url] = validator
+        if index is not None and learn_blanks and index.needs_check(grid, x, y):
+            blank = await loop.run_in_executor(_decoder(), _is_blank, content)
+            index.record_content(grid, x, y, content, blank)
+        return await process(url, x, y, content, cached, started)
+
+    async def process(url, x, y, content, cached, started):
+        if started is None:
+            return x, y, await loop.run_in_executor(_decoder(), process_response, content, x, y)
+
+        latency = time.perf_counter() - started
+        processed, decode = await loop.run_in_executor(_decoder(), _timed, process_response, content, x, y)
+        trace.event('tile', url=url, x=x, y=y, cached=cached, bytes=len(content), status=200,
+                    latency=None if cached else latency, decode=decode)
+        return x, y, processed
+
+    tasks = [asyncio.ensure_future(fetch_one(pos, url)) for pos, url in pos_url_map.items()]
+    try:
+        for done in asyncio.as_completed(tasks):
+            result = await done
+            if result is not None:
+                yield result
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _is_blank(content):
+    # uniformly black, or fully transparent
+    tile = Image.open(io.BytesIO(content))
+    if tile.mode == 'P':
+        tile = tile.convert('RGBA')
+    extrema = tile.getextrema()
+    if len(tile.getbands()) == 1:
+        extrema = (extrema,)
+    if 'A' in tile.getbands() and extrema[tile.getbands().index('A')][1] == 0:
+        return True
+    return all(high == 0 for _, high in extrema)
+
+
+def _conditional_headers(etag, last_modified):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+def _timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
 
 
 def _randomstr(size):
@@ -77,8 +507,16 @@ class StitchException(Exception):
 
 
 class TileArray(object):
+    """
+    Grid of equally-sized tiles backed by a single preallocated uint8 pixel buffer of shape
+    (rows * cellheight, cols * cellwidth, bands). Assigning a tile writes its pixels straight
+    into the buffer, and which cells hold a tile is tracked in a boolean mask. `merge` wraps the
+    buffer as an image without copying it for modes PIL can map directly (L, RGBA); RGB needs a
+    single unpack since PIL pads RGB pixels to four bytes internally.
+    """
+
     @classmethod
-    def fromtiles(cls, tileimgs):
+    def fromtiles(cls, tileimgs, mode=None):
         if not tileimgs:
             raise StitchException("Empty tiles")
 
@@ -86,43 +524,74 @@ class TileArray(object):
         ypos = [pos[1] for pos in tileimgs.keys()]
         minx, maxx = min(xpos), max(xpos)
         miny, maxy = min(ypos), max(ypos)
-        rangex = range(minx, maxx + 1)
-        rangey = range(miny, maxy + 1)
         rows = maxy - miny + 1
         cols = maxx - minx + 1
 
         animg = next(iter(tileimgs.values()))
         imwidth, imheight = animg.size
+        if mode is None:
+            mode = _buffer_mode(animg.mode)
 
-        inst = cls(rows, cols, imwidth, imheight)
-        for j in rangey:
-            for i in rangex:
-                joffset = j - miny
-                ioffset = i - minx
-                try:
-                    inst[joffset, ioffset] = tileimgs[i, j]
-                except KeyError:
-                    pass
+        inst = cls(rows, cols, imwidth, imheight, mode)
+        for (i, j), tile in tileimgs.items():
+            inst[j - miny, i - minx] = tile
         return inst
 
-    def __init__(self, rows, cols, cellwidth, cellheight):
-        self._arr = list(list(None for i in range(cols)) for j in range(rows))
+    def __init__(self, rows, cols, cellwidth, cellheight, mode='RGB'):
+        if mode not in _buffer_modes:
+            raise ValueError("Unsupported tile array mode: {}".format(mode))
         self._rows = rows
         self._cols = cols
         self._cellwidth = cellwidth
         self._cellheight = cellheight
+        self._mode = mode
+        self._buf = np.zeros((rows * cellheight, cols * cellwidth, len(mode)), dtype=np.uint8)
+        self._present = np.zeros((rows, cols), dtype=bool)
 
     def _check_access(self, key):
         if not isinstance(key, (list, tuple)) or len(key) != 2:
             raise IndexError("Tile array must be indexed by two items")
 
+    def _cell(self, i, j):
+        return self._buf[i * self._cellheight:(i + 1) * self._cellheight,
+                         j * self._cellwidth:(j + 1) * self._cellwidth]
+
     def __getitem__(self, item):
         self._check_access(item)
-        return self._arr[item[0]][item[1]]
+        if not self._present[item[0], item[1]]:
+            return None
+        cell = self._cell(*item)
+        return Image.fromarray(cell[..., 0] if self._mode == 'L' else cell, self._mode)
 
     def __setitem__(self, key, value):
         self._check_access(key)
-        self._arr[key[0]][key[1]] = value
+        cell = self._cell(*key)
+        if value is None:
+            cell[...] = 0
+            self._present[key[0], key[1]] = False
+            return
+        if value.size != (self._cellwidth, self._cellheight):
+            raise StitchException("Tile at {} does not match the tile size of the array".format(key))
+        if value.mode != self._mode:
+            value = value.convert(self._mode)
+        cell[...] = np.asarray(value).reshape(cell.shape)
+        self._present[key[0], key[1]] = True
+
+    def row(self, i):
+        # the pixels of the i-th row of tiles, and which of its cells hold a tile
+        return self._buf[i * self._cellheight:(i + 1) * self._cellheight], self._present[i]
+
+    @property
+    def shape(self):
+        return self._rows, self._cols
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @property
+    def missing(self):
+        return ~self._present
 
     @property
     def height(self):
@@ -132,24 +601,102 @@ class TileArray(object):
     def width(self):
         return self._cellwidth * self._cols
 
-    def merge(self, mode):
-        output = Image.new(mode, (self.width, self.height))
-        for i in range(self._rows):
-            for j in range(self._cols):
-                xpos = j * self._cellwidth
-                ypos = i * self._cellheight
-                tile = self[i, j]
-                if tile is not None:
-                    output.paste(tile, (xpos, ypos))
+    def extent(self):
+        # (first column, first row, last column + 1, last row + 1) of the present tiles
+        if not self._present.any():
+            raise StitchException("Empty tiles")
+        rows = np.flatnonzero(self._present.any(axis=1))
+        cols = np.flatnonzero(self._present.any(axis=0))
+        return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+    def trimmed(self):
+        # the smallest block of rows and columns holding every present tile, sharing this buffer
+        c0, r0, c1, r1 = self.extent()
+        if (r0, r1, c0, c1) == (0, self._rows, 0, self._cols):
+            return self
+
+        inst = TileArray.__new__(TileArray)
+        inst._rows, inst._cols = r1 - r0, c1 - c0
+        inst._cellwidth, inst._cellheight = self._cellwidth, self._cellheight
+        inst._mode = self._mode
+        inst._buf = self._buf[r0 * self._cellheight:r1 * self._cellheight,
+                              c0 * self._cellwidth:c1 * self._cellwidth]
+        inst._present = self._present[r0:r1, c0:c1]
+        return inst
+
+    def merge(self, mode=None):
+        if mode is None:
+            mode = self._mode
+        with trace.span('merge', width=self.width, height=self.height, mode=mode):
+            buf = np.ascontiguousarray(self._buf)
+            output = Image.frombuffer(self._mode, (self.width, self.height), buf, 'raw', self._mode, 0, 1)
+            if mode != self._mode:
+                output = output.convert(mode)
         return output
 
 
+_buffer_modes = ('L', 'RGB', 'RGBA')
+
+
+class TileCrop(object):
+    """
+    Plans a relative crop (left, top, right, bottom) of the `rangex` x `rangey` tile grid before
+    anything is fetched. `rangex` and `rangey` are narrowed to the columns and rows the crop window
+    intersects, and `box(img)` is the pixel crop of the image stitched from those tiles that gives
+    the same result as cropping the image of the whole grid.
+    """
+
+    def __init__(self, rangex, rangey, crop):
+        left, top, right, bottom = crop
+        for arg in crop:
+            if arg < 0 or arg > 1:
+                raise ValueError("Must supply 0 <= arg <= 1")
+        rangex, rangey = list(rangex), list(rangey)
+        self._cols, self._rows = len(rangex), len(rangey)
+        self._crop = crop
+        self._col0, col1 = _covering(left, right, self._cols)
+        self._row0, row1 = _covering(top, bottom, self._rows)
+        self.rangex = rangex[self._col0:col1]
+        self.rangey = rangey[self._row0:row1]
+
+    def box(self, img):
+        # `img` may lack missing edge tiles (see `_stitch_streaming`): the crop is placed by the
+        # real tile size and where `img` sits in the narrowed grid, and clipped to `img`
+        left, top, right, bottom = self._crop
+        c0, r0, c1, r1 = img.info.get('tiles', (0, 0, len(self.rangex), len(self.rangey)))
+        x0, x1 = _span(left, right, self._cols, self._col0 + c0, c1 - c0, img.width // (c1 - c0))
+        y0, y1 = _span(top, bottom, self._rows, self._row0 + r0, r1 - r0, img.height // (r1 - r0))
+        return x0, y0, x1, y1
+
+
+def _span(start, end, total, first, count, cell):
+    # round exactly as Image.crop would on the whole grid, then shift to the `count` tiles from `first` on
+    lo = max(0, round(start * total * cell) - first * cell)
+    return lo, max(lo, min(count * cell, round(end * total * cell) - first * cell))
+
+
+def _covering(start, end, count):
+    first = min(int(math.floor(start * count)), count - 1)
+    last = max(int(math.ceil(end * count)), first + 1)
+    return first, min(last, count)
+
+
 def overlay(bottom, top, pos=(0, 0)):
-    result = Image.new(bottom.mode, bottom.size)
-    result.paste(bottom, (0, 0))
-    top_mask = top.convert('RGBA')
-    result.paste(top, pos, top_mask)
-    return result
+    return composite_into(bottom.copy(), (top, pos))
+
+
+def composite_into(base, *layers):
+    """
+    Alpha-blend each layer -- an image, or an (image, (x, y)) pair -- onto `base` in order,
+    in place, and return `base`. Only the region each layer covers is touched, and no
+    full-size intermediate images are allocated.
+    """
+    with trace.span('composite', layers=len(layers)):
+        for layer in layers:
+            top, pos = layer if isinstance(layer, tuple) else (layer, (0, 0))
+            top_mask = top if top.mode == 'RGBA' else top.convert('RGBA')
+            base.paste(top, pos, top_mask)
+    return base
 
 
 def side_by_side(im1, im2, mode, valign='bottom', bg=None):
@@ -0,0 +1,470 @@
+import asyncio
+import contextvars
+import functools
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import trace
+
+
+_default = object()
+
+# the `_Admission` of the request being made, for `_attempt` to time it from when the scheduler admits it
+_admission = contextvars.ContextVar('admission', default=None)
+
+# how often a pending request is checked against the render's hedging threshold
+_hedge_check = 0.05
+
+
+class TileFetcher(object):
+    """
+    asyncio tile downloads over one keep-alive `requests.Session`, admitted by a `FetchScheduler`.
+    """
+
+    def __init__(self, max_connections=20, per_host=16, timeout=30, rate=None, burst=1, host_rates=None,
+                 concurrency=_default):
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.timeout = timeout
+        if concurrency is _default:
+            concurrency = AdaptiveConcurrency()
+        self.scheduler = FetchScheduler(max_connections, per_host, rate, burst, host_rates, concurrency)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=per_host)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._executor = ThreadPoolExecutor(max_workers=max_connections,
+                                            thread_name_prefix='stitch-fetch')
+
+    async def get(self, url, headers=None):
+        return await self._request('GET', url, headers)
+
+    async def head(self, url, headers=None):
+        return await self._request('HEAD', url, headers)
+
+    async def _request(self, method, url, headers):
+        host = urlsplit(url).netloc
+        admission = _admission.get()
+        if admission is not None:
+            admission.at = None
+        await self.scheduler.acquire(host)
+        started = time.monotonic()
+        if admission is not None:
+            admission.at = asyncio.get_running_loop().time()
+        try:
+            request = self._executor.submit(functools.partial(self._send, method, url, headers))
+        except BaseException:
+            self.scheduler.release(host)
+            raise
+
+        def done(request):
+            # the slot is held until the request itself is done, even if its caller gave up on it
+            try:
+                status = request.result().status_code
+            except Exception:
+                status = None
+            self.scheduler.release(host, time.monotonic() - started, status, method)
+
+        request.add_done_callback(done)
+        try:
+            return await asyncio.wrap_future(request)
+        except requests.RequestException:
+            return None
+
+    async def get_all(self, urls, headers=None):
+        return await asyncio.gather(*(self.get(url, headers) for url in urls))
+
+    async def fetch(self, url, headers=None, retry=None, state=None):
+        """
+        Like `get`, retrying according to the `RetryPolicy` `retry` with the per-render `state`.
+        """
+        if retry is None:
+            return await self.get(url, headers)
+        if state is None:
+            state = retry.new_render()
+
+        attempt = 0
+        while True:
+            resp = await self._attempt(url, headers, retry, state)
+            if not retry.should_retry(resp) or attempt >= retry.retries or not state.take_retry():
+                return resp
+            state.retries += 1
+            trace.event('retry', url=url, attempt=attempt + 1, status=None if resp is None else resp.status_code)
+            await asyncio.sleep(retry.delay(attempt))
+            attempt += 1
+
+    async def _attempt(self, url, headers, retry, state):
+        loop = asyncio.get_running_loop()
+        # fetchers that don't go through the scheduler are timed from when the request is made
+        admission = _Admission(loop.time())
+        primary = asyncio.ensure_future(self._admitted_get(url, headers, admission))
+        hedge_after = None
+        if retry.hedge:
+            # the threshold is checked again while waiting, as the render's first latencies come in
+            while not primary.done():
+                hedge_after = state.hedge_delay()
+                if hedge_after is None or admission.at is None:
+                    timeout = _hedge_check
+                else:
+                    timeout = min(_hedge_check, admission.at + hedge_after - loop.time())
+                    if timeout <= 0:
+                        break
+                await asyncio.wait({primary}, timeout=timeout)
+        if primary.done() or hedge_after is None or not state.take_retry():
+            resp = await primary
+        else:
+            # the original request is a straggler: race it against a duplicate
+            state.hedges += 1
+            trace.event('hedge', url=url, after=hedge_after)
+            resp = await _first_response(primary, asyncio.ensure_future(self.get(url, headers)))
+
+        if resp is not None:
+            state.record_latency(loop.time() - admission.at)
+        return resp
+
+    async def _admitted_get(self, url, headers, admission):
+        _admission.set(admission)
+        return await self.get(url, headers)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.session.close()
+
+    def _send(self, method, url, headers):
+        return self.session.request(method, url, headers=headers, timeout=self.timeout)
+
+
+class _Admission(object):
+    __slots__ = ('at',)
+
+    def __init__(self, at):
+        # None while the request waits for the scheduler
+        self.at = at
+
+
+class FetchScheduler(object):
+    """
+    Caps requests in flight overall and per host, rate limits each host, and takes turns between renders.
+    """
+
+    _idle_history = 64
+
+    def __init__(self, max_in_flight=20, per_host=10, rate=None, burst=1, host_rates=None, concurrency=None):
+        self.max_in_flight = max_in_flight
+        self.per_host = per_host
+        self.concurrency = concurrency
+        self._limits = {}
+        self.rate = rate
+        self.burst = burst
+        self.host_rates = dict(host_rates or {})
+        self.in_flight = 0
+        self._host_in_flight = {}
+        self._buckets = {}
+        self._queues = {}
+        self._served = {}
+        self._grants = 0
+        self._lock = threading.Lock()
+
+    async def acquire(self, host, flow=None):
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(host, loop, loop.create_future())
+        with self._lock:
+            flow = loop if flow is None else flow
+            self._queues.setdefault(flow, deque()).append(waiter)
+            self._served.setdefault(flow, -1)
+            self._dispatch()
+        try:
+            delay = await waiter.future
+            if delay > 0:
+                trace.event('throttle', host=host, delay=delay)
+                await asyncio.sleep(delay)
+        except BaseException:
+            with self._lock:
+                granted = waiter.granted
+                if not granted:
+                    self._withdraw(waiter)
+            if granted:
+                self.release(host)
+            raise
+
+    def release(self, host, latency=None, status=None, method='GET'):
+        """
+        Free the slot of a request to `host`. Passing the request's `latency`, its `status` (None
+        for a failed request) and its `method` feeds the adaptive concurrency limit.
+        """
+        with self._lock:
+            self.in_flight -= 1
+            self._host_in_flight[host] -= 1
+            if latency is not None and self.concurrency is not None:
+                limit = self._host_limit(host)
+                before = limit.current
+                limit.record(latency, status, saturated=self._host_in_flight[host] + 1 >= before, method=method)
+                if limit.current != before:
+                    trace.event('concurrency', host=host, limit=limit.current, previous=before, status=status)
+            self._dispatch()
+
+    def limit(self, host):
+        # how many requests may currently be in flight against `host`
+        if self.concurrency is None:
+            return self.per_host
+        return self._host_limit(host).current
+
+    def _host_limit(self, host):
+        if host not in self._limits:
+            self._limits[host] = self.concurrency.new_host(self.per_host)
+        return self._limits[host]
+
+    def _dispatch(self):
+        # hand each free slot to the render served longest ago that has a request it can take
+        while self.in_flight < self.max_in_flight:
+            chosen = None
+            for flow, queue in self._queues.items():
+                waiter = next((waiter for waiter in queue
+                               if self._host_in_flight.get(waiter.host, 0) < self.limit(waiter.host)), None)
+                if waiter is not None and (chosen is None or self._served[flow] < self._served[chosen[0]]):
+                    chosen = flow, waiter
+            if chosen is None:
+                return
+            flow, waiter = chosen
+            self._queues[flow].remove(waiter)
+            if not self._queues[flow]:
+                del self._queues[flow]
+            self._grants += 1
+            self._served[flow] = self._grants
+            self._grant(waiter)
+        self._forget_idle()
+
+    def _grant(self, waiter):
+        bucket = self._bucket(waiter.host)
+        delay = bucket.reserve() if bucket is not None else 0.0
+        try:
+            waiter.loop.call_soon_threadsafe(_resolve, waiter.future, delay)
+        except RuntimeError:
+            # the render's loop has closed
+            return
+        waiter.granted = True
+        self.in_flight += 1
+        self._host_in_flight[waiter.host] = self._host_in_flight.get(waiter.host, 0) + 1
+
+    def _withdraw(self, waiter):
+        for flow, queue in list(self._queues.items()):
+            if waiter in queue:
+                queue.remove(waiter)
+                if not queue:
+                    del self._queues[flow]
+
+    def _forget_idle(self):
+        # when each render was last served is kept for the most recent idle ones only
+        if len(self._served) > self._idle_history + len(self._queues):
+            idle = sorted((stamp, id(flow), flow) for flow, stamp in self._served.items() if flow not in self._queues)
+            for _, _, flow in idle[:len(idle) - self._idle_history]:
+                del self._served[flow]
+
+    def _bucket(self, host):
+        if host not in self._buckets:
+            rate, burst = self.host_rates.get(host, (self.rate, self.burst))
+            self._buckets[host] = None if rate is None else _TokenBucket(rate, burst)
+        return self._buckets[host]
+
+
+class _Waiter(object):
+    __slots__ = ('host', 'loop', 'future', 'granted')
+
+    def __init__(self, host, loop, future):
+        self.host = host
+        self.loop = loop
+        self.future = future
+        self.granted = False
+
+
+def _resolve(future, delay):
+    if not future.done():
+        future.set_result(delay)
+
+
+class _TokenBucket(object):
+    # tokens may go negative: the request taking one then waits until it would have been refilled
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+
+    def reserve(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+class AdaptiveConcurrency(object):
+    """
+    AIMD limit on the requests in flight against each host.
+    """
+
+    def __init__(self, initial=10, minimum=1, maximum=None, backoff=0.5, latency_tolerance=3.0,
+                 congestion_statuses=(429, 500, 502, 503, 504)):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.congestion_statuses = congestion_statuses
+
+    def new_host(self, cap):
+        return HostConcurrency(self, cap)
+
+
+class HostConcurrency(object):
+    def __init__(self, policy, cap):
+        self.policy = policy
+        self.maximum = cap if policy.maximum is None else min(cap, policy.maximum)
+        self.limit = float(max(policy.minimum, min(policy.initial, self.maximum)))
+        self._baselines = {}
+        self._smoothed = None
+        self._last_cut = None
+
+    @property
+    def current(self):
+        return int(self.limit)
+
+    def record(self, latency, status, saturated, method='GET'):
+        policy = self.policy
+        congested = status is None or status in policy.congestion_statuses
+        if not congested:
+            # the fastest recent latency, drifting up slowly so it follows a server that got slower; kept
+            # per method, as a HEAD returns no payload and is much faster than a GET of the same tile
+            baseline = self._baselines.get(method)
+            baseline = self._baselines[method] = latency if baseline is None else min(latency, baseline * 1.01)
+            self._smoothed = latency if self._smoothed is None else 0.8 * self._smoothed + 0.2 * latency
+            congested = latency > policy.latency_tolerance * baseline
+
+        now = time.monotonic()
+        if congested:
+            if self._last_cut is None or now - self._last_cut >= (self._smoothed or 0.0):
+                self.limit = max(policy.minimum, self.limit * policy.backoff)
+                self._last_cut = now
+        elif saturated:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+
+async def _first_response(*futures):
+    pending = set(futures)
+    resp = None
+    while pending and resp is None:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for fut in done:
+            if fut.result() is not None:
+                resp = fut.result()
+    for fut in pending:
+        fut.cancel()
+    return resp
+
+
+class RetryPolicy(object):
+    """
+    Retries with exponential backoff and jitter, optional hedging, and a per-render `budget`.
+    """
+
+    def __init__(self, retries=2, backoff=0.5, max_backoff=8.0, jitter=0.5,
+                 retry_statuses=(429, 500, 502, 503, 504), hedge=False, hedge_quantile=0.95,
+                 hedge_min_samples=5, budget=20):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = retry_statuses
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.budget = budget
+
+    def should_retry(self, resp):
+        return resp is None or resp.status_code in self.retry_statuses
+
+    def delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay * (1 - self.jitter * random.random())
+
+    def new_render(self):
+        return RenderRetryState(self)
+
+
+class RenderRetryState(object):
+    def __init__(self, policy):
+        self.policy = policy
+        self.retries_left = policy.budget
+        self.retries = 0
+        self.hedges = 0
+        self._latencies = []
+
+    def take_retry(self):
+        # retries and hedges both draw on the render's budget
+        if self.retries_left is not None:
+            if self.retries_left <= 0:
+                return False
+            self.retries_left -= 1
+        return True
+
+    def record_latency(self, latency):
+        self._latencies.append(latency)
+
+    def hedge_delay(self):
+        if len(self._latencies) < self.policy.hedge_min_samples:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(self.policy.hedge_quantile * len(ordered)))]
+
+
+_default_fetcher = None
+_default_fetcher_lock = threading.Lock()
+
+
+def default_fetcher():
+    global _default_fetcher
+    with _default_fetcher_lock:
+        if _default_fetcher is None:
+            _default_fetcher = TileFetcher()
+        return _default_fetcher
+
+
+def set_default_fetcher(fetcher):
+    global _default_fetcher
+    with _default_fetcher_lock:
+        _default_fetcher = fetcher
+
+
+def run_sync(coro):
+    """
+    Run a coroutine to completion from synchronous code, on a helper thread if a loop is already running.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    outcome = {}
+
+    def runner():
+        try:
+            outcome['result'] = asyncio.run(coro)
+        except BaseException as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=runner)
+    thread.start()
+    thread.join()
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
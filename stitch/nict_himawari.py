@@ -1,34 +1,121 @@
+import functools
+import threading
+from datetime import timedelta
 from itertools import product as cartesian_product
 
-from .core import stitch, overlay
+from . import trace
+from .animate import frame_times, render_frames
+from .cache import MemoryCache, image_nbytes
+from .catalogue import ScanCatalogue
+from .core import stitch_layers, composite_into, Layer, TileCrop
+from .fetch import default_fetcher
 from .postprocess import NICTPostProcessor
 
 BASE_URL = 'http://himawari8-dl.nict.go.jp/himawari8'
 
 
-def vis(timestamp, zoom, rangex, rangey, boundaries=True, crop=None):
-    return _get_himawari(timestamp, zoom, 'vis', rangex, rangey, boundaries, crop)
+def vis(timestamp, zoom, rangex, rangey, boundaries=True, crop=None, window=None, snap=None):
+    if snap is not None:
+        timestamp = scan_catalogue('vis').snap(timestamp, snap)
+    return _get_himawari(timestamp, zoom, 'vis', rangex, rangey, boundaries, crop, window)
 
 
-def ir(timestamp, zoom, rangex, rangey, boundaries=True, crop=None):
-    return _get_himawari(timestamp, zoom, 'ir', rangex, rangey, boundaries, crop)
+def ir(timestamp, zoom, rangex, rangey, boundaries=True, crop=None, window=None, snap=None):
+    if snap is not None:
+        timestamp = scan_catalogue('ir').snap(timestamp, snap)
+    return _get_himawari(timestamp, zoom, 'ir', rangex, rangey, boundaries, crop, window)
 
 
-def _get_himawari(timestamp, zoom, product, rangex, rangey, boundaries, crop):
-    sat_urls = {(x, y): _get_product_url(timestamp, zoom, product, x, y)
-                for x, y in cartesian_product(rangex, rangey)}
-    sat_img = stitch(sat_urls, 'RGB')
-
+def frames(start, end, step, zoom, product, rangex, rangey, boundaries=True, crop=None,
+           window=None, concurrency=3):
+    """
+    Render a sequence of frames from `start` to `end`, `step` apart, yielding a
+    NICTPostProcessor per frame in time order. Up to `concurrency` frames are fetched at once,
+    and all frames share a single coastline overlay.
+    """
     if boundaries:
-        coastline_urls = {(x, y): _get_coastline_url(zoom, product, x, y)
-                          for x, y in cartesian_product(rangex, rangey)}
-        coastline_img = stitch(coastline_urls, 'RGBA')
-        sat_img = overlay(sat_img, coastline_img)
+        if crop:
+            tile_crop = TileCrop(rangex, rangey, crop)
+            coastlines(zoom, product, tile_crop.rangex, tile_crop.rangey, window=window)
+        else:
+            coastlines(zoom, product, rangex, rangey, window=window)
+
+    def render(timestamp):
+        return _get_himawari(timestamp, zoom, product, rangex, rangey, boundaries, crop, window)
+
+    return render_frames(render, frame_times(start, end, step), concurrency)
+
 
-    postprocessor = NICTPostProcessor(sat_img, timestamp)
+def tile_layers(timestamp, zoom, product, rangex, rangey, boundaries=True, crop=None):
+    """
+    The tile layers, by name, that rendering these arguments downloads, without downloading them.
+    """
     if crop:
-        postprocessor.crop_relative(*crop)
-    return postprocessor
+        tile_crop = TileCrop(rangex, rangey, crop)
+        rangex, rangey = tile_crop.rangex, tile_crop.rangey
+    layers = {'sat': _imagery_layer(timestamp, zoom, product, rangex, rangey)}
+    if boundaries:
+        layers['coastline'] = _coastline_layer(zoom, product, rangex, rangey)
+    return layers
+
+
+def _get_himawari(timestamp, zoom, product, rangex, rangey, boundaries, crop, window=None):
+    with trace.span('render', source='nict_himawari', product=product, timestamp=timestamp) as stage:
+        tile_crop = TileCrop(rangex, rangey, crop) if crop else None
+        if tile_crop is not None:
+            rangex, rangey = tile_crop.rangex, tile_crop.rangey
+        layers = {'sat': _imagery_layer(timestamp, zoom, product, rangex, rangey)}
+        coastline_key = _coastline_key(zoom, product, rangex, rangey)
+        coastline_img = _coastline_cache.get(coastline_key) if boundaries else None
+        stage.set(overlays_cached=coastline_img is not None)
+        if boundaries and coastline_img is None:
+            layers['coastline'] = _coastline_layer(zoom, product, rangex, rangey)
+        imgs = stitch_layers(layers, window=window)
+
+        sat_img = imgs['sat']
+        if boundaries:
+            if coastline_img is None:
+                coastline_img = imgs['coastline']
+                _coastline_cache.put(coastline_key, coastline_img, image_nbytes(coastline_img))
+            sat_img = composite_into(sat_img, coastline_img)
+
+        postprocessor = NICTPostProcessor(sat_img, timestamp)
+        if tile_crop is not None:
+            postprocessor.crop(*tile_crop.box(sat_img))
+        return postprocessor
+
+
+_coastline_cache = MemoryCache(max_bytes=128 * 1024 * 1024)
+
+
+def coastlines(zoom, product, rangex, rangey, window=None):
+    key = _coastline_key(zoom, product, rangex, rangey)
+    coastline_img = _coastline_cache.get(key)
+    if coastline_img is None:
+        coastline_img = stitch_layers({'coastline': _coastline_layer(zoom, product, rangex, rangey)},
+                                      window=window)['coastline']
+        _coastline_cache.put(key, coastline_img, image_nbytes(coastline_img))
+    return coastline_img
+
+
+def clear_coastline_cache():
+    _coastline_cache.clear()
+
+
+def _coastline_key(zoom, product, rangex, rangey):
+    return zoom, product.lower(), tuple(rangex), tuple(rangey)
+
+
+def _imagery_layer(timestamp, zoom, product, rangex, rangey):
+    return Layer({(x, y): _get_product_url(timestamp, zoom, product, x, y)
+                  for x, y in cartesian_product(rangex, rangey)}, 'RGB',
+                 grid=(_himawari_url_common(zoom, product),), learn_blanks=product.lower() == 'ir')
+
+
+def _coastline_layer(zoom, product, rangex, rangey):
+    return Layer({(x, y): _get_coastline_url(zoom, product, x, y)
+                  for x, y in cartesian_product(rangex, rangey)}, 'RGBA', static=True,
+                 grid=(_himawari_url_common(zoom, product), 'coastline'), learn_blanks=True)
 
 
 _zoom_ref = {
@@ -53,6 +140,29 @@ def _get_product_url(timestamp, zoom, product, x, y):
                                                                        time=time, x=x, y=y)
 
 
+_catalogues = {}
+_catalogues_lock = threading.Lock()
+
+
+def scan_catalogue(product):
+    """
+    The process-wide `ScanCatalogue` of a product's scans, every 10 minutes, filled by HEAD
+    requests for tile (0, 0) at zoom 1.
+    """
+    _himawari_url_common(1, product)  # validates the product
+    with _catalogues_lock:
+        if product.lower() not in _catalogues:
+            _catalogues[product.lower()] = ScanCatalogue(functools.partial(_probe_scan, product),
+                                                         timedelta(minutes=10),
+                                                         name='{} scan'.format(product.lower()))
+        return _catalogues[product.lower()]
+
+
+async def _probe_scan(product, slot):
+    resp = await default_fetcher().head(_get_product_url(slot, 1, product, 0, 0))
+    return slot if resp is not None and resp.status_code == 200 else None
+
+
 def _get_coastline_url(zoom, product, x, y):
     prepend = _himawari_url_common(zoom, product)
     return prepend + '/coastline/ffff00_{x}_{y}.png'.format(x=x, y=y)
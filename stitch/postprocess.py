@@ -1,70 +1,226 @@
-from PIL import Image, ImageFont, ImageDraw
+import functools
+import math
+import re
 
-from .core import side_by_side, overlay, resource_path, stack
+from PIL import Image, ImageFont, ImageDraw, ImageFilter
+
+from . import trace
+from .core import side_by_side, composite_into, resource_path, stack
+
+
+# Fonts and logo/colorbar images are loaded once per process and shared by every PostProcessor,
+# along with their resized variants, so they must never be edited in place.
+_cira_rammb_logo = 'cira_rammb_logo'
+
+
+@functools.lru_cache(maxsize=None)
+def _asset(name):
+    if name == _cira_rammb_logo:
+        return side_by_side(_asset('cira_logo_200.png'), _asset('rammb_logo_150.png'), 'RGBA')
+    im = Image.open(resource_path(name), 'r')
+    im.load()
+    return im
+
+
+@functools.lru_cache(maxsize=64)
+def _thumbnail(name, target_dims, resample=None):
+    resized = _asset(name).copy()
+    if resample is None:
+        resized.thumbnail(target_dims)
+    else:
+        resized.thumbnail(target_dims, resample=resample)
+    return resized
+
+
+def _thumbnail_size(size, target_dims):
+    # the size a `size` image is given by thumbnail(target_dims), worked out as PIL does
+    width, height = size
+    x, y = math.floor(target_dims[0]), math.floor(target_dims[1])
+    if x >= width and y >= height:
+        return size
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = width / height
+    if x / y >= aspect:
+        return round_aspect(y * aspect, key=lambda n: abs(aspect - n / y)), y
+    return x, round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+
+
+@functools.lru_cache(maxsize=128)
+def _font(size):
+    return ImageFont.truetype(resource_path('Verdana.ttf'), size)
+
+
+def _label_font_size(text, target_width, target_height):
+    # Verdana's digits are all as wide as each other, so labels that only differ in their digits --
+    # the timestamps of an animation's frames -- are measured once
+    return _template_font_size(re.sub(r'[0-9]', '0', text), target_width, target_height)
+
+
+@functools.lru_cache(maxsize=256)
+def _template_font_size(text, target_width, target_height):
+    # the smallest font size at which `text` is as wide or as tall as the target, or None
+    if target_width <= 0 or target_height <= 0:
+        return None
+
+    def reaches(size):
+        width, height = _font(size).getsize(text)
+        return width >= target_width or height >= target_height
+
+    low, high = 0, 1
+    while not reaches(high):
+        low, high = high, high * 2
+    while high - low > 1:
+        mid = (low + high) // 2
+        if reaches(mid):
+            high = mid
+        else:
+            low = mid
+    return high
 
 
 class PostProcessor(object):
-    def __init__(self, im, timestamp):
+    """
+    Chainable edits to a rendered image. With `lazy=True` (or after setting `lazy` to True) the
+    edits are only recorded, and run as one optimized plan when the result is needed by
+    `result()`, `save()` or `show()`. Crops are merged and moved ahead of kernel filters so the
+    filters only see the pixels that are kept; the output is identical to applying each edit
+    as it is made.
+    """
+
+    def __init__(self, im, timestamp, lazy=False):
         self.original = im
-        self._processed = im.copy()
+        # `original` is only copied once an edit would draw on it in place
+        self._processed = im
+        self._owned = False
         self._timestamp = timestamp
+        self._plan = []
+        self._size = im.size
+        self._lazy = lazy
+
+    @property
+    def lazy(self):
+        return self._lazy
+
+    @lazy.setter
+    def lazy(self, value):
+        self._lazy = value
+        if not value:
+            self._run()
 
     @property
     def size(self):
-        return self._processed.size
+        if self._size is None:
+            self._run()
+        return self._size
 
     def result(self):
+        self._run()
         return self._processed.copy()
 
     def save(self, *args, **kwargs):
+        self._run()
         self._processed.save(*args, **kwargs)
 
     def show(self, *args, **kwargs):
+        self._run()
         self._processed.show(*args, **kwargs)
 
+    def crop(self, left, top, right, bottom):
+        # round the box exactly as Image.crop does
+        box = tuple(int(round(arg)) for arg in (left, top, right, bottom))
+        self._record(('crop', box), (box[2] - box[0], box[3] - box[1]))
+
     def crop_relative(self, left, top, right, bottom):
         self._check_arg_range(left, top, right, bottom)
 
-        width, height = self._processed.size
-        self._processed = self._processed.crop((left * width, top * height,
-                                                right * width, bottom * height))
+        width, height = self.size
+        self.crop(left * width, top * height, right * width, bottom * height)
 
     def minimize(self, width, height):
-        self._processed.thumbnail((width, height))
+        # the thumbnail size is left to PIL, so it is only known once the plan has run
+        self._record(('thumbnail', (width, height)), None)
 
     def scale(self, factor, interp=None):
         if interp is None:
             interp = Image.BILINEAR
         new_size = tuple(int(round(dim * factor)) for dim in self.size)
-        self._processed = self._processed.resize(new_size, resample=interp)
+        self._record(('resize', new_size, interp), new_size)
 
     def timestamp_label(self, breadth=0.2, padding=0.01, **text_kw):
         for remove_kw in ('xy', 'text', 'font'):
             if remove_kw in text_kw:
                 text_kw.pop(remove_kw)
 
-        drawer = ImageDraw.Draw(self._processed)
         text = self._timestamp.isoformat(sep=' ') + ' UTC'
 
-        dummy_obj = Image.new('RGB', self._processed.size)
-        x, _, target_size = self._placement(dummy_obj, 'bottom-left', breadth, padding)
-
-        width, height = 0, 0
-        fontsize = 1
-        font = None
-        while width < target_size.width and height < target_size.height:
-            font = ImageFont.truetype(resource_path('Verdana.ttf'), fontsize)
-            width, height = font.getsize(text)
-            fontsize += 1
+        self._check_breadth_and_padding(breadth, padding)
+        x = self._round(min(self.size) * padding)
+        target_width, target_height = _thumbnail_size(self.size, self._target_dims(breadth))
 
-        if font is None:
+        fontsize = _label_font_size(text, target_width, target_height)
+        if fontsize is None:
             raise ValueError("Unexpected error: can't figure the font size")
+        font = _font(fontsize)
+        _, height = font.getsize(text)
 
-        y = self._round((1 - padding) * self._processed.height - height)
-        drawer.text((x, y), text, font=font, **text_kw)
+        y = self._round((1 - padding) * self.size[1] - height)
+        self._record(('text', (x, y), text, font, text_kw), self.size)
 
     def apply_filter(self, imfilt):
-        self._processed = self._processed.filter(imfilt)
+        self._record(('filter', imfilt), self.size)
+
+    def _paste(self, im, pos):
+        self._record(('paste', im, pos), self.size)
+
+    def _stack(self, im):
+        width, height = self.size
+        self._record(('stack', im), (max(width, im.width), height + im.height))
+
+    def _record(self, op, size):
+        self._plan.append(op)
+        self._size = size
+        if not self._lazy:
+            self._run()
+
+    def _run(self):
+        if not self._plan:
+            return
+        plan = _optimize(self._plan, self._processed.size)
+        self._plan = []
+        for op in plan:
+            self._execute(op)
+        self._size = self._processed.size
+
+    def _execute(self, op):
+        kind = op[0]
+        with trace.span('postprocess.' + kind, size=self._processed.size):
+            self._execute_op(kind, op)
+
+    def _execute_op(self, kind, op):
+        if kind == 'crop':
+            self._replace(self._processed.crop(op[1]))
+        elif kind == 'resize':
+            self._replace(self._processed.resize(op[1], resample=op[2]))
+        elif kind == 'filter':
+            self._replace(self._processed.filter(op[1]))
+        elif kind == 'stack':
+            self._replace(stack(self._processed, op[1], 'RGB', halign='right'))
+        else:
+            if not self._owned:
+                self._replace(self._processed.copy())
+            if kind == 'thumbnail':
+                self._processed.thumbnail(op[1])
+            elif kind == 'paste':
+                composite_into(self._processed, (op[1], op[2]))
+            elif kind == 'text':
+                ImageDraw.Draw(self._processed).text(op[1], op[2], font=op[3], **op[4])
+
+    def _replace(self, im):
+        self._processed = im
+        self._owned = True
 
     def _check_arg_range(self, *args, minval=0.0, maxval=1.0):
         for arg in args:
@@ -77,19 +233,21 @@ class PostProcessor(object):
         if breadth + 2 * padding > 1:
             raise ValueError("Supplied breadth and padding forces overlaid item to be out of bounds")
 
-    def _placement(self, obj, corner, breadth, padding):
+    def _target_dims(self, breadth):
+        imgwidth, imgheight = self.size
+        return imgwidth * breadth, imgheight * breadth
+
+    def _placement(self, asset, corner, breadth, padding):
         self._check_breadth_and_padding(breadth, padding)
 
         if corner not in ('top-left', 'top-right',
                           'bottom-left', 'bottom-right'):
             raise ValueError("Invalid corner: {}".format(corner))
 
-        imgwidth, imgheight = self._processed.size
+        imgwidth, imgheight = self.size
 
         padding_abs = min(imgheight, imgwidth) * padding
-        target_dims = imgwidth * breadth, imgheight * breadth
-        resized = obj.copy()
-        resized.thumbnail(target_dims)
+        resized = _thumbnail(asset, self._target_dims(breadth))
 
         if 'left' in corner:
             x = self._round(0 + padding_abs)
@@ -123,28 +281,30 @@ for band in range(12, 17):
 
 
 class CIRAPostProcessor(PostProcessor):
-    def __init__(self, im, product, timestamp):
-        super(CIRAPostProcessor, self).__init__(im, timestamp)
+    def __init__(self, im, product, timestamp, lazy=False):
+        super(CIRAPostProcessor, self).__init__(im, timestamp, lazy)
         self._product = product
 
     @staticmethod
     def _get_cira_rammb_logo():
-        cira = Image.open(resource_path('cira_logo_200.png'), 'r')
-        rammb = Image.open(resource_path('rammb_logo_150.png'), 'r')
-        return side_by_side(cira, rammb, 'RGBA')
+        return _asset(_cira_rammb_logo)
 
-    def _get_colorbar(self):
+    def _colorbar_asset(self):
         if self._product.startswith('band'):
             band = int(self._product[-2:])
-            return Image.open(resource_path(_cira_band_colorbar_map[band]), 'r')
+            return _cira_band_colorbar_map[band]
         else:
             return None
 
+    def _get_colorbar(self):
+        asset = self._colorbar_asset()
+        return None if asset is None else _asset(asset)
+
     def logo(self, breadth=0.2, padding=0.01):
         logo = CIRAPostProcessor._get_cira_rammb_logo()
         if logo is not None:
-            x, y, logo_resized = self._placement(logo, 'bottom-right', breadth, padding)
-            self._processed = overlay(self._processed, logo_resized, (x, y))
+            x, y, logo_resized = self._placement(_cira_rammb_logo, 'bottom-right', breadth, padding)
+            self._paste(logo_resized, (x, y))
 
     def colorbar(self):
         cbar = self._get_colorbar()
@@ -154,17 +314,97 @@ class CIRAPostProcessor(PostProcessor):
             return
 
         cbar_width, _ = cbar.size
-        im_width, _ = self._processed.size
+        im_width, _ = self.size
         if cbar_width > im_width:
-            cbar.thumbnail((im_width, im_width), resample=Image.NEAREST)
-        self._processed = stack(self._processed, cbar, 'RGB', halign='right')
+            cbar = _thumbnail(self._colorbar_asset(), (im_width, im_width), Image.NEAREST)
+        self._stack(cbar)
 
 
 class NICTPostProcessor(PostProcessor):
-    def __init__(self, im, timestamp):
-        super(NICTPostProcessor, self).__init__(im, timestamp)
+    def __init__(self, im, timestamp, lazy=False):
+        super(NICTPostProcessor, self).__init__(im, timestamp, lazy)
 
     def logo(self, breadth=0.2, padding=0.01):
-        logoimg = Image.open(resource_path('logo_nict.png'), 'r')
-        x, y, logo_resized = self._placement(logoimg, 'bottom-right', breadth, padding)
-        self._processed = overlay(self._processed, logo_resized, (x, y))
+        x, y, logo_resized = self._placement('logo_nict.png', 'bottom-right', breadth, padding)
+        self._paste(logo_resized, (x, y))
+
+
+def _optimize(plan, size):
+    # rewrites the plan into an equivalent one that touches fewer pixels
+    ops = []
+    sizes = []
+    for op in plan:
+        ops.append(op)
+        sizes.append(size)
+        size = _output_size(op, size)
+
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(ops) - 1):
+            first, second = ops[i], ops[i + 1]
+            if first[0] == 'filter' and second[0] == 'crop' and sizes[i] is not None:
+                pushed = _crop_ahead_of_filter(first[1], second[1], sizes[i])
+                if pushed is not None:
+                    outer, inner = pushed
+                    outer_size = (outer[2] - outer[0], outer[3] - outer[1])
+                    ops[i:i + 2] = [('crop', outer), first, ('crop', inner)]
+                    sizes[i:i + 2] = [sizes[i], outer_size, outer_size]
+                    changed = True
+                    break
+            if first[0] == 'crop' and second[0] == 'crop':
+                merged = _merge_crops(first[1], second[1])
+                if merged is not None:
+                    ops[i:i + 2] = [('crop', merged)]
+                    sizes[i + 1:i + 2] = []
+                    changed = True
+                    break
+
+    # crops of the whole image are plain copies
+    return [op for op, size in zip(ops, sizes) if not (op[0] == 'crop' and size is not None and
+                                                      op[1] == (0, 0) + tuple(size))]
+
+
+def _output_size(op, size):
+    kind = op[0]
+    if kind == 'crop':
+        box = op[1]
+        return box[2] - box[0], box[3] - box[1]
+    elif kind == 'resize':
+        return op[1]
+    elif kind == 'thumbnail' or size is None:
+        return None
+    elif kind == 'stack':
+        return max(size[0], op[1].width), size[1] + op[1].height
+    return size
+
+
+def _merge_crops(outer, inner):
+    width, height = outer[2] - outer[0], outer[3] - outer[1]
+    if not (0 <= inner[0] <= inner[2] <= width and 0 <= inner[1] <= inner[3] <= height):
+        return None
+    return outer[0] + inner[0], outer[1] + inner[1], outer[0] + inner[2], outer[1] + inner[3]
+
+
+def _filter_margin(imfilt):
+    # how far each output pixel of the filter reaches into its input, where that is known
+    if isinstance(imfilt, type):
+        imfilt = imfilt()
+    if isinstance(imfilt, ImageFilter.RankFilter):
+        return imfilt.size // 2, imfilt.size // 2
+    if isinstance(imfilt, ImageFilter.BuiltinFilter):
+        width, height = imfilt.filterargs[0]
+        return width // 2, height // 2
+    return None
+
+
+def _crop_ahead_of_filter(imfilt, box, size):
+    margin = _filter_margin(imfilt)
+    if margin is None or not (0 <= box[0] <= box[2] <= size[0] and 0 <= box[1] <= box[3] <= size[1]):
+        return None
+    outer = (max(0, box[0] - margin[0]), max(0, box[1] - margin[1]),
+             min(size[0], box[2] + margin[0]), min(size[1], box[3] + margin[1]))
+    if outer == (0, 0) + tuple(size):
+        return None
+    inner = (box[0] - outer[0], box[1] - outer[1], box[2] - outer[0], box[3] - outer[1])
+    return outer, inner
@@ -0,0 +1,174 @@
+"""
+Output of stitched mosaics as a multi-resolution XYZ tile pyramid, `{z}/{x}/{y}.{format}`
+under an output directory, for zoomable viewers. The highest zoom level is the mosaic at full
+resolution and each level below it halves the one above. Output tiles that are all black or
+fully transparent are not written.
+
+The mosaic is consumed a strip at a time: every level is downsampled from the strips of the
+level above as they are written, so neither the mosaic nor any of its levels is ever held whole
+in memory. Output tiles covering only upstream tiles that are missing are not written either.
+
+    max_zoom = pyramid.stitch_pyramid(sat_urls, 'out/tiles')
+"""
+import math
+import os
+
+import numpy as np
+from PIL import Image
+
+from . import trace
+from .core import TileArray, StitchException, _buffer_mode, _stitch_rows
+from .fetch import run_sync
+
+
+def stitch_pyramid(pos_urls, outdir, mode='RGB', tile_size=256, format='png', min_zoom=0, static=False):
+    return run_sync(stitch_pyramid_async(pos_urls, outdir, mode, tile_size, format, min_zoom, static))
+
+
+async def stitch_pyramid_async(pos_urls, outdir, mode='RGB', tile_size=256, format='png', min_zoom=0,
+                               static=False):
+    """
+    Stitch the tiles of `pos_urls` straight into a pyramid in `outdir`, one row of upstream
+    tiles at a time, and return the highest zoom level written. Any number of tiles can be
+    stitched this way: only two rows of upstream tiles are in flight or in memory at once.
+    """
+    _check_tile_size(tile_size)
+    rows = max(pos[1] for pos in pos_urls.keys()) - min(pos[1] for pos in pos_urls.keys()) + 1
+
+    with trace.span('pyramid', tiles=len(pos_urls)) as stage:
+        writer = None
+        empty_rows = 0
+        async for row in _stitch_rows(pos_urls, mode, static):
+            if writer is None:
+                if row is None:
+                    # the tile size is only known once a row holds a tile
+                    empty_rows += 1
+                    continue
+                writer = _PyramidWriter(outdir, row.mode, row.width, row.height * rows,
+                                        row.width // row.shape[1], row.height, tile_size, format, min_zoom)
+                for _ in range(empty_rows):
+                    writer.add_row(*writer.empty_row())
+            writer.add_row(*(writer.empty_row() if row is None else row.row(0)))
+
+        if writer is None:
+            raise StitchException("Empty tiles")
+        writer.finish()
+        stage.set(max_zoom=writer.max_zoom, written=writer.written, skipped=writer.skipped)
+    return writer.max_zoom
+
+
+def write_pyramid(tiles, outdir, tile_size=256, format='png', min_zoom=0):
+    """
+    Write `tiles` -- a `TileArray`, or an image -- to `outdir` as a pyramid, and return the
+    highest zoom level written.
+    """
+    _check_tile_size(tile_size)
+    if isinstance(tiles, Image.Image):
+        tiles = TileArray.fromtiles({(0, 0): tiles}, _buffer_mode(tiles.mode))
+    rows, cols = tiles.shape
+    with trace.span('pyramid', width=tiles.width, height=tiles.height) as stage:
+        writer = _PyramidWriter(outdir, tiles.mode, tiles.width, tiles.height, tiles.width // cols,
+                                tiles.height // rows, tile_size, format, min_zoom)
+        for i in range(rows):
+            writer.add_row(*tiles.row(i))
+        writer.finish()
+        stage.set(max_zoom=writer.max_zoom, written=writer.written, skipped=writer.skipped)
+    return writer.max_zoom
+
+
+def _check_tile_size(tile_size):
+    if tile_size < 2 or tile_size % 2:
+        raise ValueError("`tile_size` must be an even number of pixels")
+
+
+class _PyramidWriter(object):
+    # Receives the mosaic a row of upstream tiles at a time, and writes out each level's tiles a
+    # strip (a row of output tiles) at a time.
+
+    def __init__(self, outdir, mode, width, height, cellwidth, cellheight, tile_size, format, min_zoom):
+        self.outdir = outdir
+        self.mode = mode
+        self.width, self.height = width, height
+        self.cellwidth, self.cellheight = cellwidth, cellheight
+        self.cols = width // cellwidth
+        self.tile_size = tile_size
+        self.ext = format.lower()
+        self.max_zoom = max(0, int(math.ceil(math.log2(max(width, height) / tile_size))))
+        if not 0 <= min_zoom <= self.max_zoom:
+            raise ValueError("`min_zoom` must be between 0 and {}".format(self.max_zoom))
+        self.min_zoom = min_zoom
+        self.written = 0
+        self.skipped = 0
+        self._present = []
+        self._rows = None
+        self._halves = {zoom: [] for zoom in range(min_zoom, self.max_zoom)}
+        self._strips = {zoom: 0 for zoom in range(min_zoom, self.max_zoom + 1)}
+
+    def add_row(self, pixels, present):
+        self._present.append(np.array(present))
+        rows = pixels if self._rows is None else np.concatenate((self._rows, pixels))
+        while len(rows) >= self.tile_size:
+            self._strip(self.max_zoom, self._image(rows[:self.tile_size]))
+            rows = rows[self.tile_size:]
+        # only the leftover rows are kept, copied out of the upstream row they came from
+        self._rows = np.array(rows) if len(rows) else None
+
+    def empty_row(self):
+        return TileArray(1, self.cols, self.cellwidth, self.cellheight, self.mode).row(0)
+
+    def finish(self):
+        if self._rows is not None:
+            self._strip(self.max_zoom, self._image(self._rows))
+            self._rows = None
+        for zoom in range(self.max_zoom - 1, self.min_zoom - 1, -1):
+            if self._halves[zoom]:
+                self._strip(zoom, self._halves[zoom].pop())
+
+    def _image(self, pixels):
+        return Image.fromarray(pixels[..., 0] if self.mode == 'L' else pixels, self.mode)
+
+    def _strip(self, zoom, strip):
+        row = self._strips[zoom]
+        self._strips[zoom] += 1
+        self._write_tiles(zoom, row, strip)
+        if zoom == self.min_zoom:
+            return
+
+        halves = self._halves[zoom - 1]
+        halves.append(strip.reduce(2))
+        if len(halves) == 2:
+            top, bottom = halves
+            joined = Image.new(self.mode, (top.width, top.height + bottom.height))
+            joined.paste(top, (0, 0))
+            joined.paste(bottom, (0, top.height))
+            del halves[:]
+            self._strip(zoom - 1, joined)
+
+    def _write_tiles(self, zoom, row, strip):
+        size = self.tile_size
+        span = size << (self.max_zoom - zoom)
+        for col in range(int(math.ceil(strip.width / size))):
+            if not self._covers(col * span, row * span, (col + 1) * span, (row + 1) * span):
+                self.skipped += 1
+                continue
+            tile = strip.crop((col * size, 0, (col + 1) * size, size))
+            if _empty(tile):
+                self.skipped += 1
+                continue
+            tiledir = os.path.join(self.outdir, str(zoom), str(col))
+            os.makedirs(tiledir, exist_ok=True)
+            tile.save(os.path.join(tiledir, '{}.{}'.format(row, self.ext)))
+            self.written += 1
+
+    def _covers(self, left, top, right, bottom):
+        # whether the pixel box overlaps any upstream tile that is present
+        c0, c1 = left // self.cellwidth, -(-min(right, self.width) // self.cellwidth)
+        r0, r1 = top // self.cellheight, -(-min(bottom, self.height) // self.cellheight)
+        return any(present[c0:c1].any() for present in self._present[r0:r1])
+
+
+def _empty(tile):
+    # all black, or fully transparent
+    if 'A' in tile.getbands():
+        return tile.getchannel('A').getbbox() is None
+    return tile.getbbox() is None
@@ -1,9 +1,25 @@
-from itertools import product as cartesian_product
-
-import grequests
-
-from .core import stitch, overlay
+import asyncio
+import functools
+import json
+import os
+import threading
+import time
+import warnings
+from collections import namedtuple
+from datetime import datetime, timedelta
+from itertools import chain, product as cartesian_product
+
+import numpy as np
+from PIL import Image
+
+from . import trace
+from .animate import frame_times, render_frames
+from .cache import MemoryCache, image_nbytes, update_json
+from .catalogue import ScanCatalogue
+from .core import stitch, stitch_layers, composite_into, Layer, StitchException, TileCrop
+from .fetch import default_fetcher, run_sync
 from .postprocess import CIRAPostProcessor
+from .watch import MosaicWatcher
 
 PARENT_URL = 'http://rammb-slider.cira.colostate.edu/data'
 
@@ -17,40 +33,295 @@ _valid_sectors = {
 }
 
 
+def _check_sat(sat, sector=None):
+    if sat not in _valid_sectors:
+        raise ValueError("Sat argument must be one of ({})".format(','.join((_sat_himawari, _sat_goes16))))
+    if sector is not None and sector not in _valid_sectors[sat]:
+        raise ValueError("Invalid sector: {} for satellite: {}".format(sector, sat))
+
+
+def _overlay_names(boundaries, latlon):
+    return tuple(layer for layer, wanted in (('map', boundaries), ('lat', latlon)) if wanted)
+
+
 def himawari(timestamp, zoom, product, rangex, rangey,
-             sector='full_disk', boundaries=True, latlon=False, crop=None):
+             sector='full_disk', boundaries=True, latlon=False, crop=None, window=None, snap=None):
+    if snap is not None:
+        timestamp = scan_catalogue(_sat_himawari, product, sector).snap(timestamp, snap)
     return _get_satellite_img(_sat_himawari, timestamp, zoom, product, rangex, rangey,
-                              sector, boundaries, latlon, crop)
+                              sector, boundaries, latlon, crop, window)
 
 
 def goes16(timestamp, zoom, product, rangex, rangey,
-           sector='full_disk', boundaries=True, latlon=False, crop=None):
+           sector='full_disk', boundaries=True, latlon=False, crop=None, window=None, snap=None):
+    if snap is not None:
+        timestamp = scan_catalogue(_sat_goes16, product, sector).snap(timestamp, snap)
     return _get_satellite_img(_sat_goes16, timestamp, zoom, product, rangex, rangey,
-                              sector, boundaries, latlon, crop)
+                              sector, boundaries, latlon, crop, window)
+
+
+def frames(start, end, step, zoom, product, rangex, rangey, sat=_sat_himawari, sector='full_disk',
+           boundaries=True, latlon=False, crop=None, window=None, concurrency=3):
+    """
+    Render a sequence of frames from `start` to `end`, `step` apart, yielding a
+    CIRAPostProcessor per frame in time order. Up to `concurrency` frames are fetched at once,
+    and all frames share a single overlay composite.
+    """
+    _check_sat(sat, sector)
+
+    overlay_names = _overlay_names(boundaries, latlon)
+    if overlay_names:
+        if crop:
+            tile_crop = TileCrop(rangex, rangey, crop)
+            overlay_layers(sat, zoom, sector, tile_crop.rangex, tile_crop.rangey, overlay_names, window=window)
+        else:
+            overlay_layers(sat, zoom, sector, rangex, rangey, overlay_names, window=window)
+
+    def render(timestamp):
+        return _get_satellite_img(sat, timestamp, zoom, product, rangex, rangey, sector,
+                                  boundaries, latlon, crop, window)
+
+    return render_frames(render, frame_times(start, end, step), concurrency)
+
+
+Channel = namedtuple('Channel', ['bands', 'expr', 'low', 'high', 'gamma'])
+Channel.__new__.__defaults__ = (None, 0, 255, 1.0)
+
+
+def composite(sat, timestamp, zoom, channels, rangex, rangey, sector='full_disk', boundaries=True,
+              latlon=False, crop=None, window=None):
+    """
+    Render an RGB composite of several products in one pass. `channels` holds the red, green
+    and blue `Channel`: the product(s) it reads (`bands`, a product name or band number, or a
+    tuple of them), an `expr` combining their 0-255 brightness arrays positionally (required
+    when reading more than one product), and the `low`..`high` range of the result stretched
+    over 0-255, clipped, then raised to 1/`gamma`.
+
+        rammb_slider.composite('himawari', timestamp, 3, (
+            Channel((8, 10), lambda b08, b10: b08 - b10, -40, 40),
+            Channel((13, 12), lambda b13, b12: b13 - b12, -20, 60),
+            Channel(8, low=255, high=0)), range(2, 5), range(2, 4))
+
+    The tiles of every product, and of any overlays not already cached, are fetched in a single
+    fetch phase, and the channels are evaluated over whole NumPy arrays.
+    """
+    _check_sat(sat)
+    if len(channels) != 3:
+        raise ValueError("A composite takes exactly three channels: red, green and blue")
+    channels = [_composite_channel(channel) for channel in channels]
+    products = sorted(set(chain.from_iterable(channel.bands for channel in channels)))
+
+    with trace.span('render', source='rammb_slider', sat=sat, product=products, timestamp=timestamp) as stage:
+        tile_crop = TileCrop(rangex, rangey, crop) if crop else None
+        if tile_crop is not None:
+            rangex, rangey = tile_crop.rangex, tile_crop.rangey
+        layers = {}
+        for product in products:
+            urls, exact_timestamp = _satellite_urls(sat, timestamp, zoom, product, sector, rangex, rangey)
+            layers[product] = _imagery_layer(urls, 'L', sat, sector, zoom, product)
+
+        overlay_names = _overlay_names(boundaries, latlon)
+        imgs, overlays = _stitch_with_overlays(layers, sat, zoom, sector, rangex, rangey,
+                                               overlay_names, stage, window)
+        with trace.span('bandmath', products=products):
+            sat_img = _evaluate_channels(channels, {product: imgs[product] for product in products})
+            sat_img.info.update(imgs[products[0]].info)
+        if overlays is not None:
+            sat_img = composite_into(sat_img, overlays)
+
+        postprocessor = CIRAPostProcessor(sat_img, 'composite', exact_timestamp)
+        if tile_crop is not None:
+            postprocessor.crop(*tile_crop.box(sat_img))
+        return postprocessor
+
+
+def _composite_channel(channel):
+    bands = channel.bands if isinstance(channel.bands, (tuple, list)) else (channel.bands,)
+    if not bands:
+        raise ValueError("A channel must read at least one product")
+    if channel.expr is None and len(bands) > 1:
+        raise ValueError("A channel reading more than one product needs an `expr` combining them")
+    if channel.low == channel.high:
+        raise ValueError("A channel's `low` and `high` must differ")
+    if channel.gamma <= 0:
+        raise ValueError("A channel's `gamma` must be positive")
+    return channel._replace(bands=tuple(_product_name(band) for band in bands))
+
+
+def _evaluate_channels(channels, band_imgs):
+    sizes = {img.size for img in band_imgs.values()}
+    if len(sizes) > 1:
+        raise StitchException("The products of a composite stitched to different sizes: {}. "
+                              "Some of their tiles are likely missing.".format(sorted(sizes)))
+    arrays = {product: np.asarray(img, dtype=np.float32) for product, img in band_imgs.items()}
+
+    planes = []
+    for channel in channels:
+        inputs = [arrays[band] for band in channel.bands]
+        values = inputs[0] if channel.expr is None else channel.expr(*inputs)
+        scaled = np.subtract(values, channel.low, dtype=np.float32)
+        scaled /= channel.high - channel.low
+        np.clip(scaled, 0, 1, out=scaled)
+        if channel.gamma != 1:
+            np.power(scaled, 1.0 / channel.gamma, out=scaled)
+        scaled *= 255
+        scaled += 0.5
+        planes.append(np.broadcast_to(scaled, inputs[0].shape).astype(np.uint8))
+    return Image.fromarray(np.dstack(planes), 'RGB')
+
+
+def _imagery_layer(urls, mode, sat, sector, zoom, product):
+    # bands 7 and up are infrared
+    infrared = product.startswith('band_') and int(product[5:]) >= 7
+    return Layer(urls, mode, grid=(PARENT_URL, sat, sector, zoom), learn_blanks=infrared)
+
+
+def _product_name(product):
+    if isinstance(product, int):
+        return 'band_{}'.format(str(product).zfill(2))
+    return product
 
 
 def _get_satellite_img(sat, timestamp, zoom, product, rangex, rangey, sector,
-                       boundaries, latlon, crop):
-    if isinstance(product, int):
-        product = 'band_{}'.format(str(product).zfill(2))
-    sat_img, exact_timestamp = just_satellite(sat, timestamp, zoom, product, sector, rangex, rangey)
+                       boundaries, latlon, crop, window=None):
+    with trace.span('render', source='rammb_slider', sat=sat, product=product, timestamp=timestamp) as stage:
+        product = _product_name(product)
+        tile_crop = TileCrop(rangex, rangey, crop) if crop else None
+        if tile_crop is not None:
+            rangex, rangey = tile_crop.rangex, tile_crop.rangey
+        sat_urls, exact_timestamp = _satellite_urls(sat, timestamp, zoom, product, sector, rangex, rangey)
+
+        overlay_names = _overlay_names(boundaries, latlon)
+        layers = {'sat': _imagery_layer(sat_urls, 'RGB', sat, sector, zoom, product)}
+        imgs, composite = _stitch_with_overlays(layers, sat, zoom, sector, rangex, rangey, overlay_names,
+                                                stage, window)
+        sat_img = imgs['sat']
+        if composite is not None:
+            sat_img = composite_into(sat_img, composite)
+
+        postprocessor = CIRAPostProcessor(sat_img, product, exact_timestamp)
+        if tile_crop is not None:
+            postprocessor.crop(*tile_crop.box(sat_img))
+        return postprocessor
+
+
+def _stitch_with_overlays(layers, sat, zoom, sector, rangex, rangey, overlay_names, stage, window):
+    # submit the imagery and any overlay layers not already cached in a single fetch phase
+    overlay_key = _overlay_key(sat, zoom, sector, rangex, rangey, overlay_names)
+    composite = _overlay_cache.get(overlay_key) if overlay_names else None
+    stage.set(overlays_cached=composite is not None)
+
+    if overlay_names and composite is None:
+        layers = dict(layers, **_overlay_layer_specs(sat, zoom, sector, rangex, rangey, overlay_names))
+    imgs = stitch_layers(layers, window=window)
+    if overlay_names and composite is None:
+        composite = _merge_overlays(overlay_key, [imgs[name] for name in overlay_names])
+    return imgs, composite
+
+
+class ScanWatcher(object):
+    """
+    Follows the latest scans of a region as they become available. Starting from the scan at
+    `start`, each `poll()` checks for the next scans, `step` apart, with one HEAD request each,
+    and renders the latest one available into the previous mosaic (see
+    `stitch.watch.MosaicWatcher`), writing only the tiles that differ from the previous scan's.
+    When there is no new scan, the current one's tiles are revalidated with conditional
+    requests, and it is only rendered again if some changed.
+
+    `poll()` returns a CIRAPostProcessor, or None when nothing changed; `watch()` polls every
+    `interval` seconds and yields each new frame. Probing a GOES-16 scan takes 60 requests, so
+    one not found is only looked for again after `retry` seconds.
+    """
+
+    def __init__(self, sat, start, zoom, product, rangex, rangey, sector='full_disk', boundaries=True,
+                 latlon=False, step=timedelta(minutes=10), retry=120):
+        _check_sat(sat, sector)
+        self.sat = sat
+        self.zoom = zoom
+        self.product = _product_name(product)
+        self.rangex, self.rangey = list(rangex), list(rangey)
+        self.sector = sector
+        self.overlay_names = _overlay_names(boundaries, latlon)
+        self.step = step
+        self.retry = retry
+        self.timestamp = None
+        self._next = start
+        self._retry_at = {}
+        self._mosaic = MosaicWatcher('RGB')
+
+    def poll(self):
+        latest = None
+        while self._available(self._next):
+            latest = self._next
+            self._next += self.step
+        if latest is None and self.timestamp is None:
+            return None
+
+        timestamp = self.timestamp if latest is None else latest
+        with trace.span('render', source='rammb_slider', sat=self.sat, product=self.product,
+                        timestamp=timestamp, watch=True) as stage:
+            sat_urls, exact_timestamp = _satellite_urls(self.sat, timestamp, self.zoom, self.product, self.sector,
+                                                        self.rangex, self.rangey)
+            changed = self._mosaic.update(sat_urls)
+            stage.set(changed=len(changed))
+            self.timestamp = timestamp
+            if latest is None and not changed:
+                return None
+
+            sat_img = self._mosaic.image()
+            if self.overlay_names:
+                sat_img = composite_into(sat_img, overlay_layers(self.sat, self.zoom, self.sector, self.rangex,
+                                                                 self.rangey, self.overlay_names))
+            return CIRAPostProcessor(sat_img, self.product, exact_timestamp)
+
+    def watch(self, interval=60):
+        while True:
+            frame = self.poll()
+            if frame is not None:
+                yield frame
+            time.sleep(interval)
+
+    def _available(self, timestamp):
+        if timestamp > datetime.utcnow():
+            return False
+        if self.sat == _sat_goes16:
+            if self._retry_at.get(timestamp, 0) > time.time():
+                return False
+            if _scan_seconds.available(self.sat, self.sector, timestamp, self.zoom, self.product):
+                return True
+            self._retry_at = {timestamp: time.time() + self.retry}
+            return False
+        url = _rammb_img_url(timestamp, self.product, self.zoom, self.sector, self.rangex[0], self.rangey[0],
+                             self.sat)
+        resp = run_sync(default_fetcher().head(url))
+        return resp is not None and resp.status_code == 200
+
+
+def tile_layers(sat, timestamp, zoom, product, rangex, rangey, sector='full_disk', boundaries=True,
+                latlon=False, crop=None):
+    """
+    The tile layers, by name, that rendering these arguments downloads, without downloading them.
+    """
+    _check_sat(sat)
+    product = _product_name(product)
+    if crop:
+        tile_crop = TileCrop(rangex, rangey, crop)
+        rangex, rangey = tile_crop.rangex, tile_crop.rangey
+    sat_urls, _ = _satellite_urls(sat, timestamp, zoom, product, sector, rangex, rangey)
 
-    if boundaries:
-        map_bg = map_boundaries(sat, zoom, sector, rangex, rangey)
-        sat_img = overlay(sat_img, map_bg)
-    if latlon:
-        latlon_bg = latlons(sat, zoom, sector, rangex, rangey)
-        sat_img = overlay(sat_img, latlon_bg)
+    layers = {'sat': _imagery_layer(sat_urls, 'RGB', sat, sector, zoom, product)}
+    overlay_names = _overlay_names(boundaries, latlon)
+    layers.update(_overlay_layer_specs(sat, zoom, sector, rangex, rangey, overlay_names))
+    return layers
 
-    postprocessor = CIRAPostProcessor(sat_img, product, exact_timestamp)
-    if crop:
-        postprocessor.crop_relative(*crop)
-    return postprocessor
 
+def just_satellite(sat, timestamp, zoom, product, sector, rangex, rangey, window=None):
+    sat_urls, timestamp = _satellite_urls(sat, timestamp, zoom, product, sector, rangex, rangey)
+    return stitch(sat_urls, 'RGB', window=window), timestamp
 
-def just_satellite(sat, timestamp, zoom, product, sector, rangex, rangey):
-    if sector not in _valid_sectors[sat]:
-        raise ValueError("Invalid sector: {} for satellite: {}".format(sector, sat))
+
+def _satellite_urls(sat, timestamp, zoom, product, sector, rangex, rangey):
+    _check_sat(sat, sector)
 
     seconds = 0
     # HACK: the seconds value of GOES-16 imagery does not remain constant.
@@ -60,28 +331,64 @@ def just_satellite(sat, timestamp, zoom, product, sector, rangex, rangey):
 
     sat_urls = {(x, y): _rammb_img_url(timestamp, product, zoom, sector, x, y, sat, seconds)
                 for x, y in cartesian_product(rangex, rangey)}
-    return stitch(sat_urls, 'RGB'), timestamp
+    return sat_urls, timestamp
 
 
-def map_boundaries(sat, zoom, sector, rangex, rangey):
+def map_boundaries(sat, zoom, sector, rangex, rangey, window=None):
     bg_map_urls = {(x, y): _map_or_latlon_url(x, y, zoom, 'map', sat, sector)
                    for x, y in cartesian_product(rangex, rangey)}
-    return stitch(bg_map_urls, 'RGBA')
+    return stitch(bg_map_urls, 'RGBA', static=True, window=window)
 
 
-def latlons(sat, zoom, sector, rangex, rangey):
+def latlons(sat, zoom, sector, rangex, rangey, window=None):
     bg_map_urls = {(x, y): _map_or_latlon_url(x, y, zoom, 'lat', sat, sector)
                    for x, y in cartesian_product(rangex, rangey)}
-    return stitch(bg_map_urls, 'RGBA')
+    return stitch(bg_map_urls, 'RGBA', static=True, window=window)
+
+
+_overlay_cache = MemoryCache(max_bytes=256 * 1024 * 1024)
+
+
+def overlay_layers(sat, zoom, sector, rangex, rangey, layers=('map', 'lat'), window=None):
+    key = _overlay_key(sat, zoom, sector, rangex, rangey, layers)
+    composite = _overlay_cache.get(key)
+    if composite is None:
+        imgs = stitch_layers(_overlay_layer_specs(sat, zoom, sector, rangex, rangey, layers), window=window)
+        composite = _merge_overlays(key, [imgs[layer] for layer in layers])
+    return composite
+
+
+def _overlay_key(sat, zoom, sector, rangex, rangey, layers):
+    return sat, sector, zoom, tuple(rangex), tuple(rangey), tuple(layers)
+
+
+def _overlay_layer_specs(sat, zoom, sector, rangex, rangey, layers):
+    specs = {}
+    for layer in layers:
+        if layer not in ('map', 'lat'):
+            raise ValueError("Overlay layer must be one of (map,lat)")
+        urls = {(x, y): _map_or_latlon_url(x, y, zoom, layer, sat, sector)
+                for x, y in cartesian_product(rangex, rangey)}
+        specs[layer] = Layer(urls, 'RGBA', static=True, grid=(PARENT_URL, sat, sector, zoom, layer),
+                             learn_blanks=True)
+    return specs
+
+
+def _merge_overlays(key, layer_imgs):
+    composite = layer_imgs[0]
+    for layer_img in layer_imgs[1:]:
+        composite.alpha_composite(layer_img)
+    _overlay_cache.put(key, composite, image_nbytes(composite))
+    return composite
+
+
+def clear_overlay_cache():
+    _overlay_cache.clear()
 
 
 def _rammb_img_url(timestamp, product, zoom, sector, xtile, ytile, sat, seconds=0):
-    if sat == _sat_himawari:
-        imgtype = 'himawari---{}'.format(sector)
-    elif sat == _sat_goes16:
-        imgtype = 'goes-16---{}'.format(sector)
-    else:
-        raise ValueError("Sat argument must be one of ({})".format(','.join((_sat_himawari, _sat_goes16))))
+    _check_sat(sat)
+    imgtype = '{}---{}'.format(sat, sector)
 
     datestr = timestamp.strftime('%Y%m%d')
     zoomstr = str(zoom).zfill(2)
@@ -105,12 +412,11 @@ _random_date_str_himawari = {
 
 
 def _map_or_latlon_url(x, y, zoom, map_or_lat, sat, sector):
+    _check_sat(sat)
     if sat == _sat_himawari:
         some_date_str = _random_date_str_himawari[sector]
-    elif sat == _sat_goes16:
-        some_date_str = _random_date_str_goes16[sector]
     else:
-        raise ValueError("Sat argument must be one of ({})".format(','.join((_sat_himawari, _sat_goes16))))
+        some_date_str = _random_date_str_goes16[sector]
 
     pos = '{}_{}'.format(str(y).zfill(3), str(x).zfill(3))
     return PARENT_URL + '/{type}/{sat}/{sector}/white/' \
@@ -121,27 +427,145 @@ def _map_or_latlon_url(x, y, zoom, map_or_lat, sat, sector):
 
 
 def _goes16_seconds_hack(sat, timestamp, zoom, product, sector):
-    seconds = 0
+    return _scan_seconds.resolve(sat, sector, timestamp, zoom, product)
+
+
+class ScanSecondsResolver(object):
+    """
+    Resolves the seconds value of a GOES-16 scan timestamp, which does not remain constant.
+
+    All 60 candidate seconds are probed with HEAD requests for tile (0, 0) in a single
+    concurrent round. The answer is memoized per (sat, sector, scan minute) -- the seconds are
+    shared by every product and zoom of the same scan -- and, if `path` is given, persisted
+    there as JSON so it survives across processes.
+    """
+
+    _by_likelihood = tuple(chain(range(35, 40), range(30, 35), range(20, 25), range(25, 30),
+                                 range(0, 20), range(40, 60)))
+
+    def __init__(self, path=None):
+        self.path = path
+        self._index = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self._index = json.load(f)
+
+    def resolve(self, sat, sector, timestamp, zoom, product):
+        seconds = self._resolve(sat, sector, timestamp, zoom, product)
+        return 0 if seconds is None else seconds
+
+    def available(self, sat, sector, timestamp, zoom, product):
+        return self._resolve(sat, sector, timestamp, zoom, product) is not None
+
+    def _resolve(self, sat, sector, timestamp, zoom, product, round_size=None):
+        key = self._key(sat, sector, timestamp)
+        with self._lock:
+            if key in self._index:
+                return self._index[key]
+
+        with trace.span('scan_seconds', sat=sat, sector=sector, timestamp=timestamp) as stage:
+            seconds = self._probe(sat, sector, timestamp, zoom, product, round_size)
+            stage.set(seconds=seconds)
+        if seconds is None:
+            # not memoized: the scan may simply not be available yet
+            return None
+
+        with self._lock:
+            self._index[key] = seconds
+            if self.path is not None:
+                self._save()
+        return seconds
+
+    def clear(self):
+        with self._lock:
+            self._index.clear()
+            if self.path is not None:
+                update_json(self.path, lambda saved: {})
+
+    def _probe(self, sat, sector, timestamp, zoom, product, round_size=None):
+        # every candidate in one round, or rounds of `round_size` from the most likely on, until one is found
+        size = round_size or len(self._by_likelihood)
+        for i in range(0, len(self._by_likelihood), size):
+            candidates = self._by_likelihood[i:i + size]
+            urls = [_rammb_img_url(timestamp, product, zoom, sector, 0, 0, sat, candidate_sec)
+                    for candidate_sec in candidates]
+            resps = run_sync(_head_all(urls))
+            successes = [candidate_sec for candidate_sec, resp in zip(candidates, resps)
+                         if resp is not None and resp.status_code == 200]
+            if len(successes) > 1:
+                warnings.warn("Found more than one successful response, something seems to be wonky."
+                              "Assume seconds corresponds with most likely successful response.")
+            if successes:
+                return successes[0]
+        return None
 
-    def successful_seconds(candidates):
-        url_sec_map = {_rammb_img_url(timestamp, product, zoom, sector, 0, 0, sat, candidate_sec): candidate_sec
-                       for candidate_sec in candidates}
+    def _key(self, sat, sector, timestamp):
+        return '{}/{}/{}'.format(sat, sector, timestamp.strftime('%Y%m%d%H%M'))
 
-        reqs = (grequests.get(url) for url in url_sec_map.keys())
-        resps = grequests.map(reqs, stream=True)
-        return [url_sec_map[resp.url] for resp in resps if resp is not None and resp.status_code == 200]
+    def _save(self):
+        def merged(saved):
+            # keep what other processes sharing the file resolved in the meantime
+            self._index = dict(saved or {}, **self._index)
+            return self._index
 
-    ordered_by_likelihood = [range(35, 40), range(30, 35), range(20, 25), range(25, 30),
-                             range(0, 20), range(40, 60)]
-    for second_candidates in ordered_by_likelihood:
-        successes = successful_seconds(second_candidates)
+        update_json(self.path, merged)
+
+
+async def _head_all(urls):
+    fetcher = default_fetcher()
+    return await asyncio.gather(*(fetcher.head(url) for url in urls))
 
-        if successes:
-            if len(successes) > 1:
-                import warnings
-                warnings.warn("Found more than one successful response, something seems to be wonky."
-                              "Assume seconds corresponds with first successful response.")
-            seconds = successes[0]
-            break
 
-    return seconds
\ No newline at end of file
+_scan_seconds = ScanSecondsResolver()
+
+
+def set_scan_seconds_index(path):
+    """
+    Persist resolved GOES-16 scan seconds to the JSON file at `path` (None keeps them in memory only).
+    """
+    global _scan_seconds
+    _scan_seconds = ScanSecondsResolver(path)
+
+
+# nominal scan slots per sector: GOES-16 scans the full disk every 15 or 10 minutes depending
+# on its scan mode, and the CONUS every 5 minutes from 2 past the hour
+_scan_slots = {
+    (_sat_himawari, 'full_disk'): (timedelta(minutes=10), timedelta(0)),
+    (_sat_himawari, 'japan'): (timedelta(seconds=150), timedelta(0)),
+    (_sat_goes16, 'full_disk'): (timedelta(minutes=5), timedelta(0)),
+    (_sat_goes16, 'conus'): (timedelta(minutes=5), timedelta(minutes=2)),
+}
+
+_catalogues = {}
+_catalogues_lock = threading.Lock()
+
+# candidate seconds a catalogue probes at once for a GOES-16 scan
+_probe_round = 10
+
+
+def scan_catalogue(sat, product, sector='full_disk'):
+    """
+    The process-wide `ScanCatalogue` of a product's scans, filled by HEAD requests for tile
+    (0, 0) at zoom 0 -- for GOES-16, by resolving the scan's seconds.
+
+        scan_catalogue('goes-16', 13).nearest(datetime.utcnow() - timedelta(hours=1))
+    """
+    _check_sat(sat, sector)
+    key = (sat, _product_name(product), sector)
+    with _catalogues_lock:
+        if key not in _catalogues:
+            step, offset = _scan_slots[(sat, sector)]
+            _catalogues[key] = ScanCatalogue(functools.partial(_probe_scan, *key), step, offset,
+                                              name='{} {} scan'.format(*key[:2]))
+        return _catalogues[key]
+
+
+async def _probe_scan(sat, product, sector, slot):
+    if sat == _sat_goes16:
+        # the resolver blocks on its own requests, a few likely seconds at a time
+        seconds = await asyncio.get_running_loop().run_in_executor(
+            None, _scan_seconds._resolve, sat, sector, slot, 0, product, _probe_round)
+        return None if seconds is None else slot.replace(second=seconds)
+    resp = await default_fetcher().head(_rammb_img_url(slot, product, 0, sector, 0, 0, sat))
+    return slot if resp is not None and resp.status_code == 200 else None
@@ -1,3 +1,4 @@
+import io
 import math
 import operator
 import os
@@ -44,6 +45,12 @@ def image_equivalence_test(test_func):
     return new_test_func
 
 
+def png(color=(10, 80, 160), mode='RGB'):
+    buf = io.BytesIO()
+    Image.new(mode, (10, 10), color).save(buf, 'PNG')
+    return buf.getvalue()
+
+
 def open_image(file):
     return Image.open(path_of_test_resource(file), 'r')
 
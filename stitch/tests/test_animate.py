@@ -0,0 +1,54 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from PIL import Image
+
+from stitch.animate import save_animation, frame_times, render_frames
+from stitch.postprocess import PostProcessor
+
+
+def _frames(n, size=(64, 48)):
+    for i in range(n):
+        im = Image.new('RGB', size, (i * 40, 255 - i * 40, i * 10))
+        im.paste((0, 0, 255), (5 * i, 5, 5 * i + 10, 15))
+        yield PostProcessor(im, datetime(2017, 8, 6, 0, 10 * i))
+
+
+@pytest.mark.parametrize('filename', ['loop.gif', 'loop.png'])
+def test_save_animation(tmpdir, filename):
+    path = str(tmpdir.join(filename))
+    assert save_animation(_frames(4), path, duration=200) == 4
+
+    anim = Image.open(path)
+    assert anim.n_frames == 4
+    assert anim.info['duration'] == 200
+    for i, expected in enumerate(_frames(4)):
+        anim.seek(i)
+        assert anim.convert('RGB').tobytes() == expected.result().tobytes()
+
+
+def test_save_animation_mismatched_frames(tmpdir):
+    frames = list(_frames(1)) + list(_frames(1, size=(32, 32)))
+    with pytest.raises(ValueError):
+        save_animation(frames, str(tmpdir.join('bad.gif')))
+
+
+def test_save_animation_unknown_format(tmpdir):
+    with pytest.raises(ValueError):
+        save_animation(_frames(1), str(tmpdir.join('loop.mp4')))
+
+
+def test_frame_times():
+    times = list(frame_times(datetime(2017, 8, 6, 0, 0), datetime(2017, 8, 6, 0, 30), timedelta(minutes=10)))
+    assert times == [datetime(2017, 8, 6, 0, minute) for minute in (0, 10, 20, 30)]
+
+
+def test_render_frames_ordered_and_concurrent():
+    def render(i):
+        time.sleep(0.05 * (3 - i % 3))
+        return i
+
+    started = time.time()
+    assert list(render_frames(render, range(6), concurrency=3)) == list(range(6))
+    assert time.time() - started < 0.6
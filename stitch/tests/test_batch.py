@@ -0,0 +1,119 @@
+import multiprocessing
+import sys
+from datetime import datetime
+
+import pytest
+from PIL import Image
+
+from stitch import batch, core, rammb_slider
+from stitch.cache import TileCache
+from stitch.fetch import TileFetcher, set_default_fetcher
+from stitch.tests._common import png
+
+if sys.version_info >= (3, 0):
+    from unittest.mock import MagicMock, patch
+else:
+    from mock import MagicMock, patch
+
+
+class _TileFetcher(TileFetcher):
+    def __init__(self):
+        super(_TileFetcher, self).__init__()
+        self.requested = []
+
+    async def get(self, url, headers=None):
+        self.requested.append(url)
+        content = png((255, 255, 255, 100), 'RGBA') if '/map/' in url else png((10, 80, 160))
+        return MagicMock(status_code=200, content=content)
+
+
+def _job(**kwargs):
+    job = {'source': 'rammb_slider', 'sat': 'himawari', 'product': 13, 'timestamp': '2017-08-06T00:00',
+           'zoom': 3, 'rangex': [2, 5], 'rangey': [2, 4]}
+    job.update(kwargs)
+    return job
+
+
+def test_prefetch_dedups_tiles_across_jobs(tmpdir):
+    fetcher = _TileFetcher()
+    core.set_tile_cache(TileCache(str(tmpdir)))
+    set_default_fetcher(fetcher)
+    try:
+        layers = list(rammb_slider.tile_layers('himawari', datetime(2017, 8, 6, 0, 0), 3, 13,
+                                               range(2, 5), range(2, 4)).values())
+        layers += list(rammb_slider.tile_layers('himawari', datetime(2017, 8, 6, 0, 10), 3, 13,
+                                                range(2, 5), range(2, 4)).values())
+        assert core.prefetch(layers) == 18
+        assert core.prefetch(layers) == 18
+    finally:
+        core.set_tile_cache(None)
+        set_default_fetcher(None)
+
+    # the map overlay is shared by both timestamps, and nothing is fetched twice
+    assert len(fetcher.requested) == len(set(fetcher.requested)) == 18
+
+
+def test_render_job_applies_steps_and_saves(tmpdir):
+    fetcher = _TileFetcher()
+    core.set_tile_cache(TileCache(str(tmpdir.join('cache'))))
+    set_default_fetcher(fetcher)
+    output = str(tmpdir.join('out', 'frame.png'))
+    try:
+        result = batch._render_job(_job(crop=[0, 0, 0.5, 1], output=output,
+                                        postprocess=[['scale', 2], ['apply_filter', 'SHARPEN'], 'logo']))
+    finally:
+        core.set_tile_cache(None)
+        set_default_fetcher(None)
+
+    assert result == (output, None)
+    assert Image.open(output).size == (30, 40)
+    # only the two columns the crop touches were fetched, for imagery and map alike
+    assert len(fetcher.requested) == 8
+
+
+def test_render_job_reports_errors():
+    output, error = batch._render_job(_job(postprocess=['rm_rf'], output='unused.png'))
+    assert output == 'unused.png'
+    assert error.startswith('ValueError')
+
+    _, error = batch._render_job(_job(source='nowhere', output='unused.png'))
+    assert 'Unknown source' in error
+
+
+def test_budgeted_fetcher_stops_at_budget():
+    remaining = multiprocessing.Value('l', 2)
+    fetcher = batch._BudgetedFetcher(remaining)
+    with patch.object(TileFetcher, '_send', return_value=MagicMock(status_code=200)) as send:
+        assert core.run_sync(fetcher.get('http://dummy.com/a.png')) is not None
+        assert core.run_sync(fetcher.get('http://dummy.com/b.png')) is not None
+        # fails straight away rather than as a response to retry
+        with pytest.raises(batch.BudgetExhausted):
+            core.run_sync(fetcher.fetch('http://dummy.com/c.png', retry=core.RetryPolicy()))
+    assert send.call_count == 2
+    assert remaining.value == 0
+    fetcher.close()
+
+
+@patch('stitch.batch.prefetch')
+def test_render_jobs_closes_its_fetcher(prefetch, tmpdir):
+    fetchers = []
+    prefetch.side_effect = lambda layers: fetchers.append(batch.default_fetcher())
+    with patch.object(batch.ProcessPoolExecutor, 'map', return_value=[]):
+        batch.render_jobs([_job()], str(tmpdir), workers=1)
+    assert fetchers[0]._executor._shutdown
+    assert not isinstance(batch.default_fetcher(), batch._BudgetedFetcher)
+
+
+def test_cli_reports_failed_jobs(tmpdir, capsys):
+    jobfile = tmpdir.join('jobs.json')
+    jobfile.write('{"workers": 1, "jobs": [{"source": "nowhere", "output": "x.png"}]}')
+    from stitch.__main__ import main
+    assert main([str(jobfile), '--cache', str(tmpdir.join('cache'))]) == 1
+    assert 'failed x.png' in capsys.readouterr().err
+
+
+def test_load_jobs_requires_jobs(tmpdir):
+    jobfile = tmpdir.join('jobs.json')
+    jobfile.write('{}')
+    with pytest.raises(ValueError):
+        batch.load_jobs(str(jobfile))
@@ -0,0 +1,45 @@
+import io
+
+from PIL import Image
+
+from stitch.buffer import TileBuffer
+from stitch.tests._common import png
+
+
+def test_spills_past_budget(tmpdir):
+    payloads = {(x, 0): bytes([x]) * 100 for x in range(4)}
+    buffer = TileBuffer(max_bytes=250, dir=str(tmpdir))
+    for key, content in payloads.items():
+        buffer.add(key, content)
+
+    assert len(buffer) == 4
+    assert buffer.memory_bytes == 200
+    assert buffer.spilled_bytes == 200
+    for key, content in payloads.items():
+        assert bytes(buffer.view(key)) == content
+        assert buffer.open(key).read() == content
+    buffer.close()
+
+
+def test_decodes_from_spilled_payloads():
+    buffer = TileBuffer(max_bytes=0)
+    buffer.add((0, 0), png((10, 20, 30)))
+    reader = buffer.open((0, 0))
+    buffer.add((1, 0), png((40, 50, 60)))
+
+    # readers opened before more payloads were spilled, or before close, stay readable
+    tiles = [Image.open(reader), Image.open(buffer.open((1, 0)))]
+    buffer.close()
+    assert [tile.getpixel((3, 3)) for tile in tiles] == [(10, 20, 30), (40, 50, 60)]
+
+
+def test_reader_seek_and_partial_reads():
+    buffer = TileBuffer()
+    buffer.add('key', b'0123456789')
+    reader = buffer.open('key')
+    assert reader.read(4) == b'0123'
+    reader.seek(-3, io.SEEK_END)
+    assert reader.read() == b'789'
+    reader.seek(2)
+    assert reader.tell() == 2
+    assert reader.read(100) == b'23456789'
@@ -0,0 +1,253 @@
+import sys
+import threading
+
+import pytest
+
+from stitch import core
+from stitch.cache import AvailabilityIndex, TileCache, MemoryCache, update_json
+from stitch.fetch import TileFetcher, set_default_fetcher
+from stitch.tests._common import png
+
+if sys.version_info >= (3, 0):
+    from unittest.mock import patch, MagicMock
+else:
+    from mock import patch, MagicMock
+
+
+def test_cache_roundtrip(tmpdir):
+    cache = TileCache(str(tmpdir))
+    assert cache.get('http://dummy.com/a.png') is None
+    cache.put('http://dummy.com/a.png', b'tile-a')
+    assert cache.get('http://dummy.com/a.png') == b'tile-a'
+
+
+def test_cache_persists_across_instances(tmpdir):
+    TileCache(str(tmpdir)).put('http://dummy.com/a.png', b'tile-a')
+    assert TileCache(str(tmpdir)).get('http://dummy.com/a.png') == b'tile-a'
+
+
+def test_cache_identical_payloads_stored_once(tmpdir):
+    cache = TileCache(str(tmpdir))
+    cache.put('http://dummy.com/a.png', b'black')
+    cache.put('http://dummy.com/b.png', b'black')
+    assert cache.size == len(b'black')
+
+
+@patch('stitch.cache.time')
+def test_cache_expiry(mocktime, tmpdir):
+    mocktime.time.return_value = 1000.0
+    cache = TileCache(str(tmpdir), ttl=60)
+    cache.put('http://dummy.com/img.png', b'img')
+    cache.put('http://dummy.com/map.png', b'map', static=True)
+
+    mocktime.time.return_value = 1030.0
+    assert cache.get('http://dummy.com/img.png') == b'img'
+
+    mocktime.time.return_value = 2000.0
+    assert cache.get('http://dummy.com/img.png') is None
+    assert cache.get('http://dummy.com/map.png') == b'map'
+
+
+@patch('stitch.cache.time')
+def test_cache_lru_eviction(mocktime, tmpdir):
+    mocktime.time.return_value = 1.0
+    cache = TileCache(str(tmpdir), max_bytes=10)
+    cache.put('http://dummy.com/a.png', b'aaaa')
+    mocktime.time.return_value = 2.0
+    cache.put('http://dummy.com/b.png', b'bbbb')
+    mocktime.time.return_value = 3.0
+    cache.get('http://dummy.com/a.png')
+    mocktime.time.return_value = 4.0
+    cache.put('http://dummy.com/c.png', b'cccc')
+
+    assert cache.get('http://dummy.com/b.png') is None
+    assert cache.get('http://dummy.com/a.png') == b'aaaa'
+    assert cache.get('http://dummy.com/c.png') == b'cccc'
+    assert cache.size <= 10
+
+
+def test_cache_without_eviction(tmpdir):
+    cache = TileCache(str(tmpdir), max_bytes=None)
+    for i in range(5):
+        cache.put('http://dummy.com/{}.png'.format(i), str(i).encode() * 100)
+    assert all(cache.get('http://dummy.com/{}.png'.format(i)) is not None for i in range(5))
+
+
+class _FakeFetcher(TileFetcher):
+    def __init__(self, responses):
+        super(_FakeFetcher, self).__init__()
+        self.responses = responses
+        self.requested = []
+
+    async def get(self, url, headers=None):
+        self.requested.append(url)
+        return self.responses.get(url)
+
+
+def test_load_tiles_uses_cache(tmpdir):
+    cache = TileCache(str(tmpdir))
+    cache.put('http://dummy.com/(0_0).png', b'cached')
+
+    resp = MagicMock(status_code=200, content=b'fetched')
+    fetcher = _FakeFetcher({'http://dummy.com/(0_1).png': resp})
+
+    core.set_tile_cache(cache)
+    set_default_fetcher(fetcher)
+    try:
+        tiles = core.load_tiles({(0, 0): 'http://dummy.com/(0_0).png',
+                                 (0, 1): 'http://dummy.com/(0_1).png'})
+    finally:
+        core.set_tile_cache(None)
+        set_default_fetcher(None)
+
+    assert tiles[0, 0].read() == b'cached'
+    assert tiles[0, 1].read() == b'fetched'
+    assert fetcher.requested == ['http://dummy.com/(0_1).png']
+    assert cache.get('http://dummy.com/(0_1).png') == b'fetched'
+
+
+def test_load_tiles_does_cache_io_off_the_event_loop(tmpdir):
+    class _ThreadCache(TileCache):
+        threads = []
+
+        def get(self, url):
+            self.threads.append(threading.current_thread())
+            return super(_ThreadCache, self).get(url)
+
+        def put(self, url, content, static=False):
+            self.threads.append(threading.current_thread())
+            return super(_ThreadCache, self).put(url, content, static=static)
+
+    cache = _ThreadCache(str(tmpdir))
+    fetcher = _FakeFetcher({'http://dummy.com/(0_0).png': MagicMock(status_code=200, content=b'fetched')})
+
+    core.set_tile_cache(cache)
+    set_default_fetcher(fetcher)
+    try:
+        core.load_tiles({(0, 0): 'http://dummy.com/(0_0).png'})
+    finally:
+        core.set_tile_cache(None)
+        set_default_fetcher(None)
+
+    assert len(cache.threads) == 2
+    assert threading.current_thread() not in cache.threads
+
+
+def test_memory_cache_bounded_lru():
+    cache = MemoryCache(max_bytes=10)
+    cache.put('a', 'A', 4)
+    cache.put('b', 'B', 4)
+    assert cache.get('a') == 'A'
+    cache.put('c', 'C', 4)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 'A'
+    assert cache.get('c') == 'C'
+    assert cache.size == 8
+
+    cache.put('huge', 'H', 11)
+    assert cache.get('huge') is None
+
+
+@patch('stitch.cache.time')
+def test_availability_index_missing_tiles_expire(mocktime, tmpdir):
+    mocktime.time.return_value = 1000.0
+    index = AvailabilityIndex(str(tmpdir.join('availability.json')), ttl=60)
+    index.record_missing('http://dummy.com/201708061610/0_0.png')
+    assert index.missing('http://dummy.com/201708061610/0_0.png')
+    assert not index.missing('http://dummy.com/201708061600/0_0.png')
+
+    # persisted on flush, and expired after the ttl
+    assert not tmpdir.join('availability.json').check()
+    index.flush()
+    reloaded = AvailabilityIndex(str(tmpdir.join('availability.json')), ttl=60)
+    assert reloaded.missing('http://dummy.com/201708061610/0_0.png')
+    mocktime.time.return_value = 1061.0
+    assert not reloaded.missing('http://dummy.com/201708061610/0_0.png')
+
+
+@patch('stitch.cache.time')
+def test_availability_index_confirms_blank_tiles(mocktime, tmpdir):
+    mocktime.time.return_value = 1000.0
+    index = AvailabilityIndex(str(tmpdir.join('availability.json')), confirmations=2, blank_ttl=600)
+    grid = ('src', 'full_disk', 3)
+    index.record_content(grid, 0, 0, b'black', True)
+    assert index.blank(grid, 0, 0) is None and index.needs_check(grid, 0, 0)
+    index.record_content(grid, 0, 0, b'black', True)
+    assert index.blank(grid, 0, 0) == b'black' and not index.needs_check(grid, 0, 0)
+    index.flush()
+    assert AvailabilityIndex(str(tmpdir.join('availability.json'))).blank(grid, 0, 0) == b'black'
+
+    index.record_content(grid, 1, 0, b'black', True)
+    index.record_content(grid, 1, 0, b'earth', False)
+    assert index.blank(grid, 1, 0) is None and not index.needs_check(grid, 1, 0)
+
+    # blank tiles are checked again once expired, and need confirming anew
+    mocktime.time.return_value = 1601.0
+    assert index.blank(grid, 0, 0) is None and index.needs_check(grid, 0, 0)
+    index.record_content(grid, 0, 0, b'black', True)
+    assert index.blank(grid, 0, 0) is None
+
+
+def test_stitch_skips_known_missing_and_blank_tiles():
+    black, earth = png((0, 0, 0)), png((10, 80, 160))
+    urls = {(x, 0): 'http://dummy.com/{}_0.png'.format(x) for x in range(3)}
+    fetcher = _FakeFetcher({urls[0, 0]: MagicMock(status_code=200, content=black),
+                            urls[1, 0]: MagicMock(status_code=200, content=earth),
+                            urls[2, 0]: MagicMock(status_code=404)})
+    core.set_availability_index(AvailabilityIndex(confirmations=1))
+    set_default_fetcher(fetcher)
+    try:
+        layer = core.Layer(urls, 'RGB', grid=('src', 'full_disk', 3), learn_blanks=True)
+        core.stitch_layers({'sat': layer})
+        assert sorted(fetcher.requested) == sorted(urls.values())
+
+        fetcher.requested = []
+        img = core.stitch_layers({'sat': layer._replace(learn_blanks=False)})['sat']
+    finally:
+        core.set_availability_index(None)
+        set_default_fetcher(None)
+
+    assert fetcher.requested == [urls[1, 0]]
+    assert img.size == (20, 10)
+    assert img.getpixel((5, 5)) == (0, 0, 0) and img.getpixel((15, 5)) == (10, 80, 160)
+
+
+def test_unpublished_scan_does_not_mark_other_scans_missing(tmpdir):
+    earth = png((10, 80, 160))
+    grid = ('src', 'full_disk', 3)
+    scan = {(x, 0): 'http://dummy.com/1600/{}_0.png'.format(x) for x in range(2)}
+    unpublished = {(x, 0): 'http://dummy.com/1610/{}_0.png'.format(x) for x in range(2)}
+    fetcher = _FakeFetcher(dict({url: MagicMock(status_code=200, content=earth) for url in scan.values()},
+                                **{url: MagicMock(status_code=404) for url in unpublished.values()}))
+    index = AvailabilityIndex(str(tmpdir.join('availability.json')))
+    core.set_availability_index(index)
+    set_default_fetcher(fetcher)
+    try:
+        with patch('stitch.cache.update_json', wraps=update_json) as save:
+            with pytest.raises(core.StitchException):
+                core.stitch_layers({'sat': core.Layer(unpublished, 'RGB', grid=grid)})
+            img = core.stitch_layers({'sat': core.Layer(scan, 'RGB', grid=grid)})['sat']
+    finally:
+        core.set_availability_index(None)
+        set_default_fetcher(None)
+
+    assert img.size == (20, 10)
+    assert sorted(fetcher.requested) == sorted(list(unpublished.values()) + list(scan.values()))
+    # written once per render, not once per tile
+    assert save.call_count == 1
+
+
+def test_availability_index_shared_by_processes(tmpdir):
+    path = str(tmpdir.join('availability.json'))
+    first, second = AvailabilityIndex(path), AvailabilityIndex(path)
+    first.record_missing('http://dummy.com/a.png')
+    second.record_missing('http://dummy.com/b.png')
+    second.record_content(('src', 'full_disk', 3), 0, 0, b'earth', False)
+    first.flush()
+    second.flush()
+
+    # neither overwrote the other
+    reloaded = AvailabilityIndex(path)
+    assert reloaded.missing('http://dummy.com/a.png') and reloaded.missing('http://dummy.com/b.png')
+    assert not reloaded.needs_check(('src', 'full_disk', 3), 0, 0)
@@ -0,0 +1,157 @@
+import asyncio
+import sys
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from stitch import nict_himawari, rammb_slider
+from stitch.catalogue import ScanCatalogue
+from stitch.core import StitchException
+
+if sys.version_info >= (3, 0):
+    from unittest.mock import patch
+else:
+    from mock import patch
+
+
+def _probe(scans, probes):
+    # the scan of a slot is whichever of `scans` falls within its minute
+    async def probe(slot):
+        probes.append(slot)
+        found = [scan for scan in scans if slot <= scan < slot + timedelta(minutes=1)]
+        return found[0] if found else None
+
+    return probe
+
+
+_scans = [datetime(2017, 8, 6, 0, 0, 37), datetime(2017, 8, 6, 0, 15, 38), datetime(2017, 8, 6, 0, 45, 36)]
+
+
+def test_nearest_probes_closest_slots_first_and_is_memoized():
+    probes = []
+    catalogue = ScanCatalogue(_probe(_scans, probes), timedelta(minutes=5), batch=2)
+
+    assert catalogue.nearest(datetime(2017, 8, 6, 0, 14, 10)) == datetime(2017, 8, 6, 0, 15, 38)
+    assert probes == [datetime(2017, 8, 6, 0, 15), datetime(2017, 8, 6, 0, 10)]
+
+    # a later lookup is answered by the scans already known
+    probes[:] = []
+    assert catalogue.nearest(datetime(2017, 8, 6, 0, 16)) == datetime(2017, 8, 6, 0, 15, 38)
+    assert probes == []
+
+    # none nearby: gives up past `within`
+    assert catalogue.nearest(datetime(2017, 8, 6, 0, 31), within=timedelta(minutes=5)) is None
+    assert probes == [datetime(2017, 8, 6, 0, 30), datetime(2017, 8, 6, 0, 35)]
+
+
+def test_range_and_latest():
+    probes = []
+    catalogue = ScanCatalogue(_probe(_scans, probes), timedelta(minutes=5), batch=3)
+
+    assert catalogue.range(datetime(2017, 8, 6, 0, 0), datetime(2017, 8, 6, 0, 30)) == _scans[:2]
+    probed = len(probes)
+    assert catalogue.range(datetime(2017, 8, 6, 0, 5), datetime(2017, 8, 6, 0, 20)) == _scans[1:2]
+    assert len(probes) == probed
+
+    now = datetime(2017, 8, 6, 0, 53)
+    assert catalogue.latest(within=timedelta(hours=1), now=now) == datetime(2017, 8, 6, 0, 45, 36)
+    # a single batch of the newest slots found it
+    assert probes[probed:] == [datetime(2017, 8, 6, 0, 50), datetime(2017, 8, 6, 0, 45),
+                               datetime(2017, 8, 6, 0, 40)]
+
+
+def test_range_probes_in_batches():
+    in_flight = []
+    most = []
+
+    async def probe(slot):
+        in_flight.append(slot)
+        most.append(len(in_flight))
+        await asyncio.sleep(0)
+        in_flight.remove(slot)
+        return slot if slot.minute % 10 == 0 else None
+
+    catalogue = ScanCatalogue(probe, timedelta(minutes=5), batch=3)
+    scans = catalogue.range(datetime(2017, 8, 6, 0, 0), datetime(2017, 8, 6, 2, 0))
+    assert scans == [datetime(2017, 8, 6, 0, 0) + timedelta(minutes=10 * i) for i in range(13)]
+    assert len(most) == 26 and max(most) == 3
+
+
+@patch('stitch.catalogue.time')
+def test_recent_empty_slots_probed_again(mocktime):
+    mocktime.time.return_value = 1000.0
+    probes = []
+    scans = []
+    slot = datetime.utcnow().replace(second=0, microsecond=0) - timedelta(minutes=20)
+    catalogue = ScanCatalogue(_probe(scans, probes), timedelta(minutes=10), offset=timedelta(minutes=slot.minute % 10),
+                              ttl=60)
+
+    assert catalogue.nearest(slot, within=timedelta(0)) is None
+    assert catalogue.nearest(slot, within=timedelta(0)) is None
+    assert probes == [slot]
+
+    scans.append(slot)
+    mocktime.time.return_value = 1061.0
+    assert catalogue.nearest(slot, within=timedelta(0)) == slot
+    assert probes == [slot, slot]
+
+
+@patch('stitch.rammb_slider.default_fetcher')
+def test_render_snaps_to_nearest_scan(fetcher):
+    class _Fetcher(object):
+        async def head(self, url, headers=None):
+            return SimpleNamespace(status_code=200 if '/20170806002000/' in url else 404)
+
+    fetcher.return_value = _Fetcher()
+    rammb_slider._catalogues.clear()
+    with patch('stitch.rammb_slider._get_satellite_img') as render:
+        rammb_slider.himawari(datetime(2017, 8, 6, 0, 23, 12), 3, 13, range(2, 4), range(2, 3), snap=timedelta(hours=1))
+        assert render.call_args[0][1] == datetime(2017, 8, 6, 0, 20)
+
+        with pytest.raises(StitchException):
+            rammb_slider.himawari(datetime(2017, 8, 6, 3, 0), 3, 13, range(2, 4), range(2, 3),
+                                  snap=timedelta(minutes=30))
+    rammb_slider._catalogues.clear()
+
+
+@patch('stitch.nict_himawari.default_fetcher')
+def test_nict_catalogue_probes_product_tiles(fetcher):
+    class _Fetcher(object):
+        urls = []
+
+        async def head(self, url, headers=None):
+            self.urls.append(url)
+            return SimpleNamespace(status_code=200 if '/001000_' in url else 404)
+
+    fetcher.return_value = _Fetcher()
+    nict_himawari._catalogues.clear()
+    assert nict_himawari.scan_catalogue('ir') is nict_himawari.scan_catalogue('IR')
+    assert nict_himawari.scan_catalogue('ir').nearest(datetime(2017, 8, 6, 0, 8)) == datetime(2017, 8, 6, 0, 10)
+    assert fetcher.return_value.urls[0] == (nict_himawari.BASE_URL +
+                                            '/img/INFRARED_FULL/1d/550/2017/08/06/001000_0_0.png')
+    with pytest.raises(ValueError):
+        nict_himawari.scan_catalogue('uv')
+    nict_himawari._catalogues.clear()
+
+
+@patch('stitch.rammb_slider.default_fetcher')
+def test_goes16_catalogue_probes_likely_seconds_first(fetcher):
+    class _Fetcher(object):
+        urls = []
+
+        async def head(self, url, headers=None):
+            self.urls.append(url)
+            return SimpleNamespace(status_code=200 if url.split('/')[-3] == '20170806001537' else 404)
+
+    fetcher.return_value = _Fetcher()
+    rammb_slider._catalogues.clear()
+    rammb_slider._scan_seconds.clear()
+    try:
+        catalogue = rammb_slider.scan_catalogue('goes-16', 14)
+        assert catalogue.nearest(datetime(2017, 8, 6, 0, 15), timedelta(minutes=1)) == datetime(2017, 8, 6, 0, 15, 37)
+        # the first round of likely seconds held it
+        assert len(fetcher.return_value.urls) == rammb_slider._probe_round
+    finally:
+        rammb_slider._catalogues.clear()
+        rammb_slider._scan_seconds.clear()
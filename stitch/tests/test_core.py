@@ -1,59 +1,46 @@
-import os
+import asyncio
+import random
 import sys
+import threading
 from itertools import product as cartesian_product
 
 import pytest
 from PIL import Image
 
-from stitch.core import stitch, StitchException, overlay, side_by_side, stack
+from stitch.core import stitch, stitch_async, stitch_layers, Layer, StitchException, TileArray, TileCrop, overlay, \
+    composite_into, side_by_side, stack, set_tile_buffer_budget
+from stitch.core import _load_tile_inner
+from stitch.fetch import TileFetcher, run_sync, set_default_fetcher
 from stitch.tests._common import image_equivalence_test, path_of_test_resource, open_image, save_image
 
 if sys.version_info >= (3, 0):
-    from unittest.mock import patch
+    from unittest.mock import patch, MagicMock
 else:
-    from mock import patch
+    from mock import patch, MagicMock
 
 
-def _dummy_load(exclude_tiles=()):
-    def func(path_map):
-        xvals = [xy[0] for xy in path_map.keys()]
-        yvals = [xy[1] for xy in path_map.keys()]
-        minx, miny = min(xvals), min(yvals)
-
-        return {
-            (x, y): path_of_test_resource('imgs/({}_{}).jpg'.format(x - minx, y - miny))
-            for (x, y) in path_map.keys()
-            if (x, y) not in exclude_tiles
-        }
-
-    return func
-
-
-def _dummy_save():
-    from shutil import copyfile
-
-    def func(path_map, tmpdir):
-        xvals = [xy[0] for xy in path_map.keys()]
-        yvals = [xy[1] for xy in path_map.keys()]
-        minx, miny = min(xvals), min(yvals)
-
-        result = {}
+def _dummy_load(origin, exclude_tiles=(), batches=None, wrap=None):
+    # stands in for `_load_tile_inner`, serving the test tiles relative to the grid `origin`
+    async def func(path_map, process_response, **kwargs):
+        if batches is not None:
+            batches.append(len(path_map))
         for (x, y) in path_map.keys():
-            relpath = '({}_{}).jpg'.format(x - minx, y - miny)
-            src = path_of_test_resource(os.sep.join(['imgs', relpath]))
-            dest = os.path.join(tmpdir, relpath)
-            copyfile(src, dest)
-            result[x, y] = dest
-
-        return result
+            if (x, y) in exclude_tiles:
+                continue
+            i, j = x - origin[0], y - origin[1]
+            if wrap is not None:
+                i, j = i % wrap[0], j % wrap[1]
+            relpath = 'imgs/({}_{}).jpg'.format(i, j)
+            with open(path_of_test_resource(relpath), 'rb') as f:
+                yield x, y, process_response(f.read(), x, y)
 
     return func
 
 
 @image_equivalence_test
-@patch('stitch.core.load_tiles')
+@patch('stitch.core._load_tile_inner')
 def test_stitch_inmemory(load):
-    load.side_effect = _dummy_load()
+    load.side_effect = _dummy_load(origin=(2, 3))
 
     dummy_paths = {
         (x, y): 'http://dummy.com/({}_{}).png'.format(x, y)
@@ -66,9 +53,9 @@ def test_stitch_inmemory(load):
 
 
 @image_equivalence_test
-@patch('stitch.core.save_tiles')
-def test_stitch_tempdir_intermediate(save):
-    save.side_effect = _dummy_save()
+@patch('stitch.core._load_tile_inner')
+def test_stitch_tempdir_intermediate(load):
+    load.side_effect = _dummy_load(origin=(2, 3))
 
     dummy_paths = {
         (x, y): 'http://dummy.com/({}_{}).png'.format(x, y)
@@ -80,10 +67,29 @@ def test_stitch_tempdir_intermediate(save):
     return actual, expected
 
 
+@patch('stitch.core._load_tile_inner')
+def test_stitch_buffered_spill_matches_streaming(load):
+    load.side_effect = _dummy_load(origin=(0, 0), exclude_tiles=((0, 0), (1, 2)))
+
+    dummy_paths = {
+        (x, y): 'http://dummy.com/({}_{}).png'.format(x, y)
+        for x, y in cartesian_product(range(0, 3), range(0, 4))
+    }
+
+    expected = stitch(dummy_paths, 'RGB')
+    for budget in (0, 20000, 64 * 1024 * 1024):
+        set_tile_buffer_budget(budget)
+        try:
+            actual = stitch(dummy_paths, 'RGB', tempfiles=True)
+        finally:
+            set_tile_buffer_budget(64 * 1024 * 1024)
+        assert actual.tobytes() == expected.tobytes()
+
+
 @image_equivalence_test
-@patch('stitch.core.load_tiles')
+@patch('stitch.core._load_tile_inner')
 def test_stitch_some_missing_tiles(load):
-    load.side_effect = _dummy_load(exclude_tiles=((0,0), (1,2)))
+    load.side_effect = _dummy_load(origin=(0, 0), exclude_tiles=((0,0), (1,2)))
 
     dummy_paths = {
         (x, y): 'http://dummy.com/({}_{}).png'.format(x, y)
@@ -96,10 +102,10 @@ def test_stitch_some_missing_tiles(load):
 
 
 @image_equivalence_test
-@patch('stitch.core.load_tiles')
+@patch('stitch.core._load_tile_inner')
 def test_stitch_with_missing_column(load):
     exclude = [(0, i) for i in range(4)]
-    load.side_effect = _dummy_load(exclude_tiles=exclude)
+    load.side_effect = _dummy_load(origin=(0, 0), exclude_tiles=exclude)
 
     dummy_paths = {
         (x, y): 'http://dummy.com/({}_{}).png'.format(x, y)
@@ -111,9 +117,139 @@ def test_stitch_with_missing_column(load):
     return actual, expected
 
 
-@patch('stitch.core.load_tiles')
+@patch('stitch.core._load_tile_inner')
+def test_stitch_async(load):
+    load.side_effect = _dummy_load(origin=(2, 3))
+
+    dummy_paths = {
+        (x, y): 'http://dummy.com/({}_{}).png'.format(x, y)
+        for x, y in cartesian_product(range(2, 5), range(3, 7))
+    }
+
+    actual = run_sync(stitch_async(dummy_paths, 'RGB'))
+    expected = stitch(dummy_paths, 'RGB')
+    assert actual.tobytes() == expected.tobytes()
+
+
+@patch('stitch.core._load_tile_inner')
+def test_stitch_windowed_matches_unwindowed(load):
+    exclude = [(0, i) for i in range(4)] + [(1, 2)]
+    batches = []
+    load.side_effect = _dummy_load(origin=(0, 0), exclude_tiles=exclude, batches=batches)
+
+    dummy_paths = {
+        (x, y): 'http://dummy.com/({}_{}).png'.format(x, y)
+        for x, y in cartesian_product(range(0, 3), range(0, 4))
+    }
+
+    actual = stitch(dummy_paths, 'RGB', window=5)
+    assert batches == [5, 5, 2]
+    expected = stitch(dummy_paths, 'RGB')
+    assert actual.size == expected.size
+    assert actual.tobytes() == expected.tobytes()
+
+
+@patch('stitch.core._load_tile_inner')
+def test_stitch_tempfiles_windowed(load):
+    batches = []
+    load.side_effect = _dummy_load(origin=(0, 0), exclude_tiles=[(1, 2)], batches=batches)
+
+    dummy_paths = {
+        (x, y): 'http://dummy.com/({}_{}).png'.format(x, y)
+        for x, y in cartesian_product(range(0, 3), range(0, 4))
+    }
+
+    actual = stitch(dummy_paths, 'RGB', tempfiles=True, window=5)
+    assert batches == [5, 5, 2]
+    assert actual.tobytes() == stitch(dummy_paths, 'RGB').tobytes()
+
+
+def test_tiles_decode_while_others_download():
+    decoded = threading.Event()
+
+    class _Fetcher(TileFetcher):
+        async def get(self, url, headers=None):
+            # the slow tile is only served once the fast one has been decoded
+            if url == 'slow':
+                for _ in range(200):
+                    if decoded.is_set():
+                        break
+                    await asyncio.sleep(0.01)
+                else:
+                    return MagicMock(status_code=404)
+            return MagicMock(status_code=200, content=url.encode())
+
+    def process(content, x, y):
+        decoded.set()
+        return content
+
+    async def load():
+        return [tile async for tile in _load_tile_inner({(0, 0): 'slow', (1, 0): 'fast'}, process)]
+
+    set_default_fetcher(_Fetcher())
+    try:
+        assert run_sync(load()) == [(1, 0, b'fast'), (0, 0, b'slow')]
+    finally:
+        set_default_fetcher(None)
+
+
+@patch('stitch.core._load_tile_inner')
+def test_stitch_windowed_lifts_tile_limit(load):
+    batches = []
+    # reuse the 3x4 grid of test tiles across the larger grid
+    load.side_effect = _dummy_load(origin=(0, 0), batches=batches, wrap=(3, 4))
+
+    many_tiles = {
+        (x, y): 'http://dummy.com/({}_{}).png'.format(x, y)
+        for x, y in cartesian_product(range(12), range(8))
+    }
+
+    result = stitch(many_tiles, 'RGB', window=40)
+    assert batches == [40, 40, 16]
+    assert result.size == (12 * 400, 8 * 250)
+
+
+@patch('stitch.core._load_tile_inner')
+def test_stitch_windowed_no_tiles(load):
+    exclude = list(cartesian_product(range(3), range(4)))
+    load.side_effect = _dummy_load(origin=(0, 0), exclude_tiles=exclude)
+
+    dummy_paths = {
+        (x, y): 'http://dummy.com/({}_{}).png'.format(x, y)
+        for x, y in cartesian_product(range(0, 3), range(0, 4))
+    }
+
+    with pytest.raises(StitchException):
+        stitch(dummy_paths, 'RGB', window=5)
+
+
+@patch('stitch.core._load_tile_inner')
+def test_stitch_layers_single_phase(load):
+    load.side_effect = _dummy_load(origin=(0, 0))
+
+    sat_paths = {
+        (x, y): 'http://dummy.com/sat/({}_{}).png'.format(x, y)
+        for x, y in cartesian_product(range(0, 3), range(0, 4))
+    }
+    map_paths = {
+        (x, y): 'http://dummy.com/map/({}_{}).png'.format(x, y)
+        for x, y in cartesian_product(range(0, 3), range(0, 4))
+    }
+
+    imgs = stitch_layers({'sat': Layer(sat_paths, 'RGB'), 'map': Layer(map_paths, 'RGBA', static=True)})
+    assert imgs['sat'].mode == 'RGB'
+    assert imgs['map'].mode == 'RGBA'
+    assert imgs['sat'].tobytes() == stitch(sat_paths, 'RGB').tobytes()
+
+    budgets = [call[1]['budget'] for call in load.call_args_list[:2]]
+    assert budgets[0] is budgets[1]
+    assert load.call_args_list[0][1]['static'] != load.call_args_list[1][1]['static']
+
+
+@patch('stitch.core._load_tile_inner')
 def test_stitch_with_no_tiles(load):
-    load.side_effect = lambda paths: dict()
+    exclude = list(cartesian_product(range(3), range(4)))
+    load.side_effect = _dummy_load(origin=(0, 0), exclude_tiles=exclude)
 
     dummy_paths = {
         (x, y): 'http://dummy.com/({}_{}).png'.format(x, y)
@@ -124,9 +260,9 @@ def test_stitch_with_no_tiles(load):
         stitch(dummy_paths, 'RGB')
 
 
-@patch('stitch.core.load_tiles')
+@patch('stitch.core._load_tile_inner')
 def test_stitch_limit_number_of_tiles(load):
-    load.side_effect = _dummy_load()
+    load.side_effect = _dummy_load(origin=(0, 0))
 
     too_many_tiles = {
         (x, y): 'http://dummy.com/({}_{}).png'.format(x, y)
@@ -137,6 +273,73 @@ def test_stitch_limit_number_of_tiles(load):
         stitch(too_many_tiles, 'RGB')
 
 
+def test_tilearray_setitem_getitem():
+    tiles = TileArray(2, 3, 4, 5, 'RGBA')
+    tile = Image.new('RGBA', (4, 5), (10, 20, 30, 40))
+    tiles[1, 2] = tile
+
+    assert tiles[0, 0] is None
+    assert tiles[1, 2].tobytes() == tile.tobytes()
+    assert tiles.missing.sum() == 5
+
+    tiles[1, 2] = None
+    assert tiles[1, 2] is None
+    assert tiles.missing.all()
+
+    with pytest.raises(IndexError):
+        tiles[1]
+
+
+def test_tilearray_rejects_mismatched_tile():
+    tiles = TileArray(2, 2, 4, 4)
+    with pytest.raises(StitchException):
+        tiles[0, 0] = Image.new('RGB', (5, 4))
+
+
+def test_tilearray_merge_matches_pasted_tiles():
+    tileimgs = {
+        (x, y): open_image('imgs/({}_{}).jpg'.format(x, y))
+        for x, y in cartesian_product(range(3), range(4))
+        if (x, y) not in ((0, 0), (1, 2))
+    }
+
+    expected = Image.new('RGB', (1200, 1000))
+    for (x, y), tile in tileimgs.items():
+        expected.paste(tile, (x * 400, y * 250))
+
+    assert TileArray.fromtiles(tileimgs).merge('RGB').tobytes() == expected.tobytes()
+
+
+def test_tilearray_fromtiles_keeps_alpha():
+    tileimgs = {(0, 0): Image.new('RGBA', (4, 4), (255, 0, 0, 0)),
+                (1, 0): Image.new('RGBA', (4, 4), (0, 255, 0, 128))}
+    merged = TileArray.fromtiles(tileimgs).merge('RGBA')
+    assert merged.getpixel((1, 1)) == (255, 0, 0, 0)
+    assert merged.getpixel((5, 1)) == (0, 255, 0, 128)
+
+
+def test_stitch_no_tiles():
+    for tempfiles in (False, True):
+        with pytest.raises(StitchException):
+            stitch({}, 'RGB', tempfiles=tempfiles)
+
+
+def test_tilearray_merge_rgba_is_zero_copy():
+    tiles = TileArray(1, 2, 4, 4, 'RGBA')
+    merged = tiles.merge()
+    tiles[0, 1] = Image.new('RGBA', (4, 4), (255, 0, 0, 255))
+    assert merged.getpixel((5, 0)) == (255, 0, 0, 255)
+
+
+def test_tilearray_trimmed():
+    tiles = TileArray(3, 3, 4, 4)
+    tiles[1, 1] = Image.new('RGB', (4, 4), (1, 2, 3))
+    tiles[1, 2] = Image.new('RGB', (4, 4), (4, 5, 6))
+    trimmed = tiles.trimmed()
+    assert (trimmed.width, trimmed.height) == (8, 4)
+    assert trimmed.merge('RGB').getpixel((7, 3)) == (4, 5, 6)
+
+
 @image_equivalence_test
 def test_overlay_top_left():
     im = open_image('imgs/baseimg.jpg')
@@ -157,6 +360,76 @@ def test_overlay_bottom_right():
     return result, expected
 
 
+def test_tile_crop_matches_cropping_full_grid():
+    rng = random.Random(12)
+    crops = [(0, 0, 0.8, 0.87), (0.2, 0, 0.85, 0.85), (0, 0, 1, 0.9), (0.5, 0.25, 1.0, 0.9), (0, 0, 1, 1)]
+    for _ in range(200):
+        xs, ys = sorted([rng.random(), rng.random()]), sorted([rng.random(), rng.random()])
+        crops.append((xs[0], ys[0], xs[1], ys[1]))
+
+    for cols, rows, cellsize in ((4, 3, 7), (5, 5, 10), (1, 2, 9)):
+        rangex, rangey = range(3, 3 + cols), range(1, 1 + rows)
+        full = Image.new('L', (cols * cellsize, rows * cellsize))
+        full.putdata([i % 251 for i in range(full.width * full.height)])
+        for crop in crops:
+            expected = full.crop((crop[0] * full.width, crop[1] * full.height,
+                                  crop[2] * full.width, crop[3] * full.height))
+            tile_crop = TileCrop(rangex, rangey, crop)
+            c0, r0 = tile_crop.rangex[0] - 3, tile_crop.rangey[0] - 1
+            sub = full.crop((c0 * cellsize, r0 * cellsize, (c0 + len(tile_crop.rangex)) * cellsize,
+                             (r0 + len(tile_crop.rangey)) * cellsize))
+            actual = sub.crop(tile_crop.box(sub))
+            assert actual.size == expected.size, crop
+            assert list(actual.getdata()) == list(expected.getdata()), crop
+
+
+def test_tile_crop_skips_tiles_outside_window():
+    tile_crop = TileCrop(range(0, 10), range(0, 10), (0, 0, 0.8, 0.87))
+    assert list(tile_crop.rangex) == list(range(0, 8))
+    assert list(tile_crop.rangey) == list(range(0, 9))
+
+    with pytest.raises(ValueError):
+        TileCrop(range(0, 10), range(0, 10), (0, 0, 1.2, 0.87))
+
+
+@patch('stitch.core._load_tile_inner')
+def test_tile_crop_with_missing_edge_tiles(load):
+    full = Image.new('L', (400, 200))
+    full.putdata([i % 251 for i in range(full.width * full.height)])
+
+    async def func(path_map, process_response, **kwargs):
+        for (x, y) in path_map.keys():
+            if x != 0:
+                yield x, y, full.crop((x * 100, y * 100, (x + 1) * 100, (y + 1) * 100))
+
+    load.side_effect = func
+    rangex, rangey = range(0, 4), range(0, 2)
+    # the crop of the whole grid, less the missing first column
+    for crop, expected_box in (((0, 0, 0.6, 1), (100, 0, 240, 200)), ((0.1, 0.2, 0.5, 0.9), (100, 40, 200, 180)),
+                               ((0.4, 0, 1, 1), (160, 0, 400, 200)), ((0.2, 0, 0.3, 1), (100, 0, 120, 200))):
+        tile_crop = TileCrop(rangex, rangey, crop)
+        img = stitch_layers({'sat': Layer({pos: 'http://dummy.com/{}_{}.png'.format(*pos)
+                                           for pos in cartesian_product(tile_crop.rangex, tile_crop.rangey)},
+                                          'L')})['sat']
+        actual = img.crop(tile_crop.box(img))
+        expected = full.crop(expected_box)
+        assert actual.size == expected.size, crop
+        assert list(actual.getdata()) == list(expected.getdata()), crop
+
+
+def test_composite_into_matches_chained_overlays():
+    im = open_image('imgs/baseimg.jpg')
+    wm = open_image('imgs/copyright-small.png')
+    corner = (im.width - wm.width, im.height - wm.height)
+    expected = overlay(overlay(im, wm), wm, pos=corner)
+
+    base = im.copy()
+    result = composite_into(base, wm, (wm, corner))
+    assert result is base
+    assert list(result.getdata()) == list(expected.getdata())
+    assert list(im.getdata()) != list(expected.getdata())
+
+
 @image_equivalence_test
 def test_sidebyside_right_img_larger():
     im1 = open_image('imgs/baseimg.jpg')
@@ -0,0 +1,347 @@
+import asyncio
+import sys
+import threading
+import time
+from types import SimpleNamespace
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from stitch import trace
+from stitch.fetch import AdaptiveConcurrency, FetchScheduler, TileFetcher, RetryPolicy, run_sync
+
+if sys.version_info >= (3, 0):
+    from unittest.mock import patch
+else:
+    from mock import patch
+
+
+class _TileHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super(_TileHandler, self).setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+        try:
+            if self.path.startswith('/missing'):
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = self.path.encode()
+            self.server.delay.wait(0.01)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def _local_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _TileHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.delay = threading.Event()
+    server.connections = 0
+    server.in_flight = 0
+    server.max_in_flight = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_fetch_all_in_order():
+    fetcher = TileFetcher()
+    with _local_server() as (server, base):
+        urls = ['{}/tile/{}.png'.format(base, i) for i in range(12)] + [base + '/missing.png']
+        resps = run_sync(fetcher.get_all(urls))
+    fetcher.close()
+
+    assert [resp.content for resp in resps[:-1]] == ['/tile/{}.png'.format(i).encode() for i in range(12)]
+    assert resps[-1].status_code == 404
+
+
+def test_fetch_reuses_connections_and_limits_per_host():
+    fetcher = TileFetcher(max_connections=16, per_host=4)
+    with _local_server() as (server, base):
+        for _ in range(3):
+            run_sync(fetcher.get_all('{}/tile/{}.png'.format(base, i) for i in range(20)))
+    fetcher.close()
+
+    assert server.max_in_flight <= 4
+    assert server.connections <= 4
+
+
+def test_fetch_unreachable_host_gives_none():
+    fetcher = TileFetcher(timeout=1)
+    resp = run_sync(fetcher.get('http://127.0.0.1:1/tile.png'))
+    fetcher.close()
+    assert resp is None
+
+
+def test_scheduler_takes_turns_between_renders():
+    scheduler = FetchScheduler(max_in_flight=1)
+    granted = []
+
+    async def request(flow, name):
+        await scheduler.acquire('host', flow=flow)
+        granted.append(name)
+        await asyncio.sleep(0.01)
+        scheduler.release('host')
+
+    async def main():
+        big = [asyncio.ensure_future(request('big', 'big{}'.format(i))) for i in range(3)]
+        await asyncio.sleep(0)
+        small = asyncio.ensure_future(request('small', 'small'))
+        await asyncio.gather(small, *big)
+
+    asyncio.run(main())
+    assert granted == ['big0', 'small', 'big1', 'big2']
+    assert scheduler.in_flight == 0
+
+
+def test_scheduler_rate_limits_per_host():
+    scheduler = FetchScheduler(rate=100, burst=2, host_rates={'slow': (20, 1)})
+
+    async def main():
+        started = time.monotonic()
+        await asyncio.gather(*(scheduler.acquire('fast') for _ in range(4)))
+        fast = time.monotonic() - started
+        started = time.monotonic()
+        await asyncio.gather(*(scheduler.acquire('slow') for _ in range(3)))
+        return fast, time.monotonic() - started
+
+    fast, slow = asyncio.run(main())
+    # two requests go in the burst, the rest wait for the bucket to refill
+    assert 0.015 <= fast < 0.1
+    assert 0.09 <= slow < 0.3
+    assert scheduler.in_flight == 7
+
+
+def test_scheduler_cancelled_waiter_gives_up_its_place():
+    scheduler = FetchScheduler(max_in_flight=1)
+
+    async def main():
+        await scheduler.acquire('host')
+        waiting = asyncio.ensure_future(scheduler.acquire('host'))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        scheduler.release('host')
+        await asyncio.wait_for(scheduler.acquire('host'), 1)
+
+    asyncio.run(main())
+    assert scheduler.in_flight == 1
+
+
+@patch('stitch.fetch.time')
+def test_adaptive_concurrency_aimd(mocktime):
+    mocktime.monotonic.return_value = 0.0
+    limit = AdaptiveConcurrency(initial=4, maximum=8).new_host(16)
+
+    # about one more request per round trip while the limit is in use
+    for _ in range(5):
+        limit.record(0.1, 200, saturated=True)
+    assert limit.current == 5
+    limit.record(0.1, 200, saturated=False)
+    assert limit.current == 5
+
+    # halved on congestion, but only once per round trip
+    mocktime.monotonic.return_value = 1.0
+    limit.record(0.1, 503, saturated=True)
+    limit.record(0.1, None, saturated=True)
+    assert limit.current == 2
+    mocktime.monotonic.return_value = 1.2
+    limit.record(0.5, 200, saturated=True)
+    assert limit.current == 1
+
+    for _ in range(200):
+        limit.record(0.1, 200, saturated=True)
+    assert limit.current == 8
+
+
+@patch('stitch.fetch.time')
+def test_adaptive_concurrency_baseline_per_method(mocktime):
+    mocktime.monotonic.return_value = 0.0
+    limit = AdaptiveConcurrency(initial=16).new_host(16)
+
+    # fast HEAD probes don't make healthy, slower GETs look congested
+    for _ in range(60):
+        limit.record(0.02, 200, saturated=False, method='HEAD')
+    for i in range(40):
+        mocktime.monotonic.return_value = i
+        limit.record(0.1, 200, saturated=False)
+    assert limit.current == 16
+
+    mocktime.monotonic.return_value = 100.0
+    limit.record(0.5, 200, saturated=False)
+    assert limit.current == 8
+
+
+def test_scheduler_adapts_host_limit():
+    scheduler = FetchScheduler(per_host=10, concurrency=AdaptiveConcurrency(initial=6))
+
+    async def main():
+        for _ in range(6):
+            await scheduler.acquire('host')
+        blocked = asyncio.ensure_future(scheduler.acquire('host'))
+        await asyncio.sleep(0)
+        assert not blocked.done()
+
+        with trace.recording() as recorder:
+            scheduler.release('host', 0.1, 429)
+        assert scheduler.limit('host') == 3
+        assert recorder.summary()['concurrency'] == {'host': 3}
+        for _ in range(2):
+            scheduler.release('host', 0.1, 200)
+        await asyncio.sleep(0)
+        assert not blocked.done()
+        scheduler.release('host', 0.1, 200)
+        await asyncio.wait_for(blocked, 1)
+
+    asyncio.run(main())
+    assert scheduler.in_flight == 3
+
+
+def test_run_sync_inside_running_loop():
+    async def inner():
+        return 42
+
+    async def outer():
+        return run_sync(inner())
+
+    assert asyncio.run(outer()) == 42
+
+
+class _ScriptedFetcher(TileFetcher):
+    # each call to `get` for a URL pops the next (delay, status) off that URL's script
+    def __init__(self, scripts):
+        super(_ScriptedFetcher, self).__init__()
+        self.scripts = scripts
+        self.calls = []
+
+    async def get(self, url, headers=None):
+        self.calls.append(url)
+        delay, status = self.scripts[url].pop(0)
+        await asyncio.sleep(delay)
+        if status is None:
+            return None
+        return SimpleNamespace(url=url, status_code=status, content=url.encode())
+
+
+def _fast_retries(**kwargs):
+    return RetryPolicy(backoff=0.001, max_backoff=0.001, **kwargs)
+
+
+def test_retry_until_success():
+    fetcher = _ScriptedFetcher({'a': [(0, None), (0, 503), (0, 200)]})
+    resp = run_sync(fetcher.fetch('a', retry=_fast_retries(retries=2)))
+    assert resp.status_code == 200
+    assert fetcher.calls == ['a', 'a', 'a']
+
+
+def test_no_retry_on_missing_tile():
+    fetcher = _ScriptedFetcher({'a': [(0, 404), (0, 200)]})
+    resp = run_sync(fetcher.fetch('a', retry=_fast_retries()))
+    assert resp.status_code == 404
+    assert fetcher.calls == ['a']
+
+
+def test_retry_budget_shared_across_render():
+    retry = _fast_retries(retries=5, budget=3)
+    state = retry.new_render()
+    fetcher = _ScriptedFetcher({'a': [(0, 500)] * 6, 'b': [(0, 500)] * 6})
+
+    async def render():
+        return await asyncio.gather(fetcher.fetch('a', retry=retry, state=state),
+                                    fetcher.fetch('b', retry=retry, state=state))
+
+    resps = run_sync(render())
+    assert [resp.status_code for resp in resps] == [500, 500]
+    assert len(fetcher.calls) == 2 + 3
+    assert state.retries == 3
+
+
+def test_backoff_delay_bounds():
+    retry = RetryPolicy(backoff=0.5, max_backoff=3.0, jitter=0.5)
+    for attempt, ceiling in ((0, 0.5), (1, 1.0), (2, 2.0), (5, 3.0)):
+        delay = retry.delay(attempt)
+        assert ceiling / 2 <= delay <= ceiling
+
+
+def test_hedge_straggler():
+    retry = _fast_retries(hedge=True, hedge_min_samples=3)
+    state = retry.new_render()
+    fetcher = _ScriptedFetcher({'fast{}'.format(i): [(0.01, 200)] for i in range(3)})
+    fetcher.scripts['slow'] = [(5.0, 200), (0.01, 200)]
+
+    async def render():
+        for i in range(3):
+            await fetcher.fetch('fast{}'.format(i), retry=retry, state=state)
+        return await fetcher.fetch('slow', retry=retry, state=state)
+
+    resp = run_sync(render())
+    assert resp.status_code == 200
+    assert fetcher.calls.count('slow') == 2
+    assert state.hedges == 1
+
+
+def test_hedge_straggler_among_concurrent_fetches():
+    retry = _fast_retries(hedge=True, hedge_min_samples=3)
+    state = retry.new_render()
+    fetcher = _ScriptedFetcher({'fast{}'.format(i): [(0.01, 200)] for i in range(9)})
+    fetcher.scripts['slow'] = [(3.0, 200), (0.01, 200)]
+
+    async def render():
+        return await asyncio.gather(*(fetcher.fetch(url, retry=retry, state=state) for url in sorted(fetcher.scripts)))
+
+    started = time.monotonic()
+    resps = run_sync(render())
+    assert [resp.status_code for resp in resps] == [200] * 10
+    assert fetcher.calls.count('slow') == 2
+    assert state.hedges == 1
+    assert time.monotonic() - started < 1.0
+
+
+class _SleepyFetcher(TileFetcher):
+    # goes through the scheduler, but each request just sleeps for its URL's delay
+    def __init__(self, delays, **kwargs):
+        super(_SleepyFetcher, self).__init__(**kwargs)
+        self.delays = delays
+
+    def _send(self, method, url, headers):
+        time.sleep(self.delays[url])
+        return SimpleNamespace(url=url, status_code=200, content=url.encode())
+
+
+def test_hedge_timed_from_scheduler_admission():
+    retry = _fast_retries(hedge=True, hedge_min_samples=3)
+    state = retry.new_render()
+    delays = dict({'http://a/{}'.format(i): 0.1 for i in range(3)}, **{'http://b/{}'.format(i): 0.02 for i in range(5)})
+    # one request at a time: the later ones queue far longer than any request takes
+    fetcher = _SleepyFetcher(delays, max_connections=1, concurrency=None)
+
+    async def render():
+        return await asyncio.gather(*(fetcher.fetch(url, retry=retry, state=state) for url in sorted(delays)))
+
+    resps = run_sync(render())
+    fetcher.close()
+    assert len(resps) == 8
+    assert state.hedges == 0
+    assert max(state._latencies) < 0.3
@@ -1,11 +1,19 @@
+import sys
 from datetime import datetime
 
 import pytest
-from PIL import ImageFilter
+from PIL import Image, ImageFilter, ImageFont
 
-from stitch.postprocess import PostProcessor, CIRAPostProcessor, NICTPostProcessor
+from stitch.core import resource_path
+from stitch.postprocess import PostProcessor, CIRAPostProcessor, NICTPostProcessor, _optimize, \
+    _label_font_size, _template_font_size, _thumbnail_size
 from stitch.tests._common import open_image, image_equivalence_test, save_image
 
+if sys.version_info >= (3, 0):
+    from unittest.mock import patch
+else:
+    from mock import patch
+
 
 @image_equivalence_test
 def test_crop_relative():
@@ -91,4 +99,83 @@ def test_multiple_edits():
     im.apply_filter(ImageFilter.SHARPEN)
     im.timestamp_label()
     im.logo()
-    return im.result(), open_image('imgs/baseimg_multiple_edits.jpg')
\ No newline at end of file
+    return im.result(), open_image('imgs/baseimg_multiple_edits.jpg')
+
+
+def _edit_chains():
+    yield lambda im: (im.apply_filter(ImageFilter.SHARPEN), im.crop_relative(0.5, 0.25, 1.0, 0.9),
+                      im.timestamp_label(), im.logo())
+    yield lambda im: (im.crop_relative(0.1, 0.1, 0.9, 0.9), im.crop_relative(0.2, 0, 0.7, 0.8),
+                      im.apply_filter(ImageFilter.MedianFilter(5)), im.apply_filter(ImageFilter.BLUR),
+                      im.crop_relative(0, 0.3, 0.6, 1.0), im.scale(0.5))
+    yield lambda im: (im.scale(1.5), im.minimize(300, 300),
+                      im.apply_filter(ImageFilter.EDGE_ENHANCE), im.crop_relative(0.25, 0.25, 0.75, 0.75),
+                      im.logo(), im.colorbar())
+    yield lambda im: (im.apply_filter(ImageFilter.GaussianBlur(3)), im.crop_relative(0, 0, 1, 1),
+                      im.crop_relative(0.4, 0.4, 1.0, 1.0), im.colorbar(), im.timestamp_label())
+
+
+@pytest.mark.parametrize('chain', list(_edit_chains()))
+def test_lazy_edits_match_eager(chain):
+    src = open_image('imgs/baseimg.jpg')
+    eager = CIRAPostProcessor(src, 'band_14', datetime(2017, 8, 6, 0, 0))
+    lazy = CIRAPostProcessor(src, 'band_14', datetime(2017, 8, 6, 0, 0), lazy=True)
+    chain(eager)
+    chain(lazy)
+
+    assert lazy.size == eager.size
+    assert lazy.result().tobytes() == eager.result().tobytes()
+    assert src.tobytes() == open_image('imgs/baseimg.jpg').tobytes()
+
+
+def test_lazy_edits_deferred_until_result():
+    im = PostProcessor(open_image('imgs/baseimg.jpg'), datetime(2017, 8, 6, 0, 0), lazy=True)
+    im.apply_filter(ImageFilter.SHARPEN)
+    im.crop_relative(0.5, 0.25, 1.0, 0.9)
+    assert len(im._plan) == 2
+    # the crop runs before the filter, which then only sees the kept pixels plus its margin
+    assert [op[0] for op in _optimize(im._plan, im.original.size)] == ['crop', 'filter', 'crop']
+
+    im.lazy = False
+    assert im._plan == []
+    assert im.size == im.result().size
+
+
+def test_label_font_size_matches_linear_search():
+    text = '2017-08-06 00:00:00 UTC'
+    for target_width, target_height in ((1, 1), (40, 9), (160, 30), (400, 12), (90, 200), (0, 50)):
+        width, height = 0, 0
+        fontsize = 1
+        expected = None
+        while width < target_width and height < target_height:
+            font = ImageFont.truetype(resource_path('Verdana.ttf'), fontsize)
+            width, height = font.getsize(text)
+            expected = fontsize
+            fontsize += 1
+        assert _label_font_size(text, target_width, target_height) == expected
+
+
+def test_label_font_size_shared_across_frames():
+    _template_font_size.cache_clear()
+    for minute in range(0, 60, 10):
+        im = NICTPostProcessor(open_image('imgs/baseimg.jpg'), datetime(2017, 8, 6, 0, minute), lazy=True)
+        im.timestamp_label()
+    assert _template_font_size.cache_info().misses == 1
+
+
+def test_thumbnail_size_matches_thumbnail():
+    for size in ((400, 300), (300, 400), (1000, 7), (7, 1000), (500, 500), (31, 17)):
+        for target in ((80, 80), (200, 50), (50.5, 200.7), (1, 1), (600, 600), (499, 1000)):
+            im = Image.new('1', size)
+            im.thumbnail(target)
+            assert _thumbnail_size(size, target) == im.size, (size, target)
+
+
+def test_assets_loaded_once():
+    first = NICTPostProcessor(open_image('imgs/baseimg.jpg'), datetime(2017, 8, 6, 0, 0))
+    second = NICTPostProcessor(open_image('imgs/baseimg.jpg'), datetime(2017, 8, 6, 0, 10))
+    with patch('stitch.postprocess.Image.open', wraps=Image.open) as image_open:
+        first.logo()
+        second.logo()
+    assert image_open.call_count <= 1
+    assert first.result().tobytes() == second.result().tobytes()
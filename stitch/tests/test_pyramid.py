@@ -0,0 +1,104 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from stitch import pyramid
+from stitch.core import StitchException
+
+if sys.version_info >= (3, 0):
+    from unittest.mock import patch
+else:
+    from mock import patch
+
+
+def _mosaic(width, height):
+    rng = np.random.RandomState(0)
+    return Image.fromarray(rng.randint(0, 256, (height, width, 3), dtype=np.uint8), 'RGB')
+
+
+def _dummy_load(mosaic, cell, exclude_tiles=(), rows=None):
+    # serves cells of `mosaic` as the tiles of the grid
+    async def func(path_map, process_response, **kwargs):
+        if rows is not None:
+            rows.append(sorted({y for _, y in path_map}))
+        for (x, y) in path_map.keys():
+            if (x, y) in exclude_tiles:
+                continue
+            yield x, y, mosaic.crop((x * cell, y * cell, (x + 1) * cell, (y + 1) * cell))
+
+    return func
+
+
+def _tile(outdir, z, x, y):
+    return Image.open(os.path.join(str(outdir), str(z), str(x), '{}.png'.format(y)))
+
+
+def test_write_pyramid_levels_match_downsampled_mosaic(tmpdir):
+    mosaic = _mosaic(100, 70)
+    assert pyramid.write_pyramid(mosaic, str(tmpdir), tile_size=16) == 3
+
+    # full resolution tiles, padded past the edge of the mosaic
+    assert list(_tile(tmpdir, 3, 2, 1).getdata()) == list(mosaic.crop((32, 16, 48, 32)).getdata())
+    assert list(_tile(tmpdir, 3, 6, 4).getdata()) == list(mosaic.crop((96, 64, 112, 80)).getdata())
+    assert not tmpdir.join('3', '7').check()
+
+    # each level is the one above halved, however the strips were cut
+    level1 = mosaic.reduce(2).reduce(2)
+    assert list(_tile(tmpdir, 1, 1, 0).getdata()) == list(level1.crop((16, 0, 32, 16)).getdata())
+    assert list(_tile(tmpdir, 0, 0, 0).getdata()) == list(level1.reduce(2).crop((0, 0, 16, 16)).getdata())
+    assert sorted(os.listdir(str(tmpdir))) == ['0', '1', '2', '3']
+
+
+@patch('stitch.core._load_tile_inner')
+def test_stitch_pyramid_streams_rows_and_skips_missing_tiles(load, tmpdir):
+    mosaic = _mosaic(120, 90)
+    rows = []
+    load.side_effect = _dummy_load(mosaic, 30, exclude_tiles={(0, 0), (1, 0), (2, 0), (3, 0), (3, 2)}, rows=rows)
+    urls = {(x, y): 'http://dummy.com/{}_{}.png'.format(x, y) for x in range(4) for y in range(3)}
+
+    assert pyramid.stitch_pyramid(urls, str(tmpdir), tile_size=30, min_zoom=1) == 2
+    assert rows == [[0], [1], [2]]
+
+    # the first row of tiles is missing, so is the top strip of output tiles
+    assert not tmpdir.join('2', '0', '0.png').check()
+    assert list(_tile(tmpdir, 2, 1, 1).getdata()) == list(mosaic.crop((30, 30, 60, 60)).getdata())
+    # the output tile under the missing corner tile only
+    assert not tmpdir.join('2', '3', '2.png').check()
+    assert tmpdir.join('2', '2', '2.png').check()
+    assert not tmpdir.join('0').check()
+
+
+@patch('stitch.core._load_tile_inner')
+def test_stitch_pyramid_no_tiles(load, tmpdir):
+    load.side_effect = _dummy_load(_mosaic(60, 60), 30, exclude_tiles={(0, 0), (1, 0)})
+    with pytest.raises(StitchException):
+        pyramid.stitch_pyramid({(0, 0): 'a', (1, 0): 'b'}, str(tmpdir), tile_size=32)
+
+
+def test_write_pyramid_skips_black_tiles(tmpdir):
+    mosaic = Image.new('RGB', (64, 32))
+    mosaic.paste((10, 80, 160), (40, 0, 64, 32))
+    assert pyramid.write_pyramid(mosaic, str(tmpdir), tile_size=16) == 2
+
+    assert sorted(os.listdir(str(tmpdir.join('2')))) == ['2', '3']
+    assert not tmpdir.join('1', '0').check()
+    assert tmpdir.join('1', '1', '0.png').check()
+
+
+def test_write_pyramid_skips_transparent_tiles(tmpdir):
+    # transparent, whatever the color channels hold
+    mosaic = Image.new('RGBA', (32, 16), (255, 255, 255, 0))
+    mosaic.paste((255, 255, 0, 128), (20, 4, 22, 6))
+    pyramid.write_pyramid(mosaic, str(tmpdir), tile_size=16)
+
+    assert not tmpdir.join('1', '0').check()
+    assert tmpdir.join('1', '1', '0.png').check()
+    assert tmpdir.join('0', '0', '0.png').check()
+
+
+def test_tile_size_must_be_even(tmpdir):
+    with pytest.raises(ValueError):
+        pyramid.write_pyramid(_mosaic(10, 10), str(tmpdir), tile_size=15)
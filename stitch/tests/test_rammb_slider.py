@@ -0,0 +1,239 @@
+import sys
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+from stitch import rammb_slider
+from stitch.core import overlay
+from stitch.tests._common import imgs_eq
+
+if sys.version_info >= (3, 0):
+    from unittest.mock import patch
+else:
+    from mock import patch
+
+
+def _layer(color):
+    im = Image.new('RGBA', (40, 30))
+    im.paste(color, (0, 0, 20, 30))
+    return im
+
+
+def _dummy_stitch_layers(sat_img, layer_imgs, calls):
+    def func(layers, **kwargs):
+        calls.append(sorted(layers.keys()))
+        result = {}
+        for name in layers:
+            result[name] = sat_img.copy() if name == 'sat' else layer_imgs[name].copy()
+        return result
+
+    return func
+
+
+@patch('stitch.rammb_slider.stitch_layers')
+def test_overlay_layers_cached(stitch_layers):
+    calls = []
+    stitch_layers.side_effect = _dummy_stitch_layers(None, {'map': _layer((255, 255, 255, 128)),
+                                                            'lat': _layer((255, 0, 0, 255))}, calls)
+    rammb_slider.clear_overlay_cache()
+
+    first = rammb_slider.overlay_layers('himawari', 3, 'full_disk', range(2, 4), range(2, 3))
+    second = rammb_slider.overlay_layers('himawari', 3, 'full_disk', range(2, 4), range(2, 3))
+    assert first is second
+    assert calls == [['lat', 'map']]
+
+    rammb_slider.overlay_layers('himawari', 4, 'full_disk', range(2, 4), range(2, 3))
+    assert len(calls) == 2
+    rammb_slider.clear_overlay_cache()
+
+
+@patch('stitch.rammb_slider.stitch_layers')
+def test_render_fetches_all_layers_at_once(stitch_layers):
+    calls = []
+    base = Image.new('RGB', (40, 30), (10, 80, 160))
+    map_layer = _layer((255, 255, 255, 128))
+    lat_layer = Image.new('RGBA', (40, 30))
+    lat_layer.paste((255, 0, 0, 100), (10, 0, 30, 30))
+    stitch_layers.side_effect = _dummy_stitch_layers(base, {'map': map_layer, 'lat': lat_layer}, calls)
+    rammb_slider.clear_overlay_cache()
+
+    actual = rammb_slider.himawari(datetime(2017, 8, 6, 0, 0), 3, 13, range(2, 4), range(2, 3),
+                                   latlon=True).result()
+    assert calls == [['lat', 'map', 'sat']]
+    expected = overlay(overlay(base, map_layer), lat_layer)
+    assert imgs_eq(actual, expected, tolerance=2)
+
+    # overlays come from the cache on the next render of the same region
+    rammb_slider.himawari(datetime(2017, 8, 6, 0, 10), 3, 13, range(2, 4), range(2, 3), latlon=True)
+    assert calls[-1] == ['sat']
+    rammb_slider.clear_overlay_cache()
+
+
+class _SecondsFetcher(object):
+    def __init__(self, valid_seconds):
+        self.valid_seconds = valid_seconds
+        self.probes = []
+
+    async def head(self, url, headers=None):
+        self.probes.append(url)
+        seconds = int(url.split('/')[-3][-2:])
+        return SimpleNamespace(status_code=200 if seconds in self.valid_seconds else 404)
+
+
+@patch('stitch.rammb_slider.default_fetcher')
+def test_scan_seconds_single_round_and_memoized(fetcher):
+    fake = _SecondsFetcher(valid_seconds={41})
+    fetcher.return_value = fake
+    resolver = rammb_slider.ScanSecondsResolver()
+
+    scan = datetime(2017, 8, 6, 0, 15)
+    assert resolver.resolve('goes-16', 'full_disk', scan, 3, 'band_14') == 41
+    assert len(fake.probes) == 60
+
+    # same scan, different product and zoom: no more probes
+    assert resolver.resolve('goes-16', 'full_disk', scan.replace(second=41), 4, 'band_02') == 41
+    assert len(fake.probes) == 60
+
+
+@patch('stitch.rammb_slider.default_fetcher')
+def test_scan_seconds_prefers_likely_candidates(fetcher):
+    fetcher.return_value = _SecondsFetcher(valid_seconds={5, 37})
+    resolver = rammb_slider.ScanSecondsResolver()
+    with pytest.warns(UserWarning):
+        assert resolver.resolve('goes-16', 'conus', datetime(2017, 8, 6, 0, 15), 3, 'band_14') == 37
+
+
+@patch('stitch.rammb_slider.default_fetcher')
+def test_scan_seconds_not_found_not_memoized(fetcher):
+    fake = _SecondsFetcher(valid_seconds=set())
+    fetcher.return_value = fake
+    resolver = rammb_slider.ScanSecondsResolver()
+    assert resolver.resolve('goes-16', 'conus', datetime(2017, 8, 6, 0, 15), 3, 'band_14') == 0
+    resolver.resolve('goes-16', 'conus', datetime(2017, 8, 6, 0, 15), 3, 'band_14')
+    assert len(fake.probes) == 120
+
+
+@patch('stitch.rammb_slider.default_fetcher')
+def test_scan_seconds_persisted(fetcher, tmpdir):
+    path = str(tmpdir.join('seconds.json'))
+    fetcher.return_value = _SecondsFetcher(valid_seconds={22})
+    rammb_slider.ScanSecondsResolver(path).resolve('goes-16', 'conus', datetime(2017, 8, 6, 0, 15), 3, 'band_14')
+
+    fake = _SecondsFetcher(valid_seconds=set())
+    fetcher.return_value = fake
+    assert rammb_slider.ScanSecondsResolver(path).resolve('goes-16', 'conus', datetime(2017, 8, 6, 0, 15),
+                                                          3, 'band_14') == 22
+    assert fake.probes == []
+
+
+@patch('stitch.rammb_slider.default_fetcher')
+def test_scan_seconds_shared_by_processes(fetcher, tmpdir):
+    path = str(tmpdir.join('seconds.json'))
+    first, second = rammb_slider.ScanSecondsResolver(path), rammb_slider.ScanSecondsResolver(path)
+    fetcher.return_value = _SecondsFetcher(valid_seconds={22})
+    first.resolve('goes-16', 'conus', datetime(2017, 8, 6, 0, 15), 3, 'band_14')
+    second.resolve('goes-16', 'conus', datetime(2017, 8, 6, 0, 20), 3, 'band_14')
+
+    fake = _SecondsFetcher(valid_seconds=set())
+    fetcher.return_value = fake
+    reloaded = rammb_slider.ScanSecondsResolver(path)
+    assert reloaded.resolve('goes-16', 'conus', datetime(2017, 8, 6, 0, 15), 3, 'band_14') == 22
+    assert reloaded.resolve('goes-16', 'conus', datetime(2017, 8, 6, 0, 20), 3, 'band_14') == 22
+    assert fake.probes == []
+
+
+@patch('stitch.rammb_slider.stitch_layers')
+def test_frames_share_overlays(stitch_layers):
+    calls = []
+    base = Image.new('RGB', (40, 30), (10, 80, 160))
+    stitch_layers.side_effect = _dummy_stitch_layers(base, {'map': _layer((255, 255, 255, 128))}, calls)
+    rammb_slider.clear_overlay_cache()
+
+    results = list(rammb_slider.frames(datetime(2017, 8, 6, 0, 0), datetime(2017, 8, 6, 1, 0),
+                                       timedelta(minutes=10), 3, 13, range(2, 4), range(2, 3)))
+    assert [result._timestamp for result in results] == [datetime(2017, 8, 6, 0, 0) + timedelta(minutes=10 * i)
+                                                         for i in range(7)]
+    assert calls.count(['map']) == 1
+    assert calls.count(['sat']) == 7
+    rammb_slider.clear_overlay_cache()
+
+
+def _grid_stitch_layers(counts):
+    # stitches 10px tiles colored by their position, so crops can be compared pixel for pixel
+    def func(layers, **kwargs):
+        result = {}
+        for name, layer in layers.items():
+            counts[name] = len(layer.pos_urls)
+            xs = sorted({x for x, _ in layer.pos_urls})
+            ys = sorted({y for _, y in layer.pos_urls})
+            im = Image.new(layer.mode, (10 * len(xs), 10 * len(ys)))
+            for x, y in layer.pos_urls:
+                color = (x * 20, y * 20, 100, 128 if name == 'map' else 255)
+                im.paste(color[:len(layer.mode)], (10 * xs.index(x), 10 * ys.index(y),
+                                                   10 * xs.index(x) + 10, 10 * ys.index(y) + 10))
+                im.putpixel((10 * xs.index(x) + x, 10 * ys.index(y) + y), (255,) * len(layer.mode))
+            result[name] = im
+        return result
+
+    return func
+
+
+@patch('stitch.rammb_slider.stitch_layers')
+def test_crop_fetches_only_intersecting_tiles(stitch_layers):
+    counts = {}
+    stitch_layers.side_effect = _grid_stitch_layers(counts)
+    rammb_slider.clear_overlay_cache()
+
+    full = rammb_slider.himawari(datetime(2017, 8, 6, 0, 0), 4, 13, range(0, 5), range(0, 4))
+    full.crop_relative(0.1, 0, 0.55, 0.6)
+    assert counts == {'sat': 20, 'map': 20}
+    rammb_slider.clear_overlay_cache()
+
+    cropped = rammb_slider.himawari(datetime(2017, 8, 6, 0, 0), 4, 13, range(0, 5), range(0, 4),
+                                    crop=(0.1, 0, 0.55, 0.6))
+    assert counts == {'sat': 9, 'map': 9}
+    assert list(cropped.result().getdata()) == list(full.result().getdata())
+    rammb_slider.clear_overlay_cache()
+
+
+def _band_stitch_layers(values, calls):
+    # stitches every product to a flat gray of its own brightness
+    def func(layers, **kwargs):
+        calls.append(sorted(layers.keys()))
+        return {name: Image.new(layer.mode, (40, 30), values.get(name, (255, 255, 255, 128)))
+                for name, layer in layers.items()}
+
+    return func
+
+
+@patch('stitch.rammb_slider.stitch_layers')
+def test_composite_fetches_all_bands_at_once(stitch_layers):
+    calls = []
+    stitch_layers.side_effect = _band_stitch_layers({'band_08': 100, 'band_10': 60, 'band_13': 200}, calls)
+    rammb_slider.clear_overlay_cache()
+
+    channels = (rammb_slider.Channel((8, 10), lambda b08, b10: b08 - b10, -40, 40),
+                rammb_slider.Channel(13, low=0, high=255, gamma=2),
+                rammb_slider.Channel('band_10', low=255, high=0))
+    result = rammb_slider.composite('himawari', datetime(2017, 8, 6, 0, 0), 3, channels,
+                                    range(2, 4), range(2, 5), boundaries=False)
+    assert calls == [['band_08', 'band_10', 'band_13']]
+    assert result.result().mode == 'RGB'
+    # 40 of -40..40 clips to full red, sqrt(200 / 255) of green, and band 10 inverted
+    assert result.result().getpixel((0, 0)) == (255, 226, 195)
+
+    rammb_slider.composite('himawari', datetime(2017, 8, 6, 0, 0), 3, channels, range(2, 4), range(2, 5))
+    rammb_slider.composite('himawari', datetime(2017, 8, 6, 0, 10), 3, channels, range(2, 4), range(2, 5))
+    assert calls[1:] == [['band_08', 'band_10', 'band_13', 'map'], ['band_08', 'band_10', 'band_13']]
+    rammb_slider.clear_overlay_cache()
+
+
+def test_composite_validates_channels():
+    with pytest.raises(ValueError):
+        rammb_slider.composite('himawari', datetime(2017, 8, 6, 0, 0), 3, (rammb_slider.Channel(13),),
+                               range(2, 4), range(2, 5))
+    with pytest.raises(ValueError):
+        rammb_slider.composite('himawari', datetime(2017, 8, 6, 0, 0), 3,
+                               (rammb_slider.Channel((8, 10)),) * 3, range(2, 4), range(2, 5))
@@ -0,0 +1,92 @@
+import sys
+from datetime import datetime
+
+from PIL import Image
+
+from stitch import core, trace
+from stitch.cache import TileCache
+from stitch.fetch import RetryPolicy, TileFetcher, set_default_fetcher
+from stitch.postprocess import PostProcessor
+from stitch.tests._common import png
+
+if sys.version_info >= (3, 0):
+    from unittest.mock import MagicMock
+else:
+    from mock import MagicMock
+
+
+class _FlakyFetcher(TileFetcher):
+    # fails the first request for every URL with a 503
+    def __init__(self):
+        super(_FlakyFetcher, self).__init__()
+        self.seen = set()
+
+    async def get(self, url, headers=None):
+        if url not in self.seen:
+            self.seen.add(url)
+            return MagicMock(status_code=503)
+        return MagicMock(status_code=200, content=png())
+
+
+def _urls():
+    return {(x, y): 'http://dummy.com/{}_{}.png'.format(x, y) for x in range(3) for y in range(2)}
+
+
+def test_records_stages_tiles_and_retries(tmpdir):
+    cache = TileCache(str(tmpdir))
+    cache.put('http://dummy.com/0_0.png', png())
+    core.set_tile_cache(cache)
+    set_default_fetcher(_FlakyFetcher())
+    core.set_retry_policy(RetryPolicy(backoff=0, jitter=0))
+    try:
+        with trace.recording() as recorder:
+            core.stitch_layers({'sat': core.Layer(_urls(), 'RGB')})
+    finally:
+        core.set_tile_cache(None)
+        set_default_fetcher(None)
+        core.set_retry_policy(RetryPolicy())
+
+    summary = recorder.summary()
+    assert set(summary['stages']) >= {'stitch_layers', 'merge'}
+    assert summary['tiles'] == 6
+    assert summary['cache_hit_rate'] == 1 / 6
+    assert summary['retries'] == 5
+    assert summary['bytes'] == 6 * len(png())
+
+    layers_span = next(record for record in recorder.records if record['name'] == 'stitch_layers')
+    assert layers_span['attrs']['retries'] == 5
+    merge_span = next(record for record in recorder.records if record['name'] == 'merge')
+    assert merge_span['parent'] == layers_span['id']
+
+
+def test_postprocess_ops_traced_when_run(tmpdir):
+    im = PostProcessor(Image.new('RGB', (40, 30)), datetime(2017, 8, 6, 0, 0), lazy=True)
+    with trace.recording() as recorder:
+        im.crop_relative(0, 0, 0.5, 0.5)
+        im.scale(2)
+        assert recorder.records == []
+        im.result()
+    assert [record['name'] for record in recorder.records] == ['postprocess.crop', 'postprocess.resize']
+
+    recorder.dump(str(tmpdir.join('trace.json')))
+    assert 'postprocess.crop' in tmpdir.join('trace.json').read()
+
+
+def test_disabled_without_listeners():
+    assert not trace.enabled()
+    assert trace.span('merge') is trace.span('stitch')
+
+    records = []
+    trace.add_listener(records.append)
+    try:
+        assert trace.enabled()
+        with trace.span('stage', answer=42) as stage:
+            stage.set(more=1)
+            trace.event('inside')
+    finally:
+        trace.remove_listener(records.append)
+    assert not trace.enabled()
+
+    inside, stage = records
+    assert inside['parent'] == stage['id']
+    assert stage['attrs'] == {'answer': 42, 'more': 1}
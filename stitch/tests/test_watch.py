@@ -0,0 +1,145 @@
+import sys
+from datetime import datetime, timedelta
+
+from stitch import rammb_slider
+from stitch.fetch import TileFetcher, set_default_fetcher
+from stitch.tests._common import png
+from stitch.watch import MosaicWatcher
+
+if sys.version_info >= (3, 0):
+    from unittest.mock import MagicMock, patch
+else:
+    from mock import MagicMock, patch
+
+
+class _ServerFetcher(TileFetcher):
+    # serves `tiles` (url -> payload) with content ETags, honouring If-None-Match
+    def __init__(self, tiles):
+        super(_ServerFetcher, self).__init__()
+        self.tiles = tiles
+        self.requests = []
+
+    async def get(self, url, headers=None):
+        self.requests.append((url, headers))
+        if url not in self.tiles:
+            return MagicMock(status_code=404)
+        etag = '"{}"'.format(hash(self.tiles[url]))
+        if headers and headers.get('If-None-Match') == etag:
+            return MagicMock(status_code=304, content=b'', headers={})
+        return MagicMock(status_code=200, content=self.tiles[url], headers={'ETag': etag})
+
+    async def head(self, url, headers=None):
+        self.requests.append((url, 'HEAD'))
+        return MagicMock(status_code=200 if url in self.tiles else 404)
+
+
+def _urls(tag):
+    return {(x, y): 'http://dummy.com/{}/{}_{}.png'.format(tag, x, y) for x in range(3) for y in range(2)}
+
+
+def test_revalidates_and_writes_only_changed_tiles():
+    tiles = {url: png((10, 80, 160)) for url in _urls('a').values()}
+    fetcher = _ServerFetcher(tiles)
+    set_default_fetcher(fetcher)
+    try:
+        watcher = MosaicWatcher()
+        assert sorted(watcher.update(_urls('a'))) == sorted(_urls('a'))
+        assert watcher.image().size == (30, 20)
+
+        fetcher.requests = []
+        assert watcher.update(_urls('a')) == []
+        assert all(headers and 'If-None-Match' in headers for _, headers in fetcher.requests)
+
+        tiles[_urls('a')[(1, 1)]] = png((255, 0, 0))
+        assert watcher.update(_urls('a')) == [(1, 1)]
+        assert watcher.image().getpixel((15, 15)) == (255, 0, 0)
+
+        # a new scan at new urls: only tiles whose content differs are written
+        tiles.update({url: png((10, 80, 160)) for url in _urls('b').values()})
+        assert watcher.update(_urls('b')) == [(1, 1)]
+        assert watcher.image().getpixel((15, 15)) == (10, 80, 160)
+
+        del tiles[_urls('b')[(2, 1)]]
+        assert watcher.update(_urls('b')) == [(2, 1)]
+        assert watcher.image().getpixel((25, 15)) == (0, 0, 0)
+    finally:
+        set_default_fetcher(None)
+
+
+def test_grid_change_downloads_tiles_seen_before():
+    urls = {(x, 0): 'http://dummy.com/{}_0.png'.format(x) for x in range(4)}
+    fetcher = _ServerFetcher({url: png((10, 80, 160)) for url in urls.values()})
+    set_default_fetcher(fetcher)
+    try:
+        watcher = MosaicWatcher()
+        watcher.update({pos: urls[pos] for pos in [(0, 0), (1, 0), (2, 0)]})
+        assert sorted(watcher.update({pos: urls[pos] for pos in [(1, 0), (2, 0), (3, 0)]})) == [(1, 0), (2, 0), (3, 0)]
+        assert watcher.image().size == (30, 10)
+        assert watcher.image().getpixel((5, 5)) == (10, 80, 160)
+    finally:
+        set_default_fetcher(None)
+
+
+def test_scan_watcher_follows_new_scans():
+    def scan(timestamp):
+        return {rammb_slider._rammb_img_url(timestamp, 'band_13', 3, 'full_disk', x, y, 'himawari'): png((10, 80, 160))
+                for x in range(2, 4) for y in range(2, 3)}
+
+    start = datetime(2017, 8, 6, 0, 0)
+    tiles = scan(start)
+    tiles.update(scan(start + timedelta(minutes=10)))
+    fetcher = _ServerFetcher(tiles)
+    set_default_fetcher(fetcher)
+    try:
+        watcher = rammb_slider.ScanWatcher('himawari', start, 3, 13, range(2, 4), range(2, 3), boundaries=False)
+        frame = watcher.poll()
+        assert frame._timestamp == start + timedelta(minutes=10)
+        assert watcher.poll() is None
+
+        tiles.update(scan(start + timedelta(minutes=20)))
+        fetcher.requests = []
+        assert watcher.poll()._timestamp == start + timedelta(minutes=20)
+        # probed the next two scans, then fetched the new one's tiles
+        assert [headers for _, headers in fetcher.requests] == ['HEAD', 'HEAD', None, None]
+
+        # no new scan: its tiles are only revalidated
+        fetcher.requests = []
+        assert watcher.poll() is None
+        assert [headers for _, headers in fetcher.requests][1:] == [{'If-None-Match': '"{}"'.format(
+            hash(png((10, 80, 160))))}] * 2
+    finally:
+        set_default_fetcher(None)
+
+
+@patch('stitch.rammb_slider.time')
+def test_goes16_scan_watcher_backs_off_missing_scans(mocktime):
+    mocktime.time.return_value = 1000.0
+    fetcher = _ServerFetcher({})
+    set_default_fetcher(fetcher)
+    try:
+        rammb_slider._scan_seconds.clear()
+        watcher = rammb_slider.ScanWatcher('goes-16', datetime(2017, 8, 6, 0, 0), 3, 13, range(2, 4), range(2, 3),
+                                           boundaries=False, retry=120)
+        assert watcher.poll() is None
+        assert len(fetcher.requests) == 60
+
+        # not looked for again until `retry` seconds later
+        assert watcher.poll() is None
+        assert len(fetcher.requests) == 60
+        mocktime.time.return_value = 1121.0
+        assert watcher.poll() is None
+        assert len(fetcher.requests) == 120
+    finally:
+        set_default_fetcher(None)
+
+
+def test_scan_watcher_does_not_probe_future_scans():
+    fetcher = _ServerFetcher({})
+    set_default_fetcher(fetcher)
+    try:
+        watcher = rammb_slider.ScanWatcher('goes-16', datetime.utcnow() + timedelta(minutes=5), 3, 13, range(2, 4),
+                                           range(2, 3), boundaries=False)
+        assert watcher.poll() is None
+        assert fetcher.requests == []
+    finally:
+        set_default_fetcher(None)
@@ -0,0 +1,170 @@
+"""
+Instrumentation for the render pipeline.
+
+Stages of a render -- the GOES-16 seconds probe, tile fetches, decoding, merging, overlays and
+postprocessing -- report timed spans and events to the listeners registered with
+`add_listener`, as do changes to the adaptive per-host concurrency limits of the fetcher
+('concurrency' events). A listener is any callable taking one record: a dict with the record `type`
+('span' or 'event'), its `name`, wall-clock `start`, the `parent` span id, the `attrs` of the
+stage and, for spans only, their own `id` and `duration` in seconds.
+
+While no listener is registered, `span` and `event` return immediately, so the instrumentation
+costs next to nothing.
+
+    with trace.recording() as recorder:
+        img = rammb_slider.himawari(...)
+    print(recorder.summary())
+    recorder.dump('trace.json')
+"""
+import contextvars
+import itertools
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+_listeners = ()
+_listeners_lock = threading.Lock()
+_span_ids = itertools.count(1)
+_current_span = contextvars.ContextVar('stitch_trace_span', default=None)
+
+
+def add_listener(listener):
+    global _listeners
+    with _listeners_lock:
+        _listeners = _listeners + (listener,)
+
+
+def remove_listener(listener):
+    global _listeners
+    with _listeners_lock:
+        _listeners = tuple(registered for registered in _listeners if registered != listener)
+
+
+def enabled():
+    return bool(_listeners)
+
+
+def span(name, **attrs):
+    """
+    Context manager timing the stage `name`. Attributes can be added to the span while it runs
+    with `set`.
+    """
+    if not _listeners:
+        return _null_span
+    return _Span(name, attrs)
+
+
+def event(name, **attrs):
+    if _listeners:
+        _emit({'type': 'event', 'name': name, 'start': time.time(), 'parent': _current_span.get(),
+               'attrs': attrs})
+
+
+def _emit(record):
+    for listener in _listeners:
+        listener(record)
+
+
+class _Span(object):
+    __slots__ = ('name', 'attrs', 'id', '_start', '_clock', '_token')
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.id = next(_span_ids)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self._token = _current_span.set(self.id)
+        self._start = time.time()
+        self._clock = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self._clock
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        _emit({'type': 'span', 'name': self.name, 'start': self._start, 'duration': duration,
+               'id': self.id, 'parent': _current_span.get(), 'attrs': self.attrs})
+        return False
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+class Recorder(object):
+    """
+    Listener that keeps every record, and summarizes them per stage.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def summary(self):
+        with self._lock:
+            records = list(self.records)
+
+        stages = {}
+        for record in records:
+            if record['type'] == 'span':
+                stage = stages.setdefault(record['name'], {'count': 0, 'total': 0.0, 'max': 0.0})
+                stage['count'] += 1
+                stage['total'] += record['duration']
+                stage['max'] = max(stage['max'], record['duration'])
+
+        tiles = [record['attrs'] for record in records if record['type'] == 'event' and record['name'] == 'tile']
+        # the adaptive concurrency limit each host was last left at
+        limits = {record['attrs']['host']: record['attrs']['limit'] for record in records
+                  if record['type'] == 'event' and record['name'] == 'concurrency'}
+        fetched = [tile for tile in tiles if not tile.get('cached')]
+        latencies = sorted(tile['latency'] for tile in fetched if tile.get('latency') is not None)
+        return {
+            'stages': stages,
+            'tiles': len(tiles),
+            'bytes': sum(tile.get('bytes') or 0 for tile in tiles),
+            'cache_hit_rate': (len(tiles) - len(fetched)) / len(tiles) if tiles else None,
+            'failed_tiles': sum(1 for tile in tiles if tile.get('status') != 200),
+            'retries': sum(1 for record in records if record['type'] == 'event' and record['name'] == 'retry'),
+            'hedges': sum(1 for record in records if record['type'] == 'event' and record['name'] == 'hedge'),
+            'latency_median': latencies[len(latencies) // 2] if latencies else None,
+            'latency_max': latencies[-1] if latencies else None,
+            'concurrency': limits,
+        }
+
+    def dump(self, path):
+        with self._lock:
+            records = list(self.records)
+        with open(path, 'w') as f:
+            json.dump({'records': records, 'summary': self.summary()}, f, indent=1, default=str)
+
+
+@contextmanager
+def recording():
+    recorder = Recorder()
+    add_listener(recorder)
+    try:
+        yield recorder
+    finally:
+        remove_listener(recorder)
@@ -0,0 +1,72 @@
+import hashlib
+
+from . import trace
+from .core import TileArray, StitchException, _buffer_mode, _load_tile_inner, _open_tile
+from .fetch import run_sync
+
+
+class MosaicWatcher(object):
+    """
+    A mosaic updated in place from conditional refetches of the same tile grid.
+    """
+
+    def __init__(self, mode='RGB'):
+        self.mode = mode
+        self._validators = {}
+        self._digests = {}
+        self._tiles = None
+        self._grid = None
+
+    def update(self, pos_urls):
+        return run_sync(self.update_async(pos_urls))
+
+    async def update_async(self, pos_urls):
+        """
+        Fetch the tiles of `pos_urls` and write those that changed into the mosaic, returning
+        their positions. Tiles that could not be fetched are cleared from the mosaic.
+        """
+        grid = frozenset(pos_urls.keys())
+        if grid != self._grid:
+            # a tile the new mosaic doesn't hold yet must be downloaded, even if it has not changed
+            self._tiles = None
+            self._digests.clear()
+            self._validators.clear()
+            self._grid = grid
+        minx = min(pos[0] for pos in grid)
+        miny = min(pos[1] for pos in grid)
+
+        with trace.span('watch', tiles=len(pos_urls)) as stage:
+            changed = []
+            fetched = set()
+            async for x, y, tile in _load_tile_inner(pos_urls, self._changed_tile, validators=self._validators):
+                fetched.add((x, y))
+                if tile is None:
+                    continue
+                digest, tile = tile
+                if self._tiles is None:
+                    rows = max(pos[1] for pos in grid) - miny + 1
+                    cols = max(pos[0] for pos in grid) - minx + 1
+                    self._tiles = TileArray(rows, cols, tile.width, tile.height, _buffer_mode(self.mode))
+                self._tiles[y - miny, x - minx] = tile
+                self._digests[(x, y)] = digest
+                changed.append((x, y))
+
+            for pos in grid - fetched:
+                if self._digests.pop(pos, None) is not None:
+                    self._tiles[pos[1] - miny, pos[0] - minx] = None
+                    changed.append(pos)
+            urls = set(pos_urls.values())
+            self._validators = {url: validator for url, validator in self._validators.items() if url in urls}
+            stage.set(changed=len(changed))
+        return changed
+
+    def image(self):
+        if self._tiles is None or not self._digests:
+            raise StitchException("Empty tiles")
+        return self._tiles.trimmed().merge(self.mode)
+
+    def _changed_tile(self, content, x, y):
+        digest = hashlib.sha1(content).digest()
+        if self._digests.get((x, y)) == digest:
+            return None
+        return digest, _open_tile(content, x, y)